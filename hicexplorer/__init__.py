@@ -19,4 +19,6 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 
 import multiprocessing as mp
-mp.set_start_method('fork')
+# keep a start method chosen before the import, e.g. in the processes started with spawn
+if mp.get_start_method(allow_none=True) is None:
+    mp.set_start_method('fork')
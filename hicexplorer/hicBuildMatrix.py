@@ -1,87 +1,646 @@
 import argparse
 import numpy as np
-from scipy.sparse import coo_matrix, dia_matrix
+from scipy.sparse import csr_matrix, triu
+import pandas as pd
 import time
 from os import unlink
 import os
+import shutil
+import tempfile
+import gzip
 from io import StringIO
 import traceback
+import zlib
+import json
 import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 
 import pysam
+import psutil
 from collections import OrderedDict
+from contextlib import contextmanager
 
-from copy import deepcopy
-from ctypes import Structure, c_uint, c_ushort
 from multiprocessing import Process, Queue
-from multiprocessing.sharedctypes import Array, RawArray
+from queue import Empty
 
 from intervaltree import IntervalTree, Interval
+import cooler
+import h5py
 
 from Bio.Seq import Seq
 
 # own tools
 from hicmatrix import HiCMatrix as hm
-from hicexplorer.utilities import getUserRegion, genomicRegion
+from hicexplorer.utilities import getUserRegion, genomicRegion, toString
 from hicexplorer._version import __version__
 import hicexplorer.hicPrepareQCreport as QC
 
-from hicmatrix.lib import MatrixFileHandler
-
 from hicexplorer import hicMergeMatrixBins
 import logging
 log = logging.getLogger(__name__)
 
 
-class C_Interval(Structure):
-    """Struct to map a Interval form intervaltree as a multiprocessing.sharedctype"""
-    _fields_ = [("begin", c_uint),
-                ("end", c_uint),
-                ("data", c_uint)]
+# Compact representation of a mate that is send to the worker processes.
+# pysam.AlignedSegment objects can not be pickled, therefore only the
+# fields needed to classify a read pair are kept.
+# 'dangling_end' is the index of the first restriction sequence whose
+# dangling sequence is found at the 5' end of the read, -1 otherwise.
+MATE_RECORD_DTYPE = np.dtype([('reference_id', np.int32),
+                              ('pos', np.int64),
+                              ('qlen', np.int32),
+                              ('query_length', np.int32),
+                              ('is_reverse', np.bool_),
+                              ('dangling_end', np.int16)])
+
+# Record of a read as it is returned by the bam reader processes.
+# In addition to the fields of MATE_RECORD_DTYPE the fields needed for
+# the filtering are kept. 'read_index' is the position of the read in the
+# bam file (not primary and supplementary alignments are not counted),
+# 'name_hash' the crc32 checksum of the read name and 'offset' the virtual
+# file offset of the first alignment of the read, used to split the bam files into shards.
+BAM_RECORD_DTYPE = np.dtype([('reference_id', np.int32),
+                             ('pos', np.int64),
+                             ('flag', np.uint16),
+                             ('mapq', np.uint8),
+                             ('qlen', np.int32),
+                             ('query_length', np.int32),
+                             ('is_reverse', np.bool_),
+                             ('dangling_end', np.int16),
+                             ('read_index', np.int64),
+                             ('name_hash', np.uint32),
+                             ('offset', np.int64)])
+# Number of reads per chunk of the bam reader processes. Small chunks
+# let the filtering start early, the buffers for the workers are
+# assembled from several chunks.
+BAM_READER_CHUNK_SIZE = 50000
+
+
+def _mix64(pKey):
+    """splitmix64 finalizer, used to hash arrays of uint64 values"""
+    with np.errstate(over='ignore'):
+        key = pKey ^ (pKey >> np.uint64(30))
+        key = key * np.uint64(0xBF58476D1CE4E5B9)
+        key ^= key >> np.uint64(27)
+        key = key * np.uint64(0x94D049BB133111EB)
+        key ^= key >> np.uint64(31)
+    return key
+
+
+def encode_read_pairs(pRefId1, pStart1, pRefId2, pStart2, pStrand1=None, pStrand2=None):
+    """
+    Encodes read pairs as two fixed-width integers. The first integer stores the
+    reference ids, the second the start positions, each in 32 bits.
+
+    Without strand information the reference ids and the start positions are ordered
+    independently, as it was done by the former string representation "chr1-chr2-start1-start2".
+    With strand information the mates are ordered by reference id and start position and the
+    strand is added as the lowest bit of the reference id.
+
+    >>> key_a, key_b = encode_read_pairs([1, 2], [20, 10], [2, 1], [10, 20])
+    >>> key_a[0] == key_a[1] and key_b[0] == key_b[1]
+    True
+    >>> key_a, key_b = encode_read_pairs([1, 1], [10, 10], [1, 1], [20, 20], [False, True], [True, True])
+    >>> key_a[0] == key_a[1]
+    False
+    """
+    ref_id1 = np.asarray(pRefId1, dtype=np.uint64)
+    ref_id2 = np.asarray(pRefId2, dtype=np.uint64)
+    start1 = np.asarray(pStart1, dtype=np.uint64)
+    start2 = np.asarray(pStart2, dtype=np.uint64)
+    if pStrand1 is None or pStrand2 is None:
+        ref_id_low = np.minimum(ref_id1, ref_id2)
+        ref_id_high = np.maximum(ref_id1, ref_id2)
+        start_low = np.minimum(start1, start2)
+        start_high = np.maximum(start1, start2)
+    else:
+        swap = (ref_id1 > ref_id2) | ((ref_id1 == ref_id2) & (start1 > start2))
+        ref_id1 = (ref_id1 << np.uint64(1)) | np.asarray(pStrand1, dtype=np.uint64)
+        ref_id2 = (ref_id2 << np.uint64(1)) | np.asarray(pStrand2, dtype=np.uint64)
+        ref_id_low = np.where(swap, ref_id2, ref_id1)
+        ref_id_high = np.where(swap, ref_id1, ref_id2)
+        start_low = np.where(swap, start2, start1)
+        start_high = np.where(swap, start1, start2)
 
+    key_a = (ref_id_low << np.uint64(32)) | ref_id_high
+    key_b = (start_low << np.uint64(32)) | start_high
+    return key_a, key_b
 
-class C_Coverage(Structure):
-    """Struct to model the coverage as a multiprocessing.sharedctype"""
 
-    _fields_ = [("begin", c_uint),
-                ("end", c_uint)]
+def _first_occurrence(pKeyA, pKeyB):
+    """
+    Returns the indices of the first occurrence of each key and a boolean array
+    that marks all later occurrences of a key as duplicated.
+    """
+    keys = np.empty(len(pKeyA), dtype=[('a', np.uint64), ('b', np.uint64)])
+    keys['a'] = pKeyA
+    keys['b'] = pKeyB
+    _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    duplicated = first_index[inverse.reshape(-1)] != np.arange(len(keys))
+    return first_index, duplicated
 
 
 class ReadPositionMatrix(object):
     """A class to check for PCR duplicates.
-       A set storing all possible
-       start sites. Checks if read is already in the set.
+       The positions of each read pair are encoded as two 64 bit integers
+       (see encode_read_pairs) and stored in an open addressing hash table
+       with linear probing that is backed by numpy arrays.
+       Checks if a read pair is already in the table.
     """
 
-    def __init__(self):
+    def __init__(self, pUseStrand=False, pInitialCapacity=2**16):
         """
         >>> rp = ReadPositionMatrix()
-        >>> rp.is_duplicated('1', 0, '2', 0)
+        >>> rp.is_duplicated(1, 0, 2, 0)
         False
-        >>> rp.is_duplicated('1', 0, '2', 0)
+        >>> rp.is_duplicated(1, 0, 2, 0)
+        True
+        >>> rp.is_duplicated(2, 0, 1, 0)
         True
+        >>> rp.are_duplicated([3, 3, 3], [10, 5, 5], [4, 4, 4], [20, 6, 6]).tolist()
+        [False, False, True]
+        >>> rp.false_positive_rate()
+        0.0
+        """
+        self.use_strand = pUseStrand
+        self.number_of_keys = 0
+        self._allocate(pInitialCapacity)
+
+    def _allocate(self, pCapacity):
+        # the capacity needs to be a power of two to use a bit mask instead of a modulo
+        self.capacity = int(2**np.ceil(np.log2(max(pCapacity, 2))))
+        self.key_a = np.zeros(self.capacity, dtype=np.uint64)
+        self.key_b = np.zeros(self.capacity, dtype=np.uint64)
+        self.occupied = np.zeros(self.capacity, dtype=np.bool_)
+
+    def _insert(self, pKeyA, pKeyB):
+        """
+        Inserts unique keys into the table.
+        Returns a boolean array which is True for keys that were already stored.
+        """
+        mask = np.uint64(self.capacity - 1)
+        slots = _mix64(_mix64(pKeyA) ^ pKeyB) & mask
+        found = np.zeros(len(pKeyA), dtype=np.bool_)
+        pending = np.arange(len(pKeyA))
+        while len(pending) > 0:
+            pending_slots = slots[pending]
+            occupied = self.occupied[pending_slots]
+            match = occupied & (self.key_a[pending_slots] == pKeyA[pending]) & \
+                (self.key_b[pending_slots] == pKeyB[pending])
+            found[pending[match]] = True
+
+            # keys pointing to the same free slot: only the first one is stored,
+            # the others try the same slot again in the next round
+            free = np.flatnonzero(~occupied)
+            _, first_free = np.unique(pending_slots[free], return_index=True)
+            stored = np.zeros(len(pending), dtype=np.bool_)
+            stored[free[first_free]] = True
+            stored_keys = pending[stored]
+            self.key_a[slots[stored_keys]] = pKeyA[stored_keys]
+            self.key_b[slots[stored_keys]] = pKeyB[stored_keys]
+            self.occupied[slots[stored_keys]] = True
+
+            collision = occupied & ~match
+            slots[pending[collision]] = (pending_slots[collision] + np.uint64(1)) & mask
+            pending = pending[~(match | stored)]
+        self.number_of_keys += int(len(pKeyA) - found.sum())
+        return found
+
+    def _grow(self, pNumberOfNewKeys):
+        # keep the load factor below 0.5
+        if 2 * (self.number_of_keys + pNumberOfNewKeys) <= self.capacity:
+            return
+        key_a = self.key_a[self.occupied]
+        key_b = self.key_b[self.occupied]
+        self._allocate(2 * (self.number_of_keys + pNumberOfNewKeys))
+        self.number_of_keys = 0
+        self._insert(key_a, key_b)
+
+    def are_duplicated(self, pRefId1, pStart1, pRefId2, pStart2, pStrand1=None, pStrand2=None):
         """
+        Checks an array of read pairs in the given order. A pair is duplicated if
+        it was seen before, either in a previous call or earlier in the same array.
+        The strands are only considered if the object was created with pUseStrand=True.
 
-        self.pos_matrix = set()
+        Returns a boolean numpy array
+        """
+        if not self.use_strand:
+            pStrand1 = pStrand2 = None
+        key_a, key_b = encode_read_pairs(pRefId1, pStart1, pRefId2, pStart2, pStrand1, pStrand2)
+        if len(key_a) == 0:
+            return np.zeros(0, dtype=np.bool_)
+        first_index, duplicated = _first_occurrence(key_a, key_b)
+        self._grow(len(first_index))
+        found = self._insert(key_a[first_index], key_b[first_index])
+        duplicated[first_index[found]] = True
+        return duplicated
+
+    def is_duplicated(self, chrom1, start1, chrom2, start2, strand1=False, strand2=False):
+        return bool(self.are_duplicated([chrom1], [start1], [chrom2], [start2], [strand1], [strand2])[0])
+
+    def memory_usage(self):
+        """Returns the size of the hash table in bytes"""
+        return self.key_a.nbytes + self.key_b.nbytes + self.occupied.nbytes
+
+    def false_positive_rate(self):
+        return 0.0
+
+
+class ReadPositionBloomFilter(object):
+    """A memory capped, probabilistic version of ReadPositionMatrix.
+       The encoded read pairs are stored in a Bloom filter of a fixed size.
+       The memory usage does not grow with the number of read pairs, but a
+       pair that was not seen before is reported as duplicated with a
+       small probability (false positive rate).
+    """
 
-    def is_duplicated(self, chrom1, start1, chrom2, start2):
-        if chrom1 < chrom2:
-            id_string = "{}-{}".format(chrom1, chrom2)
-        else:
-            id_string = "{}-{}".format(chrom2, chrom1)
+    def __init__(self, pMaxMemory, pUseStrand=False, pNumberOfHashFunctions=4):
+        """
+        pMaxMemory : size of the filter in bytes
 
-        if start1 < start2:
-            id_string += "-{}-{}".format(start1, start2)
-        else:
-            id_string += "-{}-{}".format(start2, start1)
+        >>> rp = ReadPositionBloomFilter(2**20)
+        >>> rp.is_duplicated(1, 0, 2, 0)
+        False
+        >>> rp.is_duplicated(2, 0, 1, 0)
+        True
+        >>> rp.are_duplicated([3, 3, 3], [10, 5, 5], [4, 4, 4], [20, 6, 6]).tolist()
+        [False, False, True]
+        >>> rp.memory_usage()
+        1048576
+        """
+        self.use_strand = pUseStrand
+        self.number_of_hash_functions = pNumberOfHashFunctions
+        self.bits = np.zeros(int(max(pMaxMemory, 1)), dtype=np.uint8)
+        self.number_of_bits = np.uint64(len(self.bits) * 8)
+
+    def _bit_positions(self, pKeyA, pKeyB):
+        # double hashing: h_i = h1 + i * h2
+        hash_1 = _mix64(_mix64(pKeyA) ^ pKeyB)
+        hash_2 = _mix64(hash_1) | np.uint64(1)
+        with np.errstate(over='ignore'):
+            for i in range(self.number_of_hash_functions):
+                yield (hash_1 + np.uint64(i) * hash_2) % self.number_of_bits
+
+    def are_duplicated(self, pRefId1, pStart1, pRefId2, pStart2, pStrand1=None, pStrand2=None):
+        """
+        Checks an array of read pairs in the given order. Identical pairs within
+        the array are detected exactly, pairs seen in previous calls with the Bloom filter.
 
-        if id_string in self.pos_matrix:
-            return True
+        Returns a boolean numpy array
+        """
+        if not self.use_strand:
+            pStrand1 = pStrand2 = None
+        key_a, key_b = encode_read_pairs(pRefId1, pStart1, pRefId2, pStart2, pStrand1, pStrand2)
+        if len(key_a) == 0:
+            return np.zeros(0, dtype=np.bool_)
+        first_index, duplicated = _first_occurrence(key_a, key_b)
+        found = np.ones(len(first_index), dtype=np.bool_)
+        bit_positions = list(self._bit_positions(key_a[first_index], key_b[first_index]))
+        for position in bit_positions:
+            found &= (self.bits[position >> np.uint64(3)] & (np.uint8(1) << (position & np.uint64(7)).astype(np.uint8))) > 0
+        for position in bit_positions:
+            position = position[~found]
+            np.bitwise_or.at(self.bits, position >> np.uint64(3), np.uint8(1) << (position & np.uint64(7)).astype(np.uint8))
+        duplicated[first_index[found]] = True
+        return duplicated
+
+    def is_duplicated(self, chrom1, start1, chrom2, start2, strand1=False, strand2=False):
+        return bool(self.are_duplicated([chrom1], [start1], [chrom2], [start2], [strand1], [strand2])[0])
+
+    def memory_usage(self):
+        """Returns the size of the filter in bytes"""
+        return self.bits.nbytes
+
+    def false_positive_rate(self):
+        """
+        Estimates the current false positive rate from the fraction of set bits:
+        (set bits / number of bits) ** number of hash functions
+        """
+        bits_per_byte = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint64)
+        set_bits = 0
+        chunk_size = 2**26
+        for i in range(0, len(self.bits), chunk_size):
+            set_bits += int(bits_per_byte[self.bits[i:i + chunk_size]].sum())
+        return (set_bits / float(self.number_of_bits)) ** self.number_of_hash_functions
+
+
+class PixelAccumulator(object):
+    """
+    Collects the contacts of the valid pairs as pixels of the upper triangle
+    of the Hi-C matrix. A pixel is stored as the key bin1_id * matrix size + bin2_id.
+    Up to pMaxPixelsInMemory keys are buffered, afterwards they are summed up and
+    written as a chunk sorted by key to a temporary folder. The pixels of the
+    matrix are created by merging all chunks, such that the memory usage does not
+    depend on the sequencing depth or the resolution.
+    """
+
+    def __init__(self, pMatrixSize, pMaxPixelsInMemory=2e7, pTempDir=None):
+        """
+        >>> acc = PixelAccumulator(3, pMaxPixelsInMemory=2)
+        >>> acc.add([0, 2, 1], [1, 0, 1])
+        >>> acc.add([1, 0], [0, 2])
+        >>> pixels = pd.concat(acc.pixels(pChunkSize=2))
+        >>> list(zip(pixels['bin1_id'], pixels['bin2_id'], pixels['count']))
+        [(0, 1, 2), (0, 2, 2), (1, 1, 1)]
+        >>> acc.to_matrix().toarray().tolist()
+        [[0, 2, 2], [2, 1, 0], [2, 0, 0]]
+        >>> acc.close()
+        """
+        self.matrix_size = pMatrixSize
+        self.max_pixels_in_memory = int(pMaxPixelsInMemory)
+        self.temp_dir = pTempDir
+        self.chunk_dir = None
+        # list of (keys, counts), either as numpy arrays or as file names of spilled chunks
+        self.chunks = []
+        self.buffer = []
+        self.buffer_size = 0
+
+    def add(self, pRow, pCol):
+        row = np.asarray(pRow, dtype=np.uint64)
+        col = np.asarray(pCol, dtype=np.uint64)
+        self.buffer.append(np.minimum(row, col) * np.uint64(self.matrix_size) + np.maximum(row, col))
+        self.buffer_size += len(row)
+        if self.buffer_size >= self.max_pixels_in_memory:
+            self._spill()
+
+    def add_pixels(self, pRow, pCol, pCount):
+        """
+        Adds pixels with counts, e.g. the pixels of a partial matrix. The pixels are
+        summed up and stored as a chunk of their own.
+
+        >>> acc = PixelAccumulator(3)
+        >>> acc.add([0], [1])
+        >>> acc.add_pixels([1, 2, 1], [0, 2, 0], [3, 1, 2])
+        >>> acc.to_matrix().toarray().tolist()
+        [[0, 6, 0], [6, 0, 0], [0, 0, 1]]
+        """
+        row = np.asarray(pRow, dtype=np.uint64)
+        col = np.asarray(pCol, dtype=np.uint64)
+        keys, inverse = np.unique(np.minimum(row, col) * np.uint64(self.matrix_size) + np.maximum(row, col),
+                                  return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=pCount, minlength=len(keys)).astype(np.uint32)
+        if len(keys) >= self.max_pixels_in_memory:
+            self._write_chunk(keys, counts)
         else:
-            self.pos_matrix.add(id_string)
-            return False
+            self.chunks.append((keys, counts))
+
+    def _reduce_buffer(self):
+        keys = np.concatenate(self.buffer) if self.buffer else np.zeros(0, dtype=np.uint64)
+        self.buffer = []
+        self.buffer_size = 0
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys, counts.astype(np.uint32)
+
+    def _spill(self):
+        self._write_chunk(*self._reduce_buffer())
+
+    def _write_chunk(self, keys, counts):
+        if self.chunk_dir is None:
+            self.chunk_dir = tempfile.mkdtemp(prefix='hicBuildMatrix_', dir=self.temp_dir)
+        chunk_prefix = os.path.join(self.chunk_dir, 'chunk_{}'.format(len(self.chunks)))
+        np.save(chunk_prefix + '_keys.npy', keys)
+        np.save(chunk_prefix + '_counts.npy', counts)
+        self.chunks.append((chunk_prefix + '_keys.npy', chunk_prefix + '_counts.npy'))
+
+    def checkpoint(self):
+        """
+        Writes all pixels that are kept in memory as chunks to the chunk folder and returns
+        the file names of all chunks relative to the chunk folder. With these names
+        and the chunk folder the accumulator can be restored by 'restore'.
+
+        >>> acc = PixelAccumulator(3)
+        >>> acc.add([0, 2], [1, 1])
+        >>> chunk_names = acc.checkpoint()
+        >>> restored = PixelAccumulator(3)
+        >>> restored.restore(acc.chunk_dir, chunk_names)
+        >>> restored.add([1], [0])
+        >>> restored.to_matrix().toarray().tolist()
+        [[0, 2, 0], [2, 0, 1], [0, 1, 0]]
+        >>> restored.close()
+        """
+        if self.buffer_size > 0:
+            self._spill()
+        # the chunk list only grows, the chunk at position i is stored as chunk_i
+        chunks = self.chunks
+        self.chunks = []
+        for keys, counts in chunks:
+            if isinstance(keys, str):
+                self.chunks.append((keys, counts))
+            else:
+                self._write_chunk(keys, counts)
+        return [(os.path.basename(keys), os.path.basename(counts)) for keys, counts in self.chunks]
+
+    def restore(self, pChunkDir, pChunkNames):
+        """
+        Continues with the chunks returned by 'checkpoint'. Chunks written to pChunkDir
+        after the checkpoint are ignored and overwritten.
+        """
+        self.chunk_dir = pChunkDir
+        self.chunks = [(os.path.join(pChunkDir, keys), os.path.join(pChunkDir, counts)) for keys, counts in pChunkNames]
+        self.buffer = []
+        self.buffer_size = 0
+
+    def pixels(self, pChunkSize=1e7):
+        """
+        k-way merge of all chunks. Yields data frames with the columns
+        'bin1_id', 'bin2_id' and 'count' sorted by bin1_id and bin2_id. Each data frame contains
+        at most pChunkSize pixels.
+        """
+        if self.buffer_size > 0:
+            self.chunks.append(self._reduce_buffer())
+        chunks = []
+        for keys, counts in self.chunks:
+            if isinstance(keys, str):
+                keys = np.load(keys, mmap_mode='r')
+                counts = np.load(counts, mmap_mode='r')
+            if len(keys) > 0:
+                chunks.append((keys, counts))
+        if len(chunks) == 0:
+            return
+        step = max(1, int(pChunkSize) // len(chunks))
+        position = [0] * len(chunks)
+        while True:
+            # the upper key of the merged part is chosen such that each
+            # chunk contributes at most 'step' pixels
+            upper = None
+            for (keys, _), start in zip(chunks, position):
+                if start + step < len(keys) and (upper is None or keys[start + step] < upper):
+                    upper = keys[start + step]
+            merge_keys = []
+            merge_counts = []
+            for i, (keys, counts) in enumerate(chunks):
+                start = position[i]
+                end = len(keys) if upper is None else start + int(np.searchsorted(keys[start:], upper))
+                merge_keys.append(np.asarray(keys[start:end]))
+                merge_counts.append(np.asarray(counts[start:end]))
+                position[i] = end
+            merge_keys, inverse = np.unique(np.concatenate(merge_keys), return_inverse=True)
+            merge_counts = np.bincount(inverse.reshape(-1), weights=np.concatenate(merge_counts),
+                                       minlength=len(merge_keys)).astype(np.int64)
+            if len(merge_keys) > 0:
+                yield pd.DataFrame({'bin1_id': (merge_keys // np.uint64(self.matrix_size)).astype(np.int64),
+                                    'bin2_id': (merge_keys % np.uint64(self.matrix_size)).astype(np.int64),
+                                    'count': merge_counts})
+            if upper is None:
+                break
+
+    def to_matrix(self):
+        """
+        Returns the symmetric Hi-C matrix as csr_matrix.
+        """
+        row = []
+        col = []
+        data = []
+        for chunk in self.pixels():
+            row.append(chunk['bin1_id'].values)
+            col.append(chunk['bin2_id'].values)
+            data.append(chunk['count'].values)
+        if len(row) == 0:
+            return csr_matrix((self.matrix_size, self.matrix_size), dtype=np.uint32)
+        upper_triangle = csr_matrix((np.concatenate(data).astype(np.uint32), (np.concatenate(row), np.concatenate(col))),
+                                    shape=(self.matrix_size, self.matrix_size))
+        return upper_triangle + triu(upper_triangle, k=1, format='csr').T
+
+    def close(self):
+        """
+        Removes the temporary files of the spilled chunks.
+        """
+        if self.chunk_dir is not None:
+            shutil.rmtree(self.chunk_dir, ignore_errors=True)
+            self.chunk_dir = None
+        self.chunks = []
+
+
+class PerformanceMonitor(object):
+    """
+    Collects the performance statistics of a run: the wall and cpu time of the stages
+    of the main process, the busy and idle time reported by the other processes, the
+    depths of the queues between the processes and the peak memory usage.
+    The time of a stage does not include the time of the stages nested in it.
+
+    >>> monitor = PerformanceMonitor()
+    >>> with monitor.stage('filtering'):
+    ...     with monitor.stage('duplication check'):
+    ...         pass
+    >>> list(monitor.stages)
+    ['duplication check', 'filtering']
+    >>> monitor.add_process_times('workers', 2.0, 1.5, 0.5)
+    >>> monitor.add_process_times('workers', 2.0, 1.5, 1.5)
+    >>> monitor.add_queue_depth('worker input', 2)
+    >>> monitor.add_queue_depth('worker input', 4)
+    >>> statistics = monitor.to_dict(pReadPairs=10, pParameters={'threads': 2})
+    >>> statistics['processes']['workers'], statistics['queues']['worker input']
+    ({'wall time': 4.0, 'cpu time': 3.0, 'idle time': 2.0, 'idle fraction': 0.3333}, {'mean': 3.0, 'max': 4})
+    """
+
+    def __init__(self):
+        self.start_wall_time = time.time()
+        self.start_cpu_time = time.process_time()
+        # name: [wall time, cpu time]
+        self.stages = OrderedDict()
+        # name: [wall time, cpu time, idle time]
+        self.processes = OrderedDict()
+        # name: [number of samples, sum of the depths, max depth]
+        self.queues = OrderedDict()
+        self.nested_times = []
+        self.process = psutil.Process()
+        self.peak_rss_main = 0
+        self.peak_rss_total = 0
+        self.last_memory_sample = 0
+
+    @contextmanager
+    def stage(self, pName):
+        start_wall_time = time.time()
+        start_cpu_time = time.process_time()
+        self.nested_times.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            wall_time = time.time() - start_wall_time
+            cpu_time = time.process_time() - start_cpu_time
+            nested_wall_time, nested_cpu_time = self.nested_times.pop()
+            self.add_stage_times(pName, wall_time - nested_wall_time, cpu_time - nested_cpu_time)
+            if self.nested_times:
+                self.nested_times[-1][0] += wall_time
+                self.nested_times[-1][1] += cpu_time
+
+    def add_stage_times(self, pName, pWallTime, pCpuTime):
+        stage_times = self.stages.setdefault(pName, [0.0, 0.0])
+        stage_times[0] += pWallTime
+        stage_times[1] += pCpuTime
+
+    def add_process_times(self, pName, pWallTime, pCpuTime, pIdleTime):
+        process_times = self.processes.setdefault(pName, [0.0, 0.0, 0.0])
+        process_times[0] += pWallTime
+        process_times[1] += pCpuTime
+        process_times[2] += pIdleTime
+
+    def add_queue_depth(self, pName, pDepth):
+        queue = self.queues.setdefault(pName, [0, 0, 0])
+        queue[0] += 1
+        queue[1] += pDepth
+        queue[2] = max(queue[2], pDepth)
+
+    def sample_queue(self, pName, pQueue):
+        try:
+            self.add_queue_depth(pName, pQueue.qsize())
+        except NotImplementedError:
+            # the size of a multiprocessing queue is not available on macOS
+            pass
+
+    def sample_memory(self, pMinInterval=1.0):
+        """
+        Updates the peak resident set size of the main process and of all processes.
+        Listing the child processes is not free, therefore the memory is sampled
+        at most every pMinInterval seconds.
+        """
+        if time.time() - self.last_memory_sample < pMinInterval:
+            return
+        self.last_memory_sample = time.time()
+        try:
+            rss_main = self.process.memory_info().rss
+            rss_total = rss_main
+            for child in self.process.children(recursive=True):
+                try:
+                    rss_total += child.memory_info().rss
+                except psutil.Error:
+                    # the child ended in between
+                    pass
+        except psutil.Error:
+            return
+        self.peak_rss_main = max(self.peak_rss_main, rss_main)
+        self.peak_rss_total = max(self.peak_rss_total, rss_total)
+
+    def to_dict(self, pReadPairs, pParameters):
+        wall_time = time.time() - self.start_wall_time
+        statistics = OrderedDict()
+        statistics['parameters'] = pParameters
+        statistics['read pairs'] = int(pReadPairs)
+        statistics['wall time'] = round(wall_time, 3)
+        statistics['cpu time'] = round(time.process_time() - self.start_cpu_time, 3)
+        statistics['read pairs per second'] = round(pReadPairs / wall_time, 1) if wall_time > 0 else 0
+        statistics['stages'] = OrderedDict()
+        for name, (stage_wall_time, stage_cpu_time) in self.stages.items():
+            statistics['stages'][name] = {'wall time': round(stage_wall_time, 3), 'cpu time': round(stage_cpu_time, 3)}
+        statistics['stages']['other'] = {'wall time': round(max(0, wall_time - sum(times[0] for times in self.stages.values())), 3),
+                                         'cpu time': round(max(0, statistics['cpu time'] - sum(times[1] for times in self.stages.values())), 3)}
+        statistics['processes'] = OrderedDict()
+        for name, (process_wall_time, process_cpu_time, idle_time) in self.processes.items():
+            statistics['processes'][name] = {'wall time': round(process_wall_time, 3),
+                                             'cpu time': round(process_cpu_time, 3),
+                                             'idle time': round(idle_time, 3),
+                                             'idle fraction': round(idle_time / (process_wall_time + idle_time), 4) if process_wall_time + idle_time > 0 else 0}
+        statistics['queues'] = OrderedDict()
+        for name, (number_of_samples, depth_sum, depth_max) in self.queues.items():
+            statistics['queues'][name] = {'mean': round(depth_sum / number_of_samples, 3), 'max': int(depth_max)}
+        self.sample_memory(pMinInterval=0)
+        statistics['peak rss (MB)'] = {'main process': round(self.peak_rss_main / 2**20, 1),
+                                       'all processes': round(self.peak_rss_total / 2**20, 1)}
+        return statistics
+
+    def save(self, pFileName, pReadPairs, pParameters):
+        with open(pFileName, 'w') as performance_file:
+            json.dump(self.to_dict(pReadPairs, pParameters), performance_file, indent=4)
 
 
 def parse_arguments(args=None):
@@ -99,12 +658,26 @@ def parse_arguments(args=None):
     parserRequired = parser.add_argument_group('Required arguments')
 
     # define the arguments
-    parserRequired.add_argument('--samFiles', '-s',
-                                help='The two PE alignment sam files to process',
-                                metavar='two sam files',
-                                nargs=2,
-                                type=argparse.FileType('r'),
-                                required=True)
+    parserInput = parserRequired.add_mutually_exclusive_group(required=True)
+    parserInput.add_argument('--samFiles', '-s',
+                             help='The two PE alignment sam files to process',
+                             metavar='two sam files',
+                             nargs=2,
+                             type=argparse.FileType('r'))
+    parserInput.add_argument('--pairsFile', '-pf',
+                             help='A pairs file in the 4DN format (.pairs or .pairs.gz) to process instead of '
+                             'the two sam files. The chromosome sizes are taken from the \'#chromsize:\' header lines '
+                             'or from --chromosomeSizes. If the columns mapq1 and mapq2 are present, the mapping quality '
+                             'filter is applied. As pairs files contain only the 5\' position of the reads, the '
+                             'dangling end check is not done, the read coverage is not computed and the bins are assigned '
+                             'by the 5\' positions.',
+                             metavar='pairs file')
+    parserInput.add_argument('--mergeShards',
+                             help='The partial matrices of all shards of a shard plan (see hicCreateShardPlan and --shardPlan) '
+                             'are merged to the matrix and the QC report a single run would give. All other parameters need '
+                             'to be the same as for the shards. The output can be a h5, cool or mcool file.',
+                             metavar='partial cool files',
+                             nargs='+')
 
     parserRequired.add_argument('--outFileName', '-o',
                                 help='Output file name for the Hi-C matrix.',
@@ -160,7 +733,7 @@ def parse_arguments(args=None):
                            'using this option. This bam file could be useful to inspect '
                            'the distribution of valid Hi-C reads pairs or for other '
                            'downstream analyses, but is not used by any HiCExplorer tool. '
-                           'Computation will be significantly longer if this option is set.',
+                           'The bam file is written by an additional process, see --compressionThreads.',
                            metavar='bam file',
                            type=argparse.FileType('w'),
                            required=False)
@@ -248,6 +821,22 @@ def parse_arguments(args=None):
                            default=15,
                            type=int
                            )
+    parserOpt.add_argument('--decompressionThreads',
+                           help='Number of threads used to decompress each of the two bam files. The two bam files '
+                           'are read by two additional processes. (Default: %(default)s).',
+                           required=False,
+                           default=2,
+                           type=int
+                           )
+
+    parserOpt.add_argument('--compressionThreads',
+                           help='Number of threads used to compress the bam file of --outBam. The bam file '
+                           'is written by an additional process. (Default: %(default)s).',
+                           required=False,
+                           default=2,
+                           type=int
+                           )
+
     parserOpt.add_argument('--threads',
                            help='Number of threads. Using the python multiprocessing module. '
                            'One master process which is used to read the input file into the buffer and one process which is merging '
@@ -295,6 +884,22 @@ def parse_arguments(args=None):
                            'get an estimation of the duplicated reads. ',
                            action='store_true'
                            )
+    parserOpt.add_argument('--duplicationCheckStrand',
+                           help='Consider the strand of both mates for the identification of '
+                           'duplicated read pairs. By default only the chromosome and the start '
+                           'position of the mates are used.',
+                           action='store_true'
+                           )
+    parserOpt.add_argument('--duplicationCheckMaxMemory',
+                           help='Upper memory limit in MB for the identification of duplicated read pairs. '
+                           'If set, a probabilistic detector (Bloom filter) of this size is used instead '
+                           'of the exact one. Duplicated pairs are never missed, but a small fraction of '
+                           'unique pairs can be reported as duplicated. The estimated false positive rate '
+                           'is written to the QC log. By default the exact detector is used '
+                           '(Default: %(default)s).',
+                           type=int,
+                           default=None
+                           )
     parserOpt.add_argument('--chromosomeSizes', '-cs',
                            help=('File with the chromosome sizes for your genome. A tab-delimited two column layout \"chr_name size\" is expected'
                                  'Usually the sizes can be determined from the SAM/BAM input files, however, '
@@ -304,6 +909,32 @@ def parse_arguments(args=None):
                                  'http://hgdownload.soe.ucsc.edu/goldenPath/dm3/bigZips/dm3.chrom.sizes'),
                            type=argparse.FileType('r'),
                            metavar='txt file')
+    parserOpt.add_argument('--shardPlan',
+                           help='Shard plan created by hicCreateShardPlan for the given sam files. Together with --shard '
+                           'only the read pairs of one shard are processed and a partial matrix is saved as cool file. '
+                           'The duplicated pairs are taken from the shard plan, such that duplicates in different shards '
+                           'are removed as in a single run. The partial matrices are merged with --mergeShards.',
+                           metavar='shard plan')
+    parserOpt.add_argument('--shard',
+                           help='Index of the shard to process, starting with 0. Needs --shardPlan.',
+                           type=int)
+    parserOpt.add_argument('--checkpointFolder',
+                           help='Folder to store checkpoints of the run. Periodically the contacts counted so far, the coverage, '
+                           'the state of the duplication check, the QC counters and the positions in both sam files are saved, '
+                           'such that a stopped run can be continued with --resume. Only one run should use the folder. '
+                           'Checkpoints are not supported together with --outBam, --pairsFile and --doTestRun.',
+                           metavar='FOLDER',
+                           default=None)
+    parserOpt.add_argument('--checkpointInterval',
+                           help='Time in minutes between two checkpoints, see --checkpointFolder'
+                           ' (Default: %(default)s).',
+                           type=float,
+                           default=30)
+    parserOpt.add_argument('--resume',
+                           help='Continue a stopped run from the last checkpoint in --checkpointFolder. All other parameters '
+                           'need to be the same as for the stopped run. If the folder contains no checkpoint, the run '
+                           'starts from the beginning.',
+                           action='store_true')
     parserOpt.add_argument("--help", "-h", action="help",
                            help="show this help message and exit")
 
@@ -338,6 +969,189 @@ def intervalListToIntervalTree(interval_list):
     return bin_int_tree
 
 
+class SortedIntervalIndex(object):
+    """
+    Stores a list of (chrom, start, end) intervals per chromosome in numpy arrays sorted
+    by start position. The chromosomes are placed one after the other on a single axis,
+    such that the intervals close to the positions of a whole batch of reads
+    are found with one searchsorted call.
+    """
+
+    def __init__(self, pIntervalList, pRefId2name):
+        intervals_per_chrom = OrderedDict()
+        for interval_id, (chrom, start, end) in enumerate(pIntervalList):
+            if chrom not in intervals_per_chrom:
+                intervals_per_chrom[chrom] = []
+            intervals_per_chrom[chrom].append((start, end, interval_id))
+
+        chrom_index = {}
+        begin = []
+        end = []
+        interval_id = []
+        chrom_of_interval = []
+        self.chrom_start = np.zeros(len(intervals_per_chrom), dtype=np.int64)
+        self.chrom_end = np.zeros(len(intervals_per_chrom), dtype=np.int64)
+        self.chrom_offset = np.zeros(len(intervals_per_chrom), dtype=np.int64)
+        offset = 0
+        for i, (chrom, interval_list) in enumerate(intervals_per_chrom.items()):
+            chrom_index[chrom] = i
+            interval_list = sorted(interval_list)
+            self.chrom_start[i] = len(begin)
+            self.chrom_end[i] = len(begin) + len(interval_list) - 1
+            self.chrom_offset[i] = offset
+            begin.extend([interval[0] for interval in interval_list])
+            end.extend([interval[1] for interval in interval_list])
+            interval_id.extend([interval[2] for interval in interval_list])
+            chrom_of_interval.extend([i] * len(interval_list))
+            offset += max([interval[1] for interval in interval_list]) + 1
+
+        self.begin = np.array(begin, dtype=np.int64)
+        self.end = np.array(end, dtype=np.int64)
+        self.interval_id = np.array(interval_id, dtype=np.int64)
+        chrom_of_interval = np.array(chrom_of_interval, dtype=np.int64)
+        self.offset_begin = self.begin + self.chrom_offset[chrom_of_interval]
+
+        self.ref_id2chrom = np.array([chrom_index.get(name, -1) for name in pRefId2name], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.begin)
+
+    def _last_interval_before(self, pRefIds, pPositions, pSide):
+        """
+        Finds for each position the last interval of its chromosome that starts
+        at or before (pSide='right') or strictly before (pSide='left') the position.
+
+        Returns the indices of the positions on a chromosome with intervals, their chromosome,
+        the found array positions and a boolean array if such an interval exists.
+        """
+        ref_ids = np.asarray(pRefIds, dtype=np.int64)
+        # reference ids unknown to the index are treated like references without intervals
+        chrom = np.full(len(ref_ids), -1, dtype=np.int64)
+        is_known = (ref_ids >= 0) & (ref_ids < len(self.ref_id2chrom))
+        chrom[is_known] = self.ref_id2chrom[ref_ids[is_known]]
+        valid = np.flatnonzero(chrom >= 0)
+        chrom = chrom[valid]
+        position = np.asarray(pPositions, dtype=np.int64)[valid]
+        candidate = np.searchsorted(self.offset_begin, self.chrom_offset[chrom] + position, side=pSide) - 1
+        candidate = np.minimum(candidate, self.chrom_end[chrom])
+        has_candidate = candidate >= self.chrom_start[chrom]
+        candidate = np.where(has_candidate, candidate, self.chrom_start[chrom])
+        return valid, chrom, candidate, has_candidate
+
+
+class BinIntervalIndex(SortedIntervalIndex):
+    """
+    Assigns genomic positions to the bins of the Hi-C matrix. This works for the even sized
+    bins of 'get_bins' as well as for the restriction fragment bins of 'get_rf_bins'.
+
+    Bins are closed intervals [begin, end], a position that is contained in more than one bin
+    (i.e. a position at the border of two bins or overlapping restriction fragment bins) is assigned
+    to the bin a binary search over the sorted bins of the chromosome finds first.
+    """
+
+    def __init__(self, pBinIntervals, pRefId2name):
+        """
+        >>> bin_list = [('chrX', 0, 50), ('chrX', 50, 100), ('chrY', 0, 30)]
+        >>> index = BinIntervalIndex(bin_list, ('chrY', 'chrX', 'chrZ'))
+        >>> bin_id, bin_begin = index.get_bins([1, 1, 1, 0, 0, 2], [10, 50, 75, 29, 40, 0])
+        >>> bin_id.tolist()
+        [0, 0, 1, 2, -1, -1]
+        >>> bin_begin.tolist()
+        [0, 0, 50, 0, -1, -1]
+        """
+        super(BinIntervalIndex, self).__init__(pBinIntervals, pRefId2name)
+        # largest end of all bins of the same chromosome that are sorted before a bin.
+        # If this is smaller than a position, no earlier bin contains the position.
+        self.max_end_before = np.full(len(self.end), -1, dtype=np.int64)
+        for start, stop in zip(self.chrom_start, self.chrom_end):
+            self.max_end_before[start + 1:stop + 1] = np.maximum.accumulate(self.end[start:stop])
+
+    def _binary_search(self, pLower, pUpper, pPosition):
+        """
+        Vectorized version of a binary search for a bin containing pPosition
+        between the array positions pLower and pUpper (both inclusive).
+        Returns the array positions of the found bins, -1 if none was found.
+        """
+        lower = pLower.copy()
+        upper = pUpper.copy()
+        result = np.full(len(pPosition), -1, dtype=np.int64)
+        active = lower <= upper
+        while np.any(active):
+            middle = np.where(active, (lower + upper) // 2, 0)
+            contained = (self.begin[middle] <= pPosition) & (pPosition <= self.end[middle])
+            found = active & contained
+            result[found] = middle[found]
+            go_left = active & ~contained & (self.begin[middle] > pPosition)
+            go_right = active & ~contained & ~go_left
+            upper[go_left] = middle[go_left] - 1
+            lower[go_right] = middle[go_right] + 1
+            active = go_left | go_right
+            active &= lower <= upper
+        return result
+
+    def get_bins(self, pRefIds, pPositions):
+        """
+        Returns for each position the id of the bin it belongs to and the start
+        position of this bin. Positions that are not covered by a bin, or that are on
+        a reference without bins, get -1 for both.
+        """
+        array_position = np.full(len(pPositions), -1, dtype=np.int64)
+        valid, chrom, candidate, has_candidate = self._last_interval_before(pRefIds, pPositions, 'right')
+        position = np.asarray(pPositions, dtype=np.int64)[valid]
+
+        # if no earlier bin reaches the position, the candidate is the only
+        # possible bin and the binary search would find it too.
+        ambiguous = has_candidate & (self.max_end_before[candidate] >= position)
+        found = has_candidate & ~ambiguous & (self.end[candidate] >= position)
+        array_position[valid[found]] = candidate[found]
+
+        array_position[valid[ambiguous]] = self._binary_search(self.chrom_start[chrom[ambiguous]],
+                                                               self.chrom_end[chrom[ambiguous]],
+                                                               position[ambiguous])
+        assigned = array_position >= 0
+        bin_id = np.full(len(array_position), -1, dtype=np.int64)
+        bin_begin = np.full(len(array_position), -1, dtype=np.int64)
+        bin_id[assigned] = self.interval_id[array_position[assigned]]
+        bin_begin[assigned] = self.begin[array_position[assigned]]
+        return bin_id, bin_begin
+
+
+class RestrictionSiteIndex(SortedIntervalIndex):
+    """
+    Stores the restriction sites given by the restriction cut files
+    to test for many genomic ranges at once if they contain a restriction site.
+    """
+
+    def __init__(self, pRestrictionSites, pRefId2name):
+        """
+        >>> sites = [('chr1', 10, 14), ('chr1', 60, 64), ('chr2', 5, 9)]
+        >>> index = RestrictionSiteIndex(sites, ('chr1', 'chr2', 'chr3'))
+        >>> index.has_site([0, 0, 0, 0, 1, 2], [0, 14, 14, 30, 0, 0], [11, 60, 61, 20, 100, 100]).tolist()
+        [True, False, True, False, True, False]
+        """
+        super(RestrictionSiteIndex, self).__init__(pRestrictionSites, pRefId2name)
+        # largest end of all sites of the same chromosome up to and including a site
+        self.max_end = self.end.copy()
+        for start, stop in zip(self.chrom_start, self.chrom_end):
+            self.max_end[start:stop + 1] = np.maximum.accumulate(self.end[start:stop + 1])
+
+    def has_site(self, pRefIds, pStart, pEnd):
+        """
+        Returns a boolean array that is True for all ranges [pStart, pEnd)
+        that overlap with at least one restriction site. Empty ranges never contain a site.
+        """
+        result = np.zeros(len(pStart), dtype=np.bool_)
+        if len(self) == 0:
+            return result
+        # all sites starting before the end of the range are candidates,
+        # one of them overlaps if the largest end is after the range start
+        valid, _, candidate, has_candidate = self._last_interval_before(pRefIds, pEnd, 'left')
+        start = np.asarray(pStart, dtype=np.int64)[valid]
+        end = np.asarray(pEnd, dtype=np.int64)[valid]
+        result[valid] = has_candidate & (start < end) & (self.max_end[candidate] > start)
+        return result
+
+
 def get_bins(bin_size, chrom_size, region=None):
     r"""
     Split the chromosomes into even sized bins
@@ -680,9 +1494,318 @@ def enlarge_bins(bin_intervals, chrom_sizes):
     return bin_intervals
 
 
-def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
+def get_max_coverage(pCoverage, pCoverageIndex):
+    """
+    Returns for each bin the maximum of the coverage elements from its first
+    element up to, but not including, its last element. Bins without coverage get NaN.
+
+    >>> coverage = np.array([0, 3, 1, 2, 0, 0, 5, 4, 0])
+    >>> get_max_coverage(coverage, np.array([[0, 2], [4, 5], [6, 8], [8, 7]]))
+    [3, nan, 5, nan]
+    """
+    bin_max = np.zeros(len(pCoverageIndex), dtype=np.int64)
+    has_elements = pCoverageIndex[:, 1] > pCoverageIndex[:, 0]
+    if np.any(has_elements):
+        # the segments of the bins are given as alternating start and end positions,
+        # every second result of reduceat is the maximum of one bin
+        segments = pCoverageIndex[has_elements].reshape(-1)
+        bin_max[has_elements] = np.maximum.reduceat(pCoverage, segments)[::2]
+    return [np.nan if max_element == 0 else max_element for max_element in bin_max.tolist()]
+
+
+def iterate_primary_alignments(pBamFile):
+    """
+    Yields one alignment per read of a bam file. 'Not primary' alignments are skipped and
+    for reads with supplementary alignments the correct mapping is chosen with 'get_correct_map'.
+    """
+    while True:
+        try:
+            read = next(pBamFile)
+            # skip 'not primary' alignments
+            while read.flag & 256 == 256:
+                read = next(pBamFile)
+            # check for supplementary alignments
+            # (needs to be done before skipping any unmapped reads
+            # to keep the order of the two bam files in sync)
+            supplementary_list = get_supplementary_alignment(read, pBamFile)
+        except StopIteration:
+            return
+        if supplementary_list:
+            read = get_correct_map(read, supplementary_list)
+        yield read
+
+
+def get_dangling_end(pRead, pRestrictionSequence, pDanglingSequences):
+    """
+    Returns the index of the first restriction sequence whose dangling sequence
+    is found at the 5' end of the read, -1 otherwise.
+    """
+    if pRestrictionSequence and pDanglingSequences:
+        for j, restrictionSequence in enumerate(pRestrictionSequence):
+            if check_dangling_end(pRead, pDanglingSequences[restrictionSequence]):
+                return j
+    return -1
+
+
+def read_bam_records_worker(pBamFileName, pQueueOut, pNumberOfItemsPerChunk, pRestrictionSequence,
+                            pDanglingSequences, pDecompressionThreads, pStartOffset=None, pNumberOfReads=None,
+                            pFirstReadIndex=0, pKeepAlignments=False):
+    """
+    Reader process for one of the two bam files. The file is decompressed with pDecompressionThreads
+    threads and converted to chunks of pNumberOfItemsPerChunk records of type BAM_RECORD_DTYPE, one record per read.
+    The chunks are returned via the bounded queue 'pQueueOut', a 'None' marks the end of the file.
+    Before the 'None' a dict with the busy wall time, the cpu time and the idle time of the process,
+    i.e. the time waiting for space in the queue, is returned. In case of an error a 'Fail: ' message is returned.
+    For a shard the reading starts at the virtual file offset pStartOffset with the read pFirstReadIndex
+    and stops after pNumberOfReads reads.
+    If pKeepAlignments is set, each chunk is returned together with an object array of the alignments
+    of its reads in SAM format (None for unmapped reads), such that the accepted read pairs can be
+    written to the output bam file without decoding the bam file a second time.
+    """
+    start_wall_time = time.time()
+    idle_time = 0.0
+    try:
+        bam_file = pysam.AlignmentFile(pBamFileName, 'rb', threads=pDecompressionThreads)
+        if pStartOffset is not None:
+            bam_file.seek(pStartOffset)
+        records = []
+        alignments = []
+        reads = iterate_primary_alignments(bam_file)
+        read_index = pFirstReadIndex
+        while pNumberOfReads is None or read_index < pFirstReadIndex + pNumberOfReads:
+            # all alignments of the previous read are consumed, the offset
+            # is the one of the next read
+            offset = bam_file.tell()
+            read = next(reads, None)
+            if read is None:
+                break
+            if read.flag & 0x4 == 4:
+                # unmapped reads are not used, only the flag is needed
+                records.append((-1, -1, read.flag, 0, 0, 0, False, -1, read_index,
+                                zlib.crc32(read.query_name.encode()), offset))
+                if pKeepAlignments:
+                    alignments.append(None)
+            else:
+                records.append((read.reference_id, read.pos, read.flag, read.mapq, read.qlen, read.query_length,
+                                read.is_reverse, get_dangling_end(read, pRestrictionSequence, pDanglingSequences),
+                                read_index, zlib.crc32(read.query_name.encode()), offset))
+                if pKeepAlignments:
+                    alignments.append(read.to_string())
+            read_index += 1
+            if len(records) == pNumberOfItemsPerChunk:
+                chunk = get_records_chunk(records, alignments, pKeepAlignments)
+                records = []
+                alignments = []
+                put_start_time = time.time()
+                pQueueOut.put(chunk)
+                idle_time += time.time() - put_start_time
+        if len(records) > 0:
+            pQueueOut.put(get_records_chunk(records, alignments, pKeepAlignments))
+        bam_file.close()
+    except Exception as exp:
+        pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
+        return
+    pQueueOut.put({'wall time': time.time() - start_wall_time - idle_time,
+                   'cpu time': time.process_time(),
+                   'idle time': idle_time})
+    pQueueOut.put(None)
+
+
+def get_records_chunk(pRecords, pAlignments, pKeepAlignments):
+    """
+    Returns the chunk of a bam reader process: the records as array of type BAM_RECORD_DTYPE
+    and, if pKeepAlignments is set, the alignments of the reads as object array.
+    """
+    records = np.array(pRecords, dtype=BAM_RECORD_DTYPE)
+    if pKeepAlignments:
+        alignments = np.empty(len(pAlignments), dtype=object)
+        alignments[:] = pAlignments
+        return records, alignments
+    return records
+
+
+class BamPairReader(object):
+    """
+    Reads the two bam files of a paired end experiment in two separate processes.
+    Both processes decode their file in parallel to the main process and
+    return chunks of records of type BAM_RECORD_DTYPE. The reads of the two files are
+    paired by their order, the read names are compared via their crc32 checksum.
+
+    Parameters
+    ----------
+    pBamFileNames : list of the two bam file names
+    pNumberOfItemsPerChunk : int, number of reads per chunk of a reader process
+    pRestrictionSequence : List of String, the restriction sequences
+    pDanglingSequences : dict, dict of dangling sequences
+    pDecompressionThreads : int, number of threads for the BGZF decompression of each file
+    pStartOffsets : list of the two virtual file offsets to start reading a shard, None to read the whole files
+    pNumberOfReads : int, number of read pairs of the shard
+    pFirstReadIndex : int, index of the first read pair of the shard
+    pPerformanceMonitor : PerformanceMonitor, collects the time waiting for the reader processes and their statistics
+    pKeepAlignments : bool, keep the alignments of the reads in SAM format, see 'pop_alignments'
+    """
+
+    def __init__(self, pBamFileNames, pNumberOfItemsPerChunk, pRestrictionSequence, pDanglingSequences,
+                 pDecompressionThreads=1, pStartOffsets=None, pNumberOfReads=None, pFirstReadIndex=0,
+                 pPerformanceMonitor=None, pKeepAlignments=False):
+        self.performance_monitor = PerformanceMonitor() if pPerformanceMonitor is None else pPerformanceMonitor
+        self.queues = []
+        self.processes = []
+        for i, bam_file_name in enumerate(pBamFileNames):
+            queue = Queue(maxsize=4)
+            process = Process(target=read_bam_records_worker, kwargs=dict(
+                pBamFileName=bam_file_name,
+                pQueueOut=queue,
+                pNumberOfItemsPerChunk=pNumberOfItemsPerChunk,
+                pRestrictionSequence=pRestrictionSequence,
+                pDanglingSequences=pDanglingSequences,
+                pDecompressionThreads=pDecompressionThreads,
+                pStartOffset=None if pStartOffsets is None else pStartOffsets[i],
+                pNumberOfReads=pNumberOfReads,
+                pFirstReadIndex=pFirstReadIndex,
+                pKeepAlignments=pKeepAlignments
+            ), daemon=True)
+            process.start()
+            self.queues.append(queue)
+            self.processes.append(process)
+        self.records = [np.empty(0, dtype=BAM_RECORD_DTYPE), np.empty(0, dtype=BAM_RECORD_DTYPE)]
+        self.all_data_read = False
+        self.keep_alignments = pKeepAlignments
+        # the alignments of each file as list of (index of the first read, object array of the alignments)
+        self.alignments = [[], []]
+
+    def _next_chunk(self, pIndex):
+        self.performance_monitor.sample_queue('bam readers', self.queues[pIndex])
+        with self.performance_monitor.stage('reading'):
+            chunk = self.queues[pIndex].get()
+        if isinstance(chunk, dict):
+            # the statistics of the reader process are sent before the end of the file
+            self.performance_monitor.add_process_times('bam readers', chunk['wall time'], chunk['cpu time'], chunk['idle time'])
+            with self.performance_monitor.stage('reading'):
+                chunk = self.queues[pIndex].get()
+        if isinstance(chunk, str):
+            self.close()
+            log.error(chunk[6:])
+            exit(1)
+        if isinstance(chunk, tuple):
+            chunk, alignments = chunk
+            if len(chunk) > 0:
+                self.alignments[pIndex].append((chunk['read_index'][0], alignments))
+        return chunk
+
+    def pop_alignments(self, pReadIndices):
+        """
+        Returns the alignments in SAM format of the read pairs with the given ascending indices
+        as two object arrays, one per bam file. The alignments of reads with smaller indices are
+        released, i.e. the read pairs need to be requested in the order of the bam files.
+        """
+        alignments = []
+        for file_alignments in self.alignments:
+            first_read_indices = np.array([first_read_index for first_read_index, _ in file_alignments], dtype=np.int64)
+            chunk_ids = np.searchsorted(first_read_indices, pReadIndices, side='right') - 1
+            selected = np.empty(len(pReadIndices), dtype=object)
+            for chunk_id in np.unique(chunk_ids):
+                in_chunk = chunk_ids == chunk_id
+                first_read_index, chunk_alignments = file_alignments[chunk_id]
+                selected[in_chunk] = chunk_alignments[pReadIndices[in_chunk] - first_read_index]
+            alignments.append(selected)
+            if len(pReadIndices) > 0:
+                # the chunks before the one of the last requested read are not needed anymore
+                del file_alignments[:chunk_ids[-1]]
+        return alignments[0], alignments[1]
+
+    def peek(self, pNumberOfItems):
+        """
+        Returns the records of the next read pairs without consuming them. At least
+        pNumberOfItems read pairs are returned as long as the files contain enough reads.
+        """
+        while not self.all_data_read and len(self.records[0]) < pNumberOfItems:
+            chunk1 = self._next_chunk(0)
+            chunk2 = self._next_chunk(1)
+            if chunk1 is None or chunk2 is None:
+                # the shorter file defines the end of the data
+                self.all_data_read = True
+                self.close()
+                continue
+            number_of_pairs = min(len(chunk1), len(chunk2))
+            if len(chunk1) != len(chunk2):
+                self.all_data_read = True
+                self.close()
+            mismatch = np.flatnonzero(chunk1['name_hash'][:number_of_pairs] != chunk2['name_hash'][:number_of_pairs])
+            if len(mismatch) > 0:
+                self.close()
+                log.error("FATAL ERROR the names of read number {} differ. "
+                          "Be sure that the sam files have the same read order "
+                          "If using Bowtie2 or Hisat2 add "
+                          "the --reorder option".format(chunk1['read_index'][mismatch[0]] + 1))
+                exit(1)
+            self.records[0] = np.concatenate([self.records[0], chunk1[:number_of_pairs]])
+            self.records[1] = np.concatenate([self.records[1], chunk2[:number_of_pairs]])
+        return self.records[0], self.records[1]
+
+    def consume(self, pNumberOfItems):
+        """
+        Removes the first pNumberOfItems read pairs.
+        """
+        self.records[0] = self.records[0][pNumberOfItems:]
+        self.records[1] = self.records[1][pNumberOfItems:]
+
+    def is_empty(self):
+        return self.all_data_read and len(self.records[0]) == 0
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes = []
+
+
+def classify_read_pairs(pRecords1, pRecords2, pMinMappingQuality):
+    """
+    Returns the boolean masks of the read pairs with an unmapped mate, with a not unique
+    mate and with a mate of low mapping quality. The remaining pairs are the candidates
+    for the duplication check.
+
+    >>> records = np.zeros(4, dtype=BAM_RECORD_DTYPE)
+    >>> records['flag'] = [0, 4, 0, 0]
+    >>> records['mapq'] = [30, 30, 0, 5]
+    >>> [mask.tolist() for mask in classify_read_pairs(records, records, 10)]
+    [[False, True, False, False], [False, False, True, False], [False, False, False, True]]
+    """
+    is_unmapped = (pRecords1['flag'] & 0x4 == 4) | (pRecords2['flag'] & 0x4 == 4)
+    is_low_quality = ~is_unmapped & ((pRecords1['mapq'] < pMinMappingQuality) | (pRecords2['mapq'] < pMinMappingQuality))
+    # for bwa other way to test
+    # for multi-mapping reads is with a mapq = 0
+    # the XS flag is not reliable.
+    # As in 'mate1.mapq == 0 & mate2.mapq == 0' only the mapq of the first mate is tested.
+    is_not_unique = is_low_quality & (pRecords1['mapq'] == 0)
+    return is_unmapped, is_not_unique, is_low_quality & ~is_not_unique
+
+
+def readBamFiles(pBamPairReader, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pMinMappingQuality,
+                 pDuplicatedReadIndices=None):
     """Read the two bam input files into n buffers each with pNumberOfItemsPerBuffer
-        with n = number of processes. The duplication check is handled here too."""
+        with n = number of processes. The duplication check is handled here too.
+        The records are read from pBamPairReader and filtered for a whole chunk at once.
+        Not more read pairs are consumed than needed to fill the buffer, such that
+        the buffer is filled with the same pairs as if they were read one by one.
+        If pDuplicatedReadIndices is given, the pairs with these sorted indices are
+        the duplicates, e.g. as computed by hicCreateShardPlan, and pReadPosMatrix is not used.
+
+    Returns the buffers of both mates as numpy record arrays of type BAM_RECORD_DTYPE
+    together with the counters of the removed pairs.
+
+    >>> test = Tester()
+    >>> reader = BamPairReader([test.root + 'R1_1000.bam', test.root + 'R2_1000.bam'], 300, None, None)
+    >>> read_pos_matrix = ReadPositionMatrix()
+    >>> buffer_mate1, buffer_mate2, all_data_read, duplicated_pairs, one_mate_unmapped, \\
+    ...     one_mate_not_unique, one_mate_low_quality, iter_num = readBamFiles(reader, 100, False, read_pos_matrix, 15)
+    >>> len(buffer_mate1), all_data_read, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality
+    (100, False, 197, 1, 65)
+    >>> readBamFiles(reader, 1000, False, read_pos_matrix, 15)[2:]
+    (True, 0, 309, 12, 99, 420)
+    """
     buffer_mate1 = []
     buffer_mate2 = []
     duplicated_pairs = 0
@@ -690,106 +1813,248 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
     one_mate_not_unique = 0
     one_mate_low_quality = 0
 
-    all_data_read = False
     j = 0
     iter_num = 0
-    while j < pNumberOfItemsPerBuffer:
-        try:
-            mate1 = next(pFileOneIterator)
-            mate2 = next(pFileTwoIterator)
-        except StopIteration:
-            all_data_read = True
-            break
-        iter_num += 1
-
-        # skip 'not primary' alignments
-        while mate1.flag & 256 == 256:
-            try:
-                mate1 = next(pFileOneIterator)
-            except StopIteration:
-                all_data_read = True
+    while j < pNumberOfItemsPerBuffer and not pBamPairReader.is_empty():
+        records1, records2 = pBamPairReader.peek(pNumberOfItemsPerBuffer - j)
+
+        is_unmapped, is_not_unique, is_low_quality = classify_read_pairs(records1, records2, pMinMappingQuality)
+        is_candidate = ~is_unmapped & ~is_not_unique & ~is_low_quality
+
+        # consume the read pairs up to the candidate that fills the buffer
+        number_of_items = len(records1)
+        candidate_count = np.cumsum(is_candidate)
+        if len(candidate_count) > 0 and candidate_count[-1] > pNumberOfItemsPerBuffer - j:
+            number_of_items = int(np.searchsorted(candidate_count, pNumberOfItemsPerBuffer - j)) + 1
+        pBamPairReader.consume(number_of_items)
+        iter_num += number_of_items
+        records1 = records1[:number_of_items]
+        records2 = records2[:number_of_items]
+        one_mate_unmapped += int(np.sum(is_unmapped[:number_of_items]))
+        one_mate_not_unique += int(np.sum(is_not_unique[:number_of_items]))
+        one_mate_low_quality += int(np.sum(is_low_quality[:number_of_items]))
+
+        is_candidate = is_candidate[:number_of_items]
+        candidate_mate1 = records1[is_candidate]
+        candidate_mate2 = records2[is_candidate]
+        if pSkipDuplicationCheck is False and pDuplicatedReadIndices is not None:
+            duplicated = np.isin(candidate_mate1['read_index'], pDuplicatedReadIndices)
+            duplicated_pairs += int(np.sum(duplicated))
+            candidate_mate1 = candidate_mate1[~duplicated]
+            candidate_mate2 = candidate_mate2[~duplicated]
+        elif pSkipDuplicationCheck is False and len(candidate_mate1) > 0:
+            with pBamPairReader.performance_monitor.stage('duplication check'):
+                duplicated = pReadPosMatrix.are_duplicated(candidate_mate1['reference_id'], candidate_mate1['pos'],
+                                                           candidate_mate2['reference_id'], candidate_mate2['pos'],
+                                                           candidate_mate1['is_reverse'], candidate_mate2['is_reverse'])
+            duplicated_pairs += int(np.sum(duplicated))
+            candidate_mate1 = candidate_mate1[~duplicated]
+            candidate_mate2 = candidate_mate2[~duplicated]
+        buffer_mate1.append(candidate_mate1)
+        buffer_mate2.append(candidate_mate2)
+        j += len(candidate_mate1)
+
+    all_data_read = pBamPairReader.is_empty()
+    if j == 0:
+        return None, None, all_data_read, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num
+    return np.concatenate(buffer_mate1), np.concatenate(buffer_mate2), all_data_read, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - j
+
+
+def write_bam_pairs(pAlignments1, pAlignments2, pOutBamFile):
+    """
+    Writes the read pairs given by the alignments in SAM format of both mates to pOutBamFile.
+    """
+    for alignment1, alignment2 in zip(pAlignments1, pAlignments2):
+        mate1 = pysam.AlignedSegment.fromstring(alignment1, pOutBamFile.header)
+        mate2 = pysam.AlignedSegment.fromstring(alignment2, pOutBamFile.header)
+
+        mate1.flag |= 0x1
+        mate2.flag |= 0x1
+
+        # set one read as the first in pair and the
+        # other as second
+        mate1.flag |= 0x40
+        mate2.flag |= 0x80
+
+        # set chrom of mate
+        mate1.mrnm = mate2.rname
+        mate2.mrnm = mate1.rname
+
+        # set position of mate
+        mate1.mpos = mate2.pos
+        mate2.mpos = mate1.pos
+
+        pOutBamFile.write(mate1)
+        pOutBamFile.write(mate2)
+
+
+def write_bam_worker(pTemplateBamFileName, pOutBamFileName, pQueueIn, pQueueOut, pCompressionThreads):
+    """
+    Writer process for the output bam file. The accepted read pairs are received via 'pQueueIn'
+    as two object arrays with the alignments in SAM format of both mates, as kept by the bam reader
+    processes, and written to pOutBamFile. The input bam files are not read again, only the header
+    of pTemplateBamFileName is used. A 'None' closes the output file.
+    A dict with the busy wall time, the cpu time and the idle time of the process, i.e. the time
+    waiting for read pairs, or a 'Fail: ' message is returned via 'pQueueOut'.
+
+    Parameters
+    ----------
+    pTemplateBamFileName : String, name of the input bam file whose header is used
+    pOutBamFileName : String, name of the output bam file
+    pQueueIn : multiprocessing.Queue, receives tuples of the alignments of both mates
+    pQueueOut : multiprocessing.Queue, returns the status of the writer
+    pCompressionThreads : int, number of threads for the BGZF compression of the output file
+    """
+    start_wall_time = time.time()
+    idle_time = 0.0
+    try:
+        with pysam.AlignmentFile(pTemplateBamFileName, 'rb') as template_bam_file:
+            out_bam_file = pysam.AlignmentFile(pOutBamFileName, 'wb', template=template_bam_file,
+                                               threads=pCompressionThreads)
+        while True:
+            get_start_time = time.time()
+            alignments = pQueueIn.get()
+            idle_time += time.time() - get_start_time
+            if alignments is None:
                 break
-        while mate2.flag & 256 == 256:
-            try:
-                mate2 = next(pFileTwoIterator)
-            except StopIteration:
-                all_data_read = True
+            write_bam_pairs(alignments[0], alignments[1], out_bam_file)
+        out_bam_file.close()
+    except Exception as exp:
+        pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
+        return
+    pQueueOut.put({'wall time': time.time() - start_wall_time - idle_time,
+                   'cpu time': time.process_time(),
+                   'idle time': idle_time})
+
+
+def read_pairs_header(pPairsFile):
+    """
+    Reads the header of a pairs file in the 4DN format.
+
+    Returns the column names, the list of (chromosome name, size) tuples of the '#chromsize:' lines
+    and the number of header lines.
+
+    >>> import tempfile, os
+    >>> _file = tempfile.NamedTemporaryFile(suffix='.pairs', delete=False, mode='w')
+    >>> foo = _file.write('## pairs format v1.0\\n#chromsize: chr1 1000\\n#chromsize: chr2 500\\n')
+    >>> foo = _file.write('#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\\nr1\\tchr1\\t10\\tchr2\\t20\\t+\\t-\\n')
+    >>> _file.close()
+    >>> read_pairs_header(_file.name)
+    (['readID', 'chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2'], [('chr1', 1000), ('chr2', 500)], 4)
+    >>> os.remove(_file.name)
+    """
+    columns = ['readID', 'chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2']
+    chrom_sizes = OrderedDict()
+    number_of_header_lines = 0
+    open_function = gzip.open if pPairsFile.endswith('.gz') else open
+    with open_function(pPairsFile, 'rt') as pairs_file:
+        for line in pairs_file:
+            if not line.startswith('#'):
                 break
+            number_of_header_lines += 1
+            if line.startswith('#chromsize:'):
+                fields = line.split()
+                chrom_sizes[fields[1]] = int(fields[2])
+            elif line.startswith('#columns:'):
+                columns = line.split()[1:]
+                # older versions of the format use chr1 / chr2
+                columns = [{'chr1': 'chrom1', 'chr2': 'chrom2'}.get(column, column) for column in columns]
+    return columns, list(chrom_sizes.items()), number_of_header_lines
+
+
+def get_pairs_chunk_iterator(pPairsFile, pColumns, pNumberOfHeaderLines, pNumberOfItemsPerBuffer):
+    """
+    Returns an iterator over data frames with pNumberOfItemsPerBuffer pairs each.
+    Only the columns needed to build the matrix are parsed.
+    """
+    use_columns = ['chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2']
+    if 'mapq1' in pColumns and 'mapq2' in pColumns:
+        use_columns.extend(['mapq1', 'mapq2'])
+    return pd.read_csv(pPairsFile, sep='\t', header=None, names=pColumns, usecols=use_columns,
+                       skiprows=pNumberOfHeaderLines, chunksize=pNumberOfItemsPerBuffer,
+                       dtype={'chrom1': str, 'chrom2': str, 'strand1': str, 'strand2': str},
+                       compression='infer')
+
+
+def readPairsFile(pPairsChunkIterator, pSkipDuplicationCheck, pReadPosMatrix, pChromName2RefId, pMinMappingQuality):
+    """
+    Reads the next chunk of a pairs file and applies the same filters as 'readBamFiles'.
+    Chromosomes that are not in pChromName2RefId get a new reference id,
+    they are not part of the matrix bins.
 
-        assert mate1.qname == mate2.qname, "FATAL ERROR {} {} " \
-            "Be sure that the sam files have the same read order " \
-            "If using Bowtie2 or Hisat2 add " \
-            "the --reorder option".format(mate1.qname, mate2.qname)
+    Returns the mate records of both sides of type MATE_RECORD_DTYPE together
+    with the same counters as 'readBamFiles'.
+    """
+    try:
+        pairs = next(pPairsChunkIterator)
+    except StopIteration:
+        return None, None, True, 0, 0, 0, 0, 0
+    number_of_pairs = len(pairs)
 
-        # check for supplementary alignments
-        # (needs to be done before skipping any unmapped reads
-        # to keep the order of the two bam files in sync)
-        mate1_supplementary_list = get_supplementary_alignment(
-            mate1, pFileOneIterator)
-        mate2_supplementary_list = get_supplementary_alignment(
-            mate2, pFileTwoIterator)
+    for chrom in pd.unique(pairs[['chrom1', 'chrom2']].values.ravel()):
+        if chrom not in pChromName2RefId:
+            pChromName2RefId[chrom] = len(pChromName2RefId)
 
-        if mate1_supplementary_list:
-            mate1 = get_correct_map(mate1, mate1_supplementary_list)
+    # pairtools marks unmapped sides with chromosome '!' and position 0
+    is_unmapped = (pairs['chrom1'].values == '!') | (pairs['chrom2'].values == '!') | \
+        (pairs['pos1'].values == 0) | (pairs['pos2'].values == 0)
+    one_mate_unmapped = int(np.sum(is_unmapped))
+    keep = ~is_unmapped
 
-        if mate2_supplementary_list:
-            mate2 = get_correct_map(mate2, mate2_supplementary_list)
+    one_mate_not_unique = 0
+    one_mate_low_quality = 0
+    if 'mapq1' in pairs.columns:
+        mapq1 = pairs['mapq1'].values
+        mapq2 = pairs['mapq2'].values
+        is_low_quality = keep & ((mapq1 < pMinMappingQuality) | (mapq2 < pMinMappingQuality))
+        # same classification as for bam files, where
+        # 'mate1.mapq == 0 & mate2.mapq == 0' is true if mate1.mapq is 0
+        is_not_unique = is_low_quality & (mapq1 == 0)
+        one_mate_not_unique = int(np.sum(is_not_unique))
+        one_mate_low_quality = int(np.sum(is_low_quality & ~is_not_unique))
+        keep &= ~is_low_quality
+
+    pairs = pairs[keep]
+    mate_records1 = np.empty(len(pairs), dtype=MATE_RECORD_DTYPE)
+    mate_records2 = np.empty(len(pairs), dtype=MATE_RECORD_DTYPE)
+    for mate_records, side in [(mate_records1, '1'), (mate_records2, '2')]:
+        mate_records['reference_id'] = pairs['chrom' + side].map(pChromName2RefId).values
+        # pairs files are 1-based
+        mate_records['pos'] = pairs['pos' + side].values - 1
+        mate_records['qlen'] = 0
+        mate_records['query_length'] = 0
+        mate_records['is_reverse'] = pairs['strand' + side].values == '-'
+        mate_records['dangling_end'] = -1
 
-        # skip if any of the reads is not mapped
-        if mate1.flag & 0x4 == 4 or mate2.flag & 0x4 == 4:
-            one_mate_unmapped += 1
-            continue
+    duplicated_pairs = 0
+    if pSkipDuplicationCheck is False and len(pairs) > 0:
+        duplicated = pReadPosMatrix.are_duplicated(mate_records1['reference_id'], mate_records1['pos'],
+                                                   mate_records2['reference_id'], mate_records2['pos'],
+                                                   mate_records1['is_reverse'], mate_records2['is_reverse'])
+        duplicated_pairs = int(np.sum(duplicated))
+        mate_records1 = mate_records1[~duplicated]
+        mate_records2 = mate_records2[~duplicated]
 
-        # skip if the read quality is low
-        if mate1.mapq < pMinMappingQuality or mate2.mapq < pMinMappingQuality:
-            # for bwa other way to test
-            # for multi-mapping reads is with a mapq = 0
-            # the XS flag is not reliable.
-            if mate1.mapq == 0 & mate2.mapq == 0:
-                one_mate_not_unique += 1
-                continue
+    if len(mate_records1) == 0:
+        return None, None, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, number_of_pairs
+    return mate_records1, mate_records2, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, number_of_pairs - len(mate_records1)
 
-            """
-            # check if low quality is because of
-            # read being repetitive
-            # by reading the XS flag.
-            # The XS:i field is set by bowtie when a read is
-            # multi read and it contains the mapping score of the next
-            # best match
-            if 'XS' in dict(mate1.tags) or 'XS' in dict(mate2.tags):
-                one_mate_not_unique += 1
-                continue
-            """
 
-            one_mate_low_quality += 1
-            continue
+def get_mate_records(pBamRecords):
+    """
+    Converts records of type BAM_RECORD_DTYPE to the compact records of type MATE_RECORD_DTYPE
+    that are send to the worker processes.
+    """
+    mate_records = np.empty(len(pBamRecords), dtype=MATE_RECORD_DTYPE)
+    for field in MATE_RECORD_DTYPE.names:
+        mate_records[field] = pBamRecords[field]
+    return mate_records
 
-        if pSkipDuplicationCheck is False:
-            if pReadPosMatrix.is_duplicated(pRefId2name[mate1.rname],
-                                            mate1.pos,
-                                            pRefId2name[mate2.rname],
-                                            mate2.pos):
-                duplicated_pairs += 1
-                continue
-        buffer_mate1.append(mate1)
-        buffer_mate2.append(mate2)
-        j += 1
-
-    if all_data_read and len(buffer_mate1) != 0 and len(buffer_mate2) != 0:
-        return buffer_mate1, buffer_mate2, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-    if all_data_read and len(buffer_mate1) == 0 or len(buffer_mate2) == 0:
-        return None, None, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-    return buffer_mate1, buffer_mate2, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-
-
-def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
-                 pKeepSelfCircles, pRestrictionSequence, pKeepSelfLigation, pMatrixSize,
-                 pRfPositions, pRefId2name,
-                 pDanglingSequences, pBinsize, pResultIndex,
-                 pQueueOut, pTemplate, pOutputBamSet, pCounter,
-                 pSharedBinIntvalTree, pDictBinIntervalTreeIndex, pCoverage, pCoverageIndex,
-                 pOutputFileBufferDir, pRow, pCol, pData,
-                 pMaxInsertSize, pQuickQCMode):
+
+def process_data(pMateBuffer1, pMateBuffer2, pKeepSelfCircles, pRestrictionSequence,
+                 pKeepSelfLigation, pRfPositions, pRefId2name, pBinsize,
+                 pBinIntervalIndex, pCoverageIndex,
+                 pMaxInsertSize, pQuickQCMode, pOutputBamSet):
     """
     This function computes for a given number of elements in pMateBuffer1 and pMaterBuffer2 a partial interaction matrix.
     This function is used by multiple processes to speed up the computation.
@@ -797,301 +2062,407 @@ def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
 
     Parameters
     ----------
-    pMateBuffer1 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 1
-    pMateBuffer2 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 2
-    pMinMappingQuality : integer, minimum mapping quality of a read
+    pMateBuffer1 : numpy record array of type MATE_RECORD_DTYPE, mates of sam input file 1
+    pMateBuffer2 : numpy record array of type MATE_RECORD_DTYPE, mates of sam input file 2
     pKeepSelfCircles : boolean, if self circles should be kept
     pRestrictionSequence : List of String, the restriction sequence
     pKeepSelfLigation : If self ligations should be removed
-    pMatrixSize : integer, the size of the interaction matrix
-    pRfPositions : intervalTree, only used if a restriction cut file and not a bin size was defined.
+    pRfPositions : RestrictionSiteIndex, the restriction sites of the restriction cut files.
     pRefId2name : Tuple, Maps a reference id to a name
-    pDanglingSequences : dict, dict of dangling sequences
     pBinsize : integer, the size of the bins
-    pResultIndex : integer, number of processs, range(0, threads). Is returned via the queue to have access to the right row, col and data array after the computation.
-    pQueueOut : multiprocessing.Queue, queue to return the computed counting variables:
-            one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-            mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
-            pair_added, len(pMateBuffer1), pResultIndex, pCounter
-    pTemplate : The template for the output bam file
-    pOutputBamSet : If a output bam file should be written. Depending on the input parameter '--outBam'
-    pOutputName : String, Name of the partial bam file
-    pCounter : integer, value which is returned to the main process. The main process can than write a pCounter.bam_done file
-                to signal the background process, which is merging the partial bam files into one, that this dataset can be merged.
-    pSharedBinIntvalTree : multiprocessing.sharedctype.RawArray of C_Interval, stores the interval tree in a 1D-RawArray.
-    pDictBinIntervalTreeIndex : dict, stores the information at which index position a given interval starts and ends in the 1D-array 'pSharedBinIntvalTree'
-    pCoverage : multiprocessing.sharedctype.Array of c_uint, Stores the coverage in a 1D-Array
-    pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores the information in the 1D-array 'pCoverage'
-    pOutputFileBufferDir : String, the directory where the partial output bam files are buffered. Default is '/dev/shm/'
-    pRow : multiprocessing.sharedctype.RawArray of c_uint, Stores the row index information. It is available for all processes and does not need to be copied.
-    pCol : multiprocessing.sharedctype.RawArray of c_uint, stores the column index information. It is available for all processes and does not need to be copied.
-    pData : multiprocessing.sharedctype.RawArray of c_ushort, stores a 1 for each row - column pair. It is available for all processes and does not need to be copied.
+    pBinIntervalIndex : BinIntervalIndex, assigns the mates to the bins of the matrix
+    pCoverageIndex : numpy array of shape (number of bins, 2), first and last coverage element of each bin
     pMaxInsertSize : maximum illumina insert size
+    pQuickQCMode : boolean, if set no row and column indices are returned
+    pOutputBamSet : If a output bam file should be written. Depending on the input parameter '--outBam'
+
+    Returns
+    -------
+    List with the counting variables:
+        one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
+        mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
+        pair_added, len(pMateBuffer1), out_bam_index_buffer
+    numpy array of the row indices of the added pairs
+    numpy array of the column indices of the added pairs
+    tuple of numpy arrays, the changed positions and the changes of the coverage difference array
     """
-    try:
+    one_mate_unmapped = 0
+    one_mate_low_quality = 0
+    one_mate_not_unique = 0
+    dangling_end = {}
+    if pRestrictionSequence is not None:
+        for restrictionSequence in pRestrictionSequence:
+            dangling_end[restrictionSequence] = 0
+
+    number_of_pairs = min(len(pMateBuffer1), len(pMateBuffer2))
+    mate1 = pMateBuffer1[:number_of_pairs]
+    mate2 = pMateBuffer2[:number_of_pairs]
+    reference_id = mate1['reference_id']
+    pos1 = mate1['pos']
+    pos2 = mate2['pos']
+
+    # check if reads belong to a bin. The middle genomic position of
+    # a read is used to find the bin it belongs to.
+    # All mates of the buffer are assigned at once, -1 marks mates without a bin.
+    mate_bin_ids1, _ = pBinIntervalIndex.get_bins(reference_id, pos1 + mate1['qlen'] // 2)
+    mate_bin_ids2, mate_bin_begins2 = pBinIntervalIndex.get_bins(mate2['reference_id'], pos2 + mate2['qlen'] // 2)
+
+    # if a mate is unassigned, it means it is not close
+    # to a restriction site
+    keep = (mate_bin_ids1 >= 0) & (mate_bin_ids2 >= 0)
+    mate_not_close_to_rf = int(np.sum(~keep))
+
+    same_chromosome = reference_id == mate2['reference_id']
+    distance = np.abs(pos2 - pos1)
+
+    # to identify 'inward' and 'outward' orientations
+    # the order or the mates in the genome has to be
+    # known.
+    """
+    outward
+    <---------------              ---------------->
+
+    inward
+    --------------->              <----------------
+
+    same-strand-right
+    --------------->              ---------------->
+
+    same-strand-left
+    <---------------              <----------------
+    """
+    mate1_is_first = pos1 < pos2
+    first_is_reverse = np.where(mate1_is_first, mate1['is_reverse'], mate2['is_reverse'])
+    second_is_reverse = np.where(mate1_is_first, mate2['is_reverse'], mate1['is_reverse'])
+    inward = same_chromosome & ~first_is_reverse & second_is_reverse
+    outward = same_chromosome & first_is_reverse & ~second_is_reverse
+    same_strand_left = same_chromosome & first_is_reverse & second_is_reverse
+    same_strand_right = same_chromosome & ~first_is_reverse & ~second_is_reverse
+
+    # the fragment between the two mates. For each restriction sequence its
+    # length is subtracted on both sides such that only fragments internally
+    # containing the restriction site are identified
+    fragment_start = np.minimum(pos1, pos2)
+    fragment_end = np.maximum(pos1 + mate1['qlen'], pos2 + mate2['qlen'])
+    check_restriction_sites = bool(pRfPositions) and bool(pRestrictionSequence)
+
+    def has_restriction_site(pSelection):
+        # for each restriction sequence, True if a site was found for this or any previous sequence
+        has_rf = np.zeros((len(pRestrictionSequence), np.sum(pSelection)), dtype=np.bool_)
+        found = np.zeros(np.sum(pSelection), dtype=np.bool_)
+        for i, restrictionSequence in enumerate(pRestrictionSequence):
+            found |= pRfPositions.has_site(reference_id[pSelection],
+                                           fragment_start[pSelection] + len(restrictionSequence),
+                                           fragment_end[pSelection] - len(restrictionSequence))
+            has_rf[i] = found
+        return has_rf
+
+    # check self-circles
+    # self circles are defined as outward pairs that do not
+    # have a restriction sequence in between. The distance of < 25kb is
+    # used to only check close outward pairs as far apart pairs can not be self-circles.
+    # A pair is counted once for each restriction sequence up to the first
+    # one with a site in between the mates, self circles are not removed.
+    self_circle = 0
+    if check_restriction_sites:
+        self_circle_candidate = keep & outward & (distance < 25000)
+        self_circle = int(np.sum(~has_restriction_site(self_circle_candidate)))
+
+    # check for dangling ends if the restriction sequence is known and if they look
+    # like 'same fragment'
+    close_inward = keep & inward & (distance < pMaxInsertSize)
+    if pRestrictionSequence:
+        # the dangling end check was done for each read when the mate records
+        # were created. The first restriction sequence matching any of the mates is counted.
+        no_match = len(pRestrictionSequence)
+        dangling_end1 = np.where(mate1['dangling_end'] < 0, no_match, mate1['dangling_end'])
+        dangling_end2 = np.where(mate2['dangling_end'] < 0, no_match, mate2['dangling_end'])
+        dangling_end_index = np.minimum(dangling_end1, dangling_end2)
+        is_dangling_end = close_inward & (dangling_end_index < no_match)
+        dangling_end_counts = np.bincount(dangling_end_index[is_dangling_end], minlength=no_match)
+        for i, restrictionSequence in enumerate(pRestrictionSequence):
+            dangling_end[restrictionSequence] += int(dangling_end_counts[i])
+        close_inward &= ~is_dangling_end
+        keep &= ~is_dangling_end
+
+    # case when there is no restriction fragment site between the
+    # mates
+    is_same_fragment = close_inward.copy()
+    if check_restriction_sites:
+        is_same_fragment[close_inward] = ~has_restriction_site(close_inward)[-1]
+    same_fragment = int(np.sum(is_same_fragment))
+    is_self_ligation = close_inward & ~is_same_fragment
+    self_ligation = int(np.sum(is_self_ligation))
+
+    keep &= ~is_same_fragment
+    if not pKeepSelfLigation:
+        # skip self ligations
+        keep &= ~is_self_ligation
+
+    # count type of pair (distance, orientation)
+    inter_chromosomal = int(np.sum(keep & ~same_chromosome))
+    short_range = int(np.sum(keep & same_chromosome & (distance < 20000)))
+    long_range = int(np.sum(keep & same_chromosome & (distance >= 20000)))
+
+    count_inward = int(np.sum(keep & inward))
+    count_outward = int(np.sum(keep & outward))
+    count_left = int(np.sum(keep & same_strand_left))
+    count_right = int(np.sum(keep & same_strand_right))
+
+    pair_added = int(np.sum(keep))
+    pair_index = np.flatnonzero(keep)
+
+    # fill in coverage vector. The coverage of both mates
+    # is counted relative to the bin of mate2. Each mate covers a range of
+    # coverage elements, the ranges are returned as start (+1) and end (-1)
+    # changes of a difference array that the main process adds up.
+    mate_bin_id = mate_bin_ids2[keep]
+    mate_bin_begin = mate_bin_begins2[keep]
+    coverage_begin = pCoverageIndex[mate_bin_id, 0]
+    length_coverage = pCoverageIndex[mate_bin_id, 1] - coverage_begin
+    coverage_start_list = []
+    coverage_end_list = []
+    for mate_pos, query_length in [(pos1[keep], mate1['query_length'][keep]),
+                                   (pos2[keep], mate2['query_length'][keep])]:
+        vec_start = np.maximum(0, mate_pos - mate_bin_begin) // pBinsize
+        vec_end = np.minimum(length_coverage, vec_start + query_length // pBinsize)
+        is_covered = vec_end > vec_start
+        coverage_start_list.append(coverage_begin[is_covered] + vec_start[is_covered])
+        coverage_end_list.append(coverage_begin[is_covered] + vec_end[is_covered])
+    coverage_start = np.concatenate(coverage_start_list)
+    coverage_end = np.concatenate(coverage_end_list)
+    coverage_index, inverse = np.unique(np.concatenate([coverage_start, coverage_end]), return_inverse=True)
+    coverage_change = np.bincount(inverse.reshape(-1), weights=np.concatenate([np.ones(len(coverage_start)), -np.ones(len(coverage_end))]),
+                                  minlength=len(coverage_index)).astype(np.int32)
+    is_changed = coverage_change != 0
+    coverage_index = coverage_index[is_changed]
+    coverage_change = coverage_change[is_changed]
+
+    if pQuickQCMode:
+        row = np.array([], dtype=np.uint32)
+        col = np.array([], dtype=np.uint32)
+    else:
+        row = mate_bin_ids1[keep].astype(np.uint32)
+        col = mate_bin_ids2[keep].astype(np.uint32)
+
+    out_bam_index_buffer = []
+    if pOutputBamSet:
+        out_bam_index_buffer = pair_index.tolist()
 
-        one_mate_unmapped = 0
-        one_mate_low_quality = 0
-        one_mate_not_unique = 0
-        dangling_end = {}
-        if pRestrictionSequence is not None:
-            for restrictionSequence in pRestrictionSequence:
-                dangling_end[restrictionSequence] = 0
-        self_circle = 0
-        self_ligation = 0
-        same_fragment = 0
-        mate_not_close_to_rf = 0
-
-        count_inward = 0
-        count_outward = 0
-        count_left = 0
-        count_right = 0
-        inter_chromosomal = 0
-        short_range = 0
-        long_range = 0
-
-        pair_added = 0
-
-        iter_num = 0
-        hic_matrix = None
-
-        out_bam_index_buffer = []
-
-        if pMateBuffer1 is None or pMateBuffer2 is None:
-
-            pQueueOut.put([hic_matrix, [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                                        mate_not_close_to_rf, count_inward, count_outward,
-                                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, iter_num, pResultIndex, out_bam_index_buffer]])
+    return [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
+            mate_not_close_to_rf, count_inward, count_outward,
+            count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1),
+            out_bam_index_buffer], row, col, (coverage_index, coverage_change)
+
+
+def process_data_worker(pQueueIn, pQueueOut, pProcessDataArgs):
+    """
+    Long-lived worker process. The read only data structures needed by 'process_data'
+    (interval trees, bin and coverage index, restriction sites) are given once
+    as 'pProcessDataArgs' when the process is started. Afterwards only the mate records are
+    received via the bounded queue 'pQueueIn'. The results are returned via 'pQueueOut' together with
+    the id of the processed batch. A 'None' in 'pQueueIn' stops the worker.
+
+    Parameters
+    ----------
+    pQueueIn : multiprocessing.Queue, receives tuples of (batch id, mate records 1, mate records 2)
+    pQueueOut : multiprocessing.Queue, returns [batch id, result of 'process_data', (wall time, cpu time, idle time)]
+                or a 'Fail: ' message. The idle time is the time waiting for the batch.
+    pProcessDataArgs : dict, keyword arguments for 'process_data' which are the same for all batches
+    """
+    while True:
+        get_start_time = time.time()
+        task = pQueueIn.get()
+        idle_time = time.time() - get_start_time
+        if task is None:
+            return
+        batch_id, mate_records1, mate_records2 = task
+        start_wall_time = time.time()
+        start_cpu_time = time.process_time()
+        try:
+            result = process_data(mate_records1, mate_records2, **pProcessDataArgs)
+        except Exception as exp:
+            pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
             return
+        pQueueOut.put([batch_id, result, (time.time() - start_wall_time, time.process_time() - start_cpu_time, idle_time)])
 
-        while iter_num < len(pMateBuffer1) and iter_num < len(pMateBuffer2):
-            mate1 = pMateBuffer1[iter_num]
-            mate2 = pMateBuffer2[iter_num]
-            iter_num += 1
-
-            # check if reads belong to a bin
-            #
-            # pDictBinInterval stores the start and end position for each chromsome in the array 'pSharedBinIntvalTree'
-            # To get to the right interval a binary search is used.
-            mate_bins = []
-            mate_is_unasigned = False
-            for mate in [mate1, mate2]:
-                mate_ref = pRefId2name[mate.rname]
-                # find the middle genomic position of the read. This is used to
-                # find the bin it belongs to.
-                read_middle = mate.pos + int(mate.qlen / 2)
-                try:
-                    start, end = pDictBinIntervalTreeIndex[mate_ref]
-                    middle_pos = int((start + end) / 2)
-                    mate_bin = None
-                    while not start > end:
-                        if pSharedBinIntvalTree[middle_pos].begin <= read_middle and read_middle <= pSharedBinIntvalTree[middle_pos].end:
-                            mate_bin = pSharedBinIntvalTree[middle_pos]
-                            mate_is_unasigned = False
-                            break
-                        elif pSharedBinIntvalTree[middle_pos].begin > read_middle:
-                            end = middle_pos - 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-                        else:
-                            start = middle_pos + 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-
-                except KeyError:
-                    # for small contigs it can happen that they are not
-                    # in the bin_intval_tree keys if no restriction site is found
-                    # on the contig.
-                    mate_is_unasigned = True
-                    break
-
-                # report no match case
-                if mate_bin is None:
-                    mate_is_unasigned = True
-                    break
-                mate_bin_id = mate_bin.data
-                mate_bins.append(mate_bin_id)
-
-            # if a mate is unassigned, it means it is not close
-            # to a restriction site
-            if mate_is_unasigned is True:
-                mate_not_close_to_rf += 1
-                continue
 
-            # check if mates are in the same chromosome
-            if mate1.reference_id != mate2.reference_id:
-                orientation = 'diff_chromosome'
-            else:
-                # to identify 'inward' and 'outward' orientations
-                # the order or the mates in the genome has to be
-                # known.
-                if mate1.pos < mate2.pos:
-                    first_mate = mate1
-                    second_mate = mate2
-                else:
-                    first_mate = mate2
-                    second_mate = mate1
-
-                """
-                outward
-                <---------------              ---------------->
-
-                inward
-                --------------->              <----------------
-
-                same-strand-right
-                --------------->              ---------------->
-
-                same-strand-left
-                <---------------              <----------------
-                """
-
-                if not first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'inward'
-                elif first_mate.is_reverse and not second_mate.is_reverse:
-                    orientation = 'outward'
-                elif first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'same-strand-left'
-                else:
-                    orientation = 'same-strand-right'
-
-                # check self-circles
-                # self circles are defined as outward pairs that do not
-                # have a restriction sequence in between. The distance of < 25kb is
-                # used to only check close outward pairs as far apart pairs can not be self-circles
-                if abs(mate2.pos - mate1.pos) < 25000 and orientation == 'outward':
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-                        # check for multiple restriction sequences
-                        for restrictionSequence in pRestrictionSequence:
-                            # the interval used is:
-                            # start of fragment + length of restriction sequence
-                            # end of fragment - length of restriction sequence
-                            # the restriction sequence length is subtracted
-                            # such that only fragments internally containing
-                            # the restriction site are identified
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                            if len(has_rf) == 0:
-                                self_circle += 1
-                                if not pKeepSelfCircles:
-                                    continue
-                if abs(mate2.pos - mate1.pos) < pMaxInsertSize and orientation == 'inward':
-                    # check for dangling ends if the restriction sequence is known and if they look
-                    # like 'same fragment'
-                    if pRestrictionSequence:
-                        if pDanglingSequences:
-
-                            # check for dangling ends in sequence. Stop check with first match
-                            one_match = False
-                            for restrictionSequence in pRestrictionSequence:
-                                if check_dangling_end(mate1, pDanglingSequences[restrictionSequence]) or \
-                                        check_dangling_end(mate2, pDanglingSequences[restrictionSequence]):
-                                    dangling_end[restrictionSequence] += 1
-                                    one_match = True
-                                    break
-                            if one_match:
-                                continue
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-
-                        # the interval used is:
-                        # start of fragment + length of restriction sequence
-                        # end of fragment - length of restriction sequence
-                        # the restriction sequence length is subtracted
-                        # such that only fragments internally containing
-                        # the restriction site are identified
-
-                        for restrictionSequence in pRestrictionSequence:
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                    # case when there is no restriction fragment site between the
-                    # mates
-                    if len(has_rf) == 0:
-                        same_fragment += 1
-                        continue
-
-                    self_ligation += 1
-
-                    if not pKeepSelfLigation:
-                        # skip self ligations
-                        continue
-
-                # set insert size to save bam
-                mate1.isize = mate2.pos - mate1.pos
-                mate2.isize = mate1.pos - mate2.pos
-
-            # if mate_bins, which is set in the previous section
-            # does not have size=2, it means that one
-            # of the exceptions happened
-            if len(mate_bins) != 2:
-                continue
+def save_shard_plan(pFileName, pFirstReadIndex, pNumberOfReadPairs, pOffsets, pDuplicatedReadIndices, pParameters):
+    """
+    Saves a shard plan as numpy npz file. A shard i consists of pNumberOfReadPairs[i] read pairs starting
+    with the read pair pFirstReadIndex[i] at the virtual file offsets pOffsets[i] of the two bam files.
+    pDuplicatedReadIndices are the sorted indices of all duplicated read pairs and pParameters is a dict of the
+    parameters used to compute them.
+    """
+    with open(pFileName, 'wb') as plan_file:
+        np.savez(plan_file,
+                 first_read_index=np.asarray(pFirstReadIndex, dtype=np.int64),
+                 number_of_read_pairs=np.asarray(pNumberOfReadPairs, dtype=np.int64),
+                 offsets=np.asarray(pOffsets, dtype=np.int64).reshape(-1, 2),
+                 duplicated_read_indices=np.asarray(pDuplicatedReadIndices, dtype=np.int64),
+                 parameters=np.array(json.dumps(pParameters)))
 
-            # count type of pair (distance, orientation)
-            if mate1.reference_id != mate2.reference_id:
-                inter_chromosomal += 1
 
-            elif abs(mate2.pos - mate1.pos) < 20000:
-                short_range += 1
-            else:
-                long_range += 1
-
-            if orientation == 'inward':
-                count_inward += 1
-            elif orientation == 'outward':
-                count_outward += 1
-            elif orientation == 'same-strand-left':
-                count_left += 1
-            elif orientation == 'same-strand-right':
-                count_right += 1
-
-            for mate in [mate1, mate2]:
-                # fill in coverage vector
-                vec_start = int(max(0, mate.pos - mate_bin.begin) / pBinsize)
-                length_coverage = pCoverageIndex[mate_bin_id].end - \
-                    pCoverageIndex[mate_bin_id].begin
-                vec_end = min(length_coverage, int(
-                    vec_start + len(mate.seq) / pBinsize))
-                coverage_index = pCoverageIndex[mate_bin_id].begin + vec_start
-                coverage_end = pCoverageIndex[mate_bin_id].begin + vec_end
-                for i in range(coverage_index, coverage_end, 1):
-                    pCoverage[i] += 1
-
-            if not pQuickQCMode:
-                pRow[pair_added] = mate_bins[0]
-                pCol[pair_added] = mate_bins[1]
-                pData[pair_added] = np.uint8(1)
-
-            pair_added += 1
-            if pOutputBamSet:
-
-                out_bam_index_buffer.append(iter_num - 1)
-
-        pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                        mate_not_close_to_rf, count_inward, count_outward,
-                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer]])
-    except Exception as exp:
-        pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    return
+def load_shard_plan(pFileName):
+    """
+    Loads a shard plan saved by 'save_shard_plan'. Returns a dict with the arrays of the plan
+    and the dict of parameters.
+
+    >>> import tempfile, os
+    >>> _file = tempfile.NamedTemporaryFile(suffix='.npz', delete=False)
+    >>> _file.close()
+    >>> save_shard_plan(_file.name, [0, 10], [10, 5], [[100, 200], [300, 400]], [3, 12], {'minMappingQuality': 15})
+    >>> plan = load_shard_plan(_file.name)
+    >>> plan['offsets'].tolist(), plan['duplicated_read_indices'].tolist(), plan['parameters']
+    ([[100, 200], [300, 400]], [3, 12], {'minMappingQuality': 15})
+    >>> os.remove(_file.name)
+    """
+    with np.load(pFileName) as plan_file:
+        plan = {key: plan_file[key] for key in ['first_read_index', 'number_of_read_pairs', 'offsets', 'duplicated_read_indices']}
+        plan['parameters'] = json.loads(str(plan_file['parameters']))
+    return plan
+
+
+def save_shard_state(pFileName, pShard, pNumberOfShards, pCounters, pCoverage, pChromSizes):
+    """
+    Stores the state of a shard that is needed to merge the shards in the group 'hicexplorer_shard'
+    of the cool file of its partial matrix: the QC counters, the coverage array and the chromosome sizes.
+    """
+    with h5py.File(pFileName, 'r+') as h5file:
+        group = h5file.create_group('hicexplorer_shard')
+        group.attrs['shard'] = pShard
+        group.attrs['number_of_shards'] = pNumberOfShards
+        group.attrs['counters'] = json.dumps(pCounters, default=int)
+        group.attrs['chrom_sizes'] = json.dumps(pChromSizes)
+        group.create_dataset('coverage', data=pCoverage, compression='gzip', compression_opts=1)
+
+
+def load_shard_state(pFileName, pLoadCoverage=False):
+    """
+    Loads the state of a shard saved by 'save_shard_state'. Returns a dict with the keys 'shard', 'number_of_shards',
+    'counters', 'chrom_sizes' and, if pLoadCoverage is set, 'coverage'.
+    """
+    shard_state = {}
+    with h5py.File(pFileName, 'r') as h5file:
+        if 'hicexplorer_shard' not in h5file:
+            log.error('{} is not the partial matrix of a shard.'.format(pFileName))
+            exit(1)
+        group = h5file['hicexplorer_shard']
+        shard_state['shard'] = int(group.attrs['shard'])
+        shard_state['number_of_shards'] = int(group.attrs['number_of_shards'])
+        shard_state['counters'] = json.loads(group.attrs['counters'])
+        shard_state['chrom_sizes'] = [tuple(chrom_size) for chrom_size in json.loads(group.attrs['chrom_sizes'])]
+        if pLoadCoverage:
+            shard_state['coverage'] = group['coverage'][:]
+    return shard_state
+
+
+def save_checkpoint(pFileName, pReadIndex, pOffsets, pCounters, pCoverage, pReadPosMatrix, pPixelChunks, pParameters):
+    """
+    Saves the state of a run after all read pairs before the read pair pReadIndex are processed.
+    pOffsets are the virtual file offsets of this read pair in the two bam files, pPixelChunks
+    is a list with the chunk folder and the chunk names (see PixelAccumulator.checkpoint) of each
+    pixel accumulator and pParameters is a dict of the parameters the run depends on.
+    The arrays of the duplication check are stored with the prefix 'duplication_check_'.
+    The file is first written to a temporary file and then renamed, such that an interrupted
+    write keeps the previous checkpoint.
+    """
+    duplication_check = {'duplication_check_' + key: value for key, value in vars(pReadPosMatrix).items()}
+    # the coverage difference array has one element per 10 bp and is almost all zeros,
+    # only its non-zero elements are stored
+    coverage_index = np.flatnonzero(pCoverage)
+    with open(pFileName + '.tmp', 'wb') as checkpoint_file:
+        np.savez(checkpoint_file,
+                 read_index=np.int64(pReadIndex),
+                 offsets=np.asarray(pOffsets, dtype=np.int64),
+                 counters=np.array(json.dumps(pCounters, default=int)),
+                 coverage_size=np.int64(len(pCoverage)),
+                 coverage_index=coverage_index,
+                 coverage_values=pCoverage[coverage_index],
+                 pixel_chunks=np.array(json.dumps(pPixelChunks)),
+                 parameters=np.array(json.dumps(pParameters)),
+                 **duplication_check)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(pFileName + '.tmp', pFileName)
+
+
+def load_checkpoint(pFileName):
+    """
+    Loads a checkpoint saved by 'save_checkpoint'. Returns a dict with the keys of 'save_checkpoint'.
+    'duplication_check' is a dict of the attributes of the duplication check.
+
+    >>> import tempfile, os
+    >>> _file = tempfile.NamedTemporaryFile(suffix='.npz', delete=False)
+    >>> _file.close()
+    >>> rp = ReadPositionMatrix()
+    >>> rp.is_duplicated(1, 0, 2, 0)
+    False
+    >>> save_checkpoint(_file.name, 12, [100, 200], {'iter_num': 12}, np.array([0, 3, 0], dtype=np.int32), rp,
+    ...                 [['hicBuildMatrix_x', [['chunk_0_keys.npy', 'chunk_0_counts.npy']]]], {'binSize': [10000]})
+    >>> checkpoint = load_checkpoint(_file.name)
+    >>> checkpoint['read_index'], checkpoint['offsets'].tolist(), checkpoint['counters'], checkpoint['parameters']
+    (12, [100, 200], {'iter_num': 12}, {'binSize': [10000]})
+    >>> checkpoint['coverage'].tolist(), checkpoint['coverage'].dtype
+    ([0, 3, 0], dtype('int32'))
+    >>> restored = ReadPositionMatrix()
+    >>> for key, value in checkpoint['duplication_check'].items():
+    ...     setattr(restored, key, value)
+    >>> restored.is_duplicated(2, 0, 1, 0)
+    True
+    >>> os.remove(_file.name)
+    """
+    checkpoint = {'duplication_check': {}}
+    with np.load(pFileName) as checkpoint_file:
+        for key in checkpoint_file.files:
+            if key.startswith('duplication_check_'):
+                # zero dimensional arrays are converted back to numpy scalars
+                checkpoint['duplication_check'][key[len('duplication_check_'):]] = checkpoint_file[key][()]
+        checkpoint['read_index'] = int(checkpoint_file['read_index'])
+        checkpoint['offsets'] = checkpoint_file['offsets']
+        coverage_values = checkpoint_file['coverage_values']
+        checkpoint['coverage'] = np.zeros(int(checkpoint_file['coverage_size']), dtype=coverage_values.dtype)
+        checkpoint['coverage'][checkpoint_file['coverage_index']] = coverage_values
+        for key in ['counters', 'pixel_chunks', 'parameters']:
+            checkpoint[key] = json.loads(str(checkpoint_file[key]))
+    return checkpoint
+
+
+def save_pixels_to_cool(pFileName, pBinIntervals, pPixels, pHiCMetadata):
+    """
+    Writes a matrix given as iterator of upper triangle pixel data frames,
+    sorted by bin1_id and bin2_id, to a cool file. The whole matrix is never held in memory.
+
+    Parameters
+    ----------
+    pFileName : String, the cool file name, for a mcool file the URI of the resolution group
+    pBinIntervals : List of tuples (chrom, start, end, ...), the bins of the matrix
+    pPixels : Iterator of pandas.DataFrame with the columns 'bin1_id', 'bin2_id' and 'count'
+    pHiCMetadata : dict, additional metadata ('matrix-generated-by', 'matrix-generated-by-url', 'genome-assembly')
+    """
+    bins_data_frame = pd.DataFrame([interval[:3] for interval in pBinIntervals], columns=['chrom', 'start', 'end'])
+    info = {}
+    info['format'] = str('HDF5::Cooler')
+    info['format-url'] = str('https://github.com/mirnylab/cooler')
+    info['generated-by'] = str('HiCExplorer-' + __version__)
+    info['generated-by-cooler-lib'] = str('cooler-' + cooler.__version__)
+    info['tool-url'] = str('https://github.com/deeptools/HiCExplorer')
+    for key in ['matrix-generated-by', 'matrix-generated-by-url', 'genome-assembly']:
+        if key in pHiCMetadata:
+            info[key] = toString(pHiCMetadata[key])
+
+    append = '::' in pFileName and os.path.exists(pFileName.split('::')[0])
+    cooler.create_cooler(cool_uri=pFileName,
+                         bins=bins_data_frame,
+                         pixels=pPixels,
+                         mode='a' if append else 'w',
+                         dtypes={'bin1_id': np.int32, 'bin2_id': np.int32, 'count': np.int32},
+                         ordered=True,
+                         metadata=info,
+                         temp_dir=os.path.dirname(os.path.realpath(pFileName.split('::')[0])))
+    if not append:
+        with h5py.File(pFileName.split('::')[0], 'r+') as h5file:
+            h5file.attrs.update(info)
 
 
 def main(args=None):
@@ -1110,6 +2481,7 @@ def main(args=None):
     """
 
     args = parse_arguments().parse_args(args)
+    performance_monitor = PerformanceMonitor()
     # args.outFileName.name = args.outFileName.name.strip()
     # log.debug('args.outFileName.name: {}'.format(args.outFileName.name.endswith('.h5')))
     if not args.outFileName.name.endswith('.h5') and not args.outFileName.name.endswith('.cool'):
@@ -1119,6 +2491,16 @@ def main(args=None):
     # for backwards compatibility
     if args.maxDistance is not None:
         args.maxLibraryInsertSize = args.maxDistance
+
+    # all resolutions of a mcool file are accumulated in the same pass over the bam files
+    save_as_mcool = args.outFileName.name.endswith('.mcool') and args.binSize is not None
+    if save_as_mcool:
+        for resolution in args.binSize[1:]:
+            if resolution % args.binSize[0] != 0:
+                log.error('All resolutions need to be a multiple of the first bin size {}. Given: {}'.format(args.binSize[0], resolution))
+                exit(1)
+    elif args.binSize is not None and len(args.binSize) > 1:
+        log.warning('Multiple bin sizes are only supported for the mcool file format. Only {} is used.'.format(args.binSize[0]))
     try:
         QC.make_sure_path_exists(args.QCfolder)
     except OSError:
@@ -1128,24 +2510,91 @@ def main(args=None):
         args.threads = 2
         warnings.warn(
             "\nAt least two threads need to be defined. Setting --threads = 2!s\n")
+    performance_parameters = dict(threads=args.threads,
+                                  inputBufferSize=args.inputBufferSize,
+                                  decompressionThreads=args.decompressionThreads,
+                                  compressionThreads=args.compressionThreads)
 
     if args.danglingSequence and not args.restrictionSequence:
         exit("\nIf --danglingSequence is set, --restrictionSequence needs to be set too.\n")
 
-    log.info("reading {} and {} to build hic_matrix\n".format(args.samFiles[0].name,
-                                                              args.samFiles[1].name))
-    str1 = pysam.Samfile(args.samFiles[0].name, 'rb')
-    str2 = pysam.Samfile(args.samFiles[1].name, 'rb')
+    shard_plan = None
+    if args.shardPlan is not None or args.shard is not None:
+        if args.shardPlan is None or args.shard is None or args.samFiles is None:
+            log.error('--shardPlan and --shard need to be used together with --samFiles.')
+            exit(1)
+        if not args.outFileName.name.endswith('.cool'):
+            log.error('The partial matrix of a shard is saved as cool file. Given: {}'.format(args.outFileName.name))
+            exit(1)
+        shard_plan = load_shard_plan(args.shardPlan)
+        number_of_shards = len(shard_plan['first_read_index'])
+        if args.shard < 0 or args.shard >= number_of_shards:
+            log.error('The shard plan contains the shards 0 to {}. Given: {}'.format(number_of_shards - 1, args.shard))
+            exit(1)
+        # the duplicated pairs of the plan are only valid for the same read pair filters
+        for parameter in ['minMappingQuality', 'skipDuplicationCheck', 'duplicationCheckStrand']:
+            if shard_plan['parameters'][parameter] != getattr(args, parameter):
+                log.error('The shard plan was created with --{} {}, please use the same value. '
+                          'Given: {}'.format(parameter, shard_plan['parameters'][parameter], getattr(args, parameter)))
+                exit(1)
+
+    checkpoint_file_name = None
+    if args.checkpointFolder is not None or args.resume:
+        if args.checkpointFolder is None:
+            log.error('--resume needs the --checkpointFolder of the stopped run.')
+            exit(1)
+        if args.samFiles is None or args.outBam or args.doTestRun:
+            log.error('--checkpointFolder can only be used with --samFiles and without --outBam and --doTestRun.')
+            exit(1)
+        try:
+            QC.make_sure_path_exists(args.checkpointFolder)
+        except OSError:
+            exit("Can't open/create checkpoint folder path: {}. Please check".format(args.checkpointFolder))
+        checkpoint_file_name = os.path.join(args.checkpointFolder, 'checkpoint.npz')
+        if os.path.exists(checkpoint_file_name) and not args.resume:
+            log.error('The checkpoint folder {} contains the checkpoint of another run. Use --resume to continue '
+                      'this run or remove the checkpoint.'.format(args.checkpointFolder))
+            exit(1)
 
-    args.samFiles[0].close()
-    args.samFiles[1].close()
-    if not args.doTestRun:
+    if args.mergeShards is not None:
+        shard_states = [load_shard_state(shard_file) for shard_file in args.mergeShards]
+        number_of_shards = shard_states[0]['number_of_shards']
+        shard_indices = sorted(shard_state['shard'] for shard_state in shard_states)
+        if shard_indices != list(range(number_of_shards)) or \
+                any(shard_state['number_of_shards'] != number_of_shards for shard_state in shard_states):
+            log.error('All {} shards of the shard plan are needed exactly once. Given are the shards {}'.format(number_of_shards, shard_indices))
+            exit(1)
         if args.outBam:
-            args.outBam.close()
-            out_bam_file = pysam.Samfile(args.outBam.name, 'wb', template=str1)
+            log.error('--outBam can not be used with --mergeShards.')
+            exit(1)
+        log.info("merging {} shards to build hic_matrix\n".format(number_of_shards))
+    elif args.pairsFile is not None:
+        if args.outBam:
+            log.error('--outBam can only be used with --samFiles.')
+            exit(1)
+        log.info("reading {} to build hic_matrix\n".format(args.pairsFile))
+        pairs_columns, pairs_chrom_sizes, pairs_header_lines = read_pairs_header(args.pairsFile)
+        if args.chromosomeSizes is None and len(pairs_chrom_sizes) == 0:
+            log.error('The pairs file contains no \'#chromsize:\' header lines. Please define --chromosomeSizes.')
+            exit(1)
+    else:
+        log.info("reading {} and {} to build hic_matrix\n".format(args.samFiles[0].name,
+                                                                  args.samFiles[1].name))
+        str1 = pysam.Samfile(args.samFiles[0].name, 'rb')
+        str2 = pysam.Samfile(args.samFiles[1].name, 'rb')
+
+        args.samFiles[0].close()
+        args.samFiles[1].close()
+    if args.outBam:
+        args.outBam.close()
 
     if args.chromosomeSizes is None:
-        chrom_sizes = get_chrom_sizes(str1)
+        if args.pairsFile is not None:
+            chrom_sizes = pairs_chrom_sizes
+        elif args.mergeShards is not None:
+            chrom_sizes = shard_states[0]['chrom_sizes']
+        else:
+            chrom_sizes = get_chrom_sizes(str1)
     else:
         chrom_sizes = OrderedDict()
         with open(args.chromosomeSizes.name, 'r') as file:
@@ -1158,14 +2607,35 @@ def main(args=None):
         chrom_sizes = list(chrom_sizes.items())
 
     # log.debug('chrom_sizes {}'.format(chrom_sizes))
-    read_pos_matrix = ReadPositionMatrix()
+    if args.duplicationCheckMaxMemory is not None:
+        if args.duplicationCheckMaxMemory <= 0:
+            log.error('--duplicationCheckMaxMemory needs to be a positive number of MB.')
+            exit(1)
+        read_pos_matrix = ReadPositionBloomFilter(args.duplicationCheckMaxMemory * 2**20,
+                                                  pUseStrand=args.duplicationCheckStrand)
+    else:
+        read_pos_matrix = ReadPositionMatrix(pUseStrand=args.duplicationCheckStrand)
 
     rf_interval = []
     for restrictionCutFile in args.restrictionCutFile:
         rf_interval.extend(bed2interval_list(restrictionCutFile, chrom_sizes, args.region))
 
-    rf_positions = intervalListToIntervalTree(rf_interval)
-    log.debug('rf_positions {}'.format(rf_positions.keys()))
+    if args.pairsFile is not None:
+        # reference ids for the chromosomes of the pairs file, chromosomes
+        # that are not listed get new ids while the file is read
+        chrom_name2ref_id = OrderedDict()
+        for chrom, _ in pairs_chrom_sizes + chrom_sizes:
+            if chrom not in chrom_name2ref_id:
+                chrom_name2ref_id[chrom] = len(chrom_name2ref_id)
+        ref_id2name = tuple(chrom_name2ref_id.keys())
+    elif args.mergeShards is not None:
+        # no reads are processed, the names are only needed to build the indices
+        ref_id2name = tuple(chrom for chrom, _ in chrom_sizes)
+    else:
+        ref_id2name = str1.references
+
+    rf_positions = RestrictionSiteIndex(rf_interval, ref_id2name)
+    log.debug('number of restriction sites {}'.format(len(rf_positions)))
     if args.binSize:
         bin_intervals = get_bins(args.binSize[0], chrom_sizes, args.region)
     else:
@@ -1174,24 +2644,8 @@ def main(args=None):
                                     max_distance=args.maxLibraryInsertSize)
 
     matrix_size = len(bin_intervals)
-    bin_intval_tree = intervalListToIntervalTree(bin_intervals)
-    ref_id2name = str1.references
-
-    # build c_type shared memory for the interval tree
-    shared_array_list = []
-    index_dict = {}
-    end = -1
-    for i, seq in enumerate(bin_intval_tree):
-        start = end + 1
-        interval_list = []
-        for interval in bin_intval_tree[seq]:
-            interval_list.append((interval.begin, interval.end, interval.data))
-        end = start + len(bin_intval_tree[seq]) - 1
-        index_dict[seq] = (start, end)
-        interval_list = sorted(interval_list)
-        shared_array_list.extend(interval_list)
-    shared_build_intval_tree = RawArray(C_Interval, shared_array_list)
-    bin_intval_tree = None
+    bin_interval_index = BinIntervalIndex(bin_intervals, ref_id2name)
+
     dangling_sequences = {}
     if args.danglingSequence:
         # build a list of dangling sequences
@@ -1213,36 +2667,20 @@ def main(args=None):
     # To save memory, coverage is not measured by bp
     # but by bins of length 10bp
     binsize = 10
-    number_of_elements_coverage = 0
-    start_pos_coverage = []
-    end_pos_coverage = []
-
-    for chrom, start, end in bin_intervals:
-        start_pos_coverage.append(number_of_elements_coverage)
-
-        number_of_elements_coverage += (end - start) // binsize
-        end_pos_coverage.append(number_of_elements_coverage - 1)
-    pos_coverage = RawArray(C_Coverage, list(zip(
-        start_pos_coverage, end_pos_coverage)))
-    start_pos_coverage = None
-    end_pos_coverage = None
-    coverage = Array(c_uint, [0] * number_of_elements_coverage)
-
-    # define global shared ctypes arrays for row, col and data
-    args.threads = args.threads - 1
-    row = [None] * args.threads
-    col = [None] * args.threads
-    data = [None] * args.threads
-    for i in range(args.threads):
-        row[i] = RawArray(c_uint, args.inputBufferSize)
-        col[i] = RawArray(c_uint, args.inputBufferSize)
-        data[i] = RawArray(c_ushort, args.inputBufferSize)
+    coverage_length = np.array([(end - start) // binsize for chrom, start, end in bin_intervals], dtype=np.int64)
+    number_of_elements_coverage = int(np.sum(coverage_length))
+    # first and last element of each bin in the coverage array
+    pos_coverage = np.empty((len(bin_intervals), 2), dtype=np.int64)
+    pos_coverage[:, 0] = np.cumsum(coverage_length) - coverage_length
+    pos_coverage[:, 1] = pos_coverage[:, 0] + coverage_length - 1
+    coverage_length = None
+    # the workers report the covered ranges as changes of a difference array,
+    # the coverage is computed at the end as the cumulative sum
+    coverage = np.zeros(number_of_elements_coverage + 1, dtype=np.int32)
 
     start_time = time.time()
 
     iter_num = 0
-    # pair_added = 0
-    # hic_matrix = None
 
     one_mate_unmapped = 0
     one_mate_low_quality = 0
@@ -1268,209 +2706,468 @@ def main(args=None):
 
     pair_added = 0
 
-    # input buffer for bam files
-    buffer_workers1 = [None] * args.threads
-    buffer_workers2 = [None] * args.threads
+    def get_counters():
+        return dict(iter_num=iter_num,
+                    one_mate_unmapped=one_mate_unmapped,
+                    one_mate_low_quality=one_mate_low_quality,
+                    one_mate_not_unique=one_mate_not_unique,
+                    dangling_end=dangling_end,
+                    self_circle=self_circle,
+                    self_ligation=self_ligation,
+                    same_fragment=same_fragment,
+                    mate_not_close_to_rf=mate_not_close_to_rf,
+                    duplicated_pairs=duplicated_pairs,
+                    count_inward=count_inward,
+                    count_outward=count_outward,
+                    count_left=count_left,
+                    count_right=count_right,
+                    inter_chromosomal=inter_chromosomal,
+                    short_range=short_range,
+                    long_range=long_range,
+                    pair_added=pair_added)
+
+    output_bam_set = args.outBam is not None and not args.doTestRun
 
-    # output buffer to write bam with mate1 and mate2 pairs
-    process = [None] * args.threads
     all_data_processed = False
-    hic_matrix = coo_matrix((matrix_size, matrix_size), dtype='uint32')
-    queue = [None] * args.threads
-
-    all_threads_done = False
-    thread_done = [False] * args.threads
-    count_output = 0
-    count_call_of_read_input = 0
-    computed_pairs = 0
+    # the contacts are collected as upper triangle pixels, chunks exceeding
+    # the memory limit are stored next to the output file or, to keep them
+    # for a resumed run, in the checkpoint folder
+    if checkpoint_file_name is not None:
+        pixel_temp_dir = args.checkpointFolder
+    else:
+        pixel_temp_dir = os.path.dirname(os.path.realpath(args.outFileName.name))
+    pixel_accumulator = PixelAccumulator(matrix_size, pTempDir=pixel_temp_dir)
+    # for the lower resolutions of a mcool file the bins are grouped like hicMergeMatrixBins does
+    # and the contacts are directly added to the lower resolution bins.
+    merged_bins = []
+    if save_as_mcool:
+        chrom_list = [interval[0] for interval in bin_intervals]
+        for resolution in args.binSize[1:]:
+            groups = hicMergeMatrixBins.get_bins_to_merge(chrom_list, resolution // args.binSize[0])
+            merged_bin_id = np.full(matrix_size, -1, dtype=np.int64)
+            for i, (idx_start, idx_end) in enumerate(groups):
+                merged_bin_id[idx_start:idx_end] = i
+            merged_bins.append((resolution, groups, merged_bin_id,
+                                PixelAccumulator(len(groups), pTempDir=pixel_accumulator.temp_dir)))
+        chrom_list = None
 
     if args.doTestRun:
         args.inputBufferSize = args.doTestRunLines
+    duplicated_read_indices = None
+    if shard_plan is not None:
+        start_offsets = shard_plan['offsets'][args.shard].tolist()
+        first_read_index = int(shard_plan['first_read_index'][args.shard])
+        number_of_read_pairs = int(shard_plan['number_of_read_pairs'][args.shard])
+        duplicated_read_indices = shard_plan['duplicated_read_indices']
+        duplicated_read_indices = duplicated_read_indices[np.searchsorted(duplicated_read_indices, first_read_index):
+                                                          np.searchsorted(duplicated_read_indices, first_read_index + number_of_read_pairs)]
+        log.info("processing the read pairs {} to {} of shard {}\n".format(first_read_index, first_read_index + number_of_read_pairs - 1, args.shard))
+    else:
+        start_offsets = None
+        first_read_index = 0
+        number_of_read_pairs = None
+
+    if checkpoint_file_name is not None:
+        # a checkpoint is only valid for the same input and the same parameters
+        checkpoint_parameters = json.loads(json.dumps(dict(
+            samFiles=[sam_file.name for sam_file in args.samFiles],
+            restrictionCutFile=[restriction_cut_file.name for restriction_cut_file in args.restrictionCutFile],
+            restrictionSequence=args.restrictionSequence,
+            danglingSequence=args.danglingSequence,
+            binSize=args.binSize,
+            region=args.region,
+            chromosomeSizes=None if args.chromosomeSizes is None else args.chromosomeSizes.name,
+            minDistance=args.minDistance,
+            maxLibraryInsertSize=args.maxLibraryInsertSize,
+            minMappingQuality=args.minMappingQuality,
+            keepSelfLigation=args.keepSelfLigation,
+            keepSelfCircles=args.keepSelfCircles,
+            skipDuplicationCheck=args.skipDuplicationCheck,
+            duplicationCheckStrand=args.duplicationCheckStrand,
+            duplicationCheckMaxMemory=args.duplicationCheckMaxMemory,
+            shardPlan=args.shardPlan,
+            shard=args.shard)))
+        pixel_accumulators = [pixel_accumulator] + [merged_pixel_accumulator for _, _, _, merged_pixel_accumulator in merged_bins]
+        used_chunk_dirs = set()
+        if args.resume and os.path.exists(checkpoint_file_name):
+            checkpoint = load_checkpoint(checkpoint_file_name)
+            if checkpoint['parameters'] != checkpoint_parameters or len(checkpoint['coverage']) != len(coverage):
+                log.error('The checkpoint in {} was created with different parameters. Please use the same parameters '
+                          'as for the stopped run: {}'.format(args.checkpointFolder, checkpoint['parameters']))
+                exit(1)
+            coverage[:] = checkpoint['coverage']
+            for key, value in checkpoint['duplication_check'].items():
+                setattr(read_pos_matrix, key, value)
+            for accumulator, (chunk_dir, chunk_names) in zip(pixel_accumulators, checkpoint['pixel_chunks']):
+                if chunk_dir is not None:
+                    used_chunk_dirs.add(chunk_dir)
+                    accumulator.restore(os.path.join(args.checkpointFolder, chunk_dir), chunk_names)
+            counters = checkpoint['counters']
+            iter_num = counters['iter_num']
+            one_mate_unmapped = counters['one_mate_unmapped']
+            one_mate_low_quality = counters['one_mate_low_quality']
+            one_mate_not_unique = counters['one_mate_not_unique']
+            dangling_end = counters['dangling_end']
+            self_circle = counters['self_circle']
+            self_ligation = counters['self_ligation']
+            same_fragment = counters['same_fragment']
+            mate_not_close_to_rf = counters['mate_not_close_to_rf']
+            duplicated_pairs = counters['duplicated_pairs']
+            count_inward = counters['count_inward']
+            count_outward = counters['count_outward']
+            count_left = counters['count_left']
+            count_right = counters['count_right']
+            inter_chromosomal = counters['inter_chromosomal']
+            short_range = counters['short_range']
+            long_range = counters['long_range']
+            pair_added = counters['pair_added']
+
+            # the readers continue with the first read pair that is not part of the checkpoint
+            start_offsets = checkpoint['offsets'].tolist()
+            if number_of_read_pairs is not None:
+                number_of_read_pairs -= checkpoint['read_index'] - first_read_index
+            first_read_index = checkpoint['read_index']
+            log.info("resuming from the checkpoint at read pair {}\n".format(first_read_index))
+        elif args.resume:
+            log.warning('The checkpoint folder {} contains no checkpoint, the run starts from the beginning.'.format(args.checkpointFolder))
+        # chunk folders of stopped runs that are not part of the checkpoint are removed
+        for file_name in os.listdir(args.checkpointFolder):
+            if file_name.startswith('hicBuildMatrix_') and file_name not in used_chunk_dirs:
+                shutil.rmtree(os.path.join(args.checkpointFolder, file_name), ignore_errors=True)
+        next_checkpoint_time = time.time() + 60 * args.checkpointInterval
+
+    # the setup is the time since the start, i.e. loading the bins and building the indices
+    performance_monitor.add_stage_times('setup', time.time() - performance_monitor.start_wall_time,
+                                        time.process_time() - performance_monitor.start_cpu_time)
+
+    if args.pairsFile is not None:
+        pairs_chunk_iterator = get_pairs_chunk_iterator(args.pairsFile, pairs_columns,
+                                                        pairs_header_lines, args.inputBufferSize)
+    elif args.mergeShards is not None:
+        with performance_monitor.stage('merging shards'):
+            for shard_file in args.mergeShards:
+                shard_state = load_shard_state(shard_file, pLoadCoverage=True)
+                if len(shard_state['coverage']) != len(coverage):
+                    log.error('The bins of {} differ from the given parameters.'.format(shard_file))
+                    exit(1)
+                # the stored coverage is already the cumulative sum of the difference array
+                coverage += shard_state['coverage']
+                counters = shard_state['counters']
+                iter_num += counters['iter_num']
+                one_mate_unmapped += counters['one_mate_unmapped']
+                one_mate_low_quality += counters['one_mate_low_quality']
+                one_mate_not_unique += counters['one_mate_not_unique']
+                for sequence in counters['dangling_end']:
+                    dangling_end[sequence] += counters['dangling_end'][sequence]
+                self_circle += counters['self_circle']
+                self_ligation += counters['self_ligation']
+                same_fragment += counters['same_fragment']
+                mate_not_close_to_rf += counters['mate_not_close_to_rf']
+                duplicated_pairs += counters['duplicated_pairs']
+                count_inward += counters['count_inward']
+                count_outward += counters['count_outward']
+                count_left += counters['count_left']
+                count_right += counters['count_right']
+                inter_chromosomal += counters['inter_chromosomal']
+                short_range += counters['short_range']
+                long_range += counters['long_range']
+                pair_added += counters['pair_added']
+                duplication_check_memory = counters['duplication_check_memory']
+                duplication_check_false_positive_rate = counters['duplication_check_false_positive_rate']
+
+                shard_cooler = cooler.Cooler(shard_file)
+                if shard_cooler.info['nbins'] != matrix_size:
+                    log.error('The bins of {} differ from the given parameters.'.format(shard_file))
+                    exit(1)
+                for chunk_start in range(0, shard_cooler.info['nnz'], int(1e7)):
+                    pixels = shard_cooler.pixels()[chunk_start:chunk_start + int(1e7)]
+                    row = pixels['bin1_id'].values
+                    col = pixels['bin2_id'].values
+                    pixel_accumulator.add_pixels(row, col, pixels['count'].values)
+                    for _, _, merged_bin_id, merged_pixel_accumulator in merged_bins:
+                        merged_row = merged_bin_id[row]
+                        merged_col = merged_bin_id[col]
+                        is_merged = (merged_row >= 0) & (merged_col >= 0)
+                        merged_pixel_accumulator.add_pixels(merged_row[is_merged], merged_col[is_merged],
+                                                            pixels['count'].values[is_merged])
+        all_data_processed = True
+    else:
+        # the two bam files are decoded in two reader processes, the records
+        # of the reads are filtered in this process by 'readBamFiles'
+        bam_pair_reader = BamPairReader([args.samFiles[0].name, args.samFiles[1].name],
+                                        pNumberOfItemsPerChunk=min(args.inputBufferSize, BAM_READER_CHUNK_SIZE),
+                                        pRestrictionSequence=args.restrictionSequence,
+                                        pDanglingSequences=dangling_sequences,
+                                        pDecompressionThreads=args.decompressionThreads,
+                                        pStartOffsets=start_offsets,
+                                        pNumberOfReads=number_of_read_pairs,
+                                        pFirstReadIndex=first_read_index,
+                                        pPerformanceMonitor=performance_monitor,
+                                        pKeepAlignments=output_bam_set)
+        str1.close()
+        str2.close()
+        if output_bam_set:
+            # the accepted pairs are written by a separate process in the order
+            # of the bam files, such that the compression of the output does
+            # not delay the dispatch of new batches. The alignments of the pairs
+            # are kept by the bam reader processes, the input is decoded only once.
+            queue_bam_writer = Queue()
+            queue_bam_writer_status = Queue()
+            bam_writer = Process(target=write_bam_worker, kwargs=dict(
+                pTemplateBamFileName=args.samFiles[0].name,
+                pOutBamFileName=args.outBam.name,
+                pQueueIn=queue_bam_writer,
+                pQueueOut=queue_bam_writer_status,
+                pCompressionThreads=args.compressionThreads
+            ), daemon=True)
+            bam_writer.start()
+            bam_alignments = {}
+            next_bam_batch_id = 0
+
+    # Start a pool of long-lived worker processes. All read only data
+    # is given once at start up, afterwards the workers only receive the
+    # mate records of one buffer via the bounded input queue and return
+    # their results via the output queue. The number of buffers in flight is
+    # limited to two per worker, such that a worker has always a buffer to
+    # work on while the main process is reading the next one.
+    # For a test run only one buffer per worker is read to not
+    # process more lines than requested.
+    args.threads = args.threads - 1
+    if args.mergeShards is not None:
+        # the partial matrices are already summed up, no workers are needed
+        args.threads = 0
+    if args.doTestRun:
+        max_batches_in_flight = args.threads
+    else:
+        max_batches_in_flight = 2 * args.threads
+    queue_in = Queue(maxsize=max_batches_in_flight)
+    queue_out = Queue()
+    process_data_args = dict(pKeepSelfCircles=args.keepSelfCircles,
+                             pRestrictionSequence=args.restrictionSequence,
+                             pKeepSelfLigation=args.keepSelfLigation,
+                             pRfPositions=rf_positions,
+                             pRefId2name=ref_id2name,
+                             pBinsize=binsize,
+                             pBinIntervalIndex=bin_interval_index,
+                             pCoverageIndex=pos_coverage,
+                             pMaxInsertSize=args.maxLibraryInsertSize,
+                             pQuickQCMode=args.doTestRun,
+                             pOutputBamSet=output_bam_set)
+    process = [None] * args.threads
+    for i in range(args.threads):
+        process[i] = Process(target=process_data_worker, kwargs=dict(
+            pQueueIn=queue_in,
+            pQueueOut=queue_out,
+            pProcessDataArgs=process_data_args
+        ), daemon=True)
+        process[i].start()
+
+    # the alignments of the batches are only needed to write the output bam file
+    batch_alignments = {}
+    batch_id = 0
+    batches_in_flight = 0
     fail_flag = False
     fail_message = ''
-    while not all_data_processed or not all_threads_done:
+    # for a checkpoint no new batches are dispatched until all batches in flight are processed
+    checkpoint_due = False
+    while not fail_flag and (not all_data_processed or batches_in_flight > 0):
+
+        while not all_data_processed and batches_in_flight < max_batches_in_flight and not checkpoint_due:
+            if args.pairsFile is not None:
+                with performance_monitor.stage('reading'):
+                    mate_records1, mate_records2, all_data_processed, \
+                        duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
+                        one_mate_low_quality_, iter_num_ = readPairsFile(pPairsChunkIterator=pairs_chunk_iterator,
+                                                                         pSkipDuplicationCheck=args.skipDuplicationCheck,
+                                                                         pReadPosMatrix=read_pos_matrix,
+                                                                         pChromName2RefId=chrom_name2ref_id,
+                                                                         pMinMappingQuality=args.minMappingQuality
+                                                                         )
+                buffer_mate1, buffer_mate2 = mate_records1, mate_records2
+            else:
+                with performance_monitor.stage('filtering'):
+                    buffer_mate1, buffer_mate2, all_data_processed, \
+                        duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
+                        one_mate_low_quality_, iter_num_ = readBamFiles(pBamPairReader=bam_pair_reader,
+                                                                        pNumberOfItemsPerBuffer=args.inputBufferSize,
+                                                                        pSkipDuplicationCheck=args.skipDuplicationCheck,
+                                                                        pReadPosMatrix=read_pos_matrix,
+                                                                        pMinMappingQuality=args.minMappingQuality,
+                                                                        pDuplicatedReadIndices=duplicated_read_indices
+                                                                        )
+            duplicated_pairs += duplicated_pairs_
+            one_mate_unmapped += one_mate_unmapped_
+            one_mate_not_unique += one_mate_not_unique_
+            one_mate_low_quality += one_mate_low_quality_
+            iter_num += iter_num_
+            if buffer_mate1 is None or buffer_mate2 is None:
+                continue
 
-        for i in range(args.threads):
-            if queue[i] is None and not all_data_processed:
-                count_call_of_read_input += 1
-
-                buffer_workers1[i], buffer_workers2[i], all_data_processed, \
-                    duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
-                    one_mate_low_quality_, iter_num_ = readBamFiles(pFileOneIterator=str1,
-                                                                    pFileTwoIterator=str2,
-                                                                    pNumberOfItemsPerBuffer=args.inputBufferSize,
-                                                                    pSkipDuplicationCheck=args.skipDuplicationCheck,
-                                                                    pReadPosMatrix=read_pos_matrix,
-                                                                    pRefId2name=ref_id2name,
-                                                                    pMinMappingQuality=args.minMappingQuality
-                                                                    )
-                duplicated_pairs += duplicated_pairs_
-                one_mate_unmapped += one_mate_unmapped_
-                one_mate_not_unique += one_mate_not_unique_
-                one_mate_low_quality += one_mate_low_quality_
-                iter_num += iter_num_
-                queue[i] = Queue()
-                thread_done[i] = False
-                computed_pairs += len(buffer_workers1[i])
-                # create process to compute hic matrix for this buffer
-                process[i] = Process(target=process_data, kwargs=dict(
-                    pMateBuffer1=buffer_workers1[i],
-                    pMateBuffer2=buffer_workers2[i],
-                    pMinMappingQuality=args.minMappingQuality,
-                    pKeepSelfCircles=args.keepSelfCircles,
-                    pRestrictionSequence=args.restrictionSequence,
-                    pKeepSelfLigation=args.keepSelfLigation,
-                    pMatrixSize=matrix_size,
-                    pRfPositions=rf_positions,
-                    pRefId2name=ref_id2name,
-                    pDanglingSequences=dangling_sequences,
-                    pBinsize=binsize,
-                    pResultIndex=i,
-                    pQueueOut=queue[i],
-                    pTemplate=str1,
-                    pOutputBamSet=args.outBam,
-                    pCounter=count_output,
-                    pSharedBinIntvalTree=shared_build_intval_tree,
-                    pDictBinIntervalTreeIndex=index_dict,
-                    pCoverage=coverage,
-                    pCoverageIndex=pos_coverage,
-                    pOutputFileBufferDir="",
-                    pRow=row[i],
-                    pCol=col[i],
-                    pData=data[i],
-                    pMaxInsertSize=args.maxLibraryInsertSize,
-                    pQuickQCMode=args.doTestRun
-                ))
-                process[i].start()
-                count_output += 1
-
-            elif queue[i] is not None and not queue[i].empty():
-                result = queue[i].get()
-                if 'Fail:' in result:
+            with performance_monitor.stage('dispatching'):
+                if args.pairsFile is None:
+                    mate_records1 = get_mate_records(buffer_mate1)
+                    mate_records2 = get_mate_records(buffer_mate2)
+                queue_in.put((batch_id, mate_records1, mate_records2))
+            if output_bam_set:
+                batch_alignments[batch_id] = bam_pair_reader.pop_alignments(buffer_mate1['read_index'])
+            batch_id += 1
+            batches_in_flight += 1
+
+        if checkpoint_due and batches_in_flight == 0 and not all_data_processed:
+            records1, records2 = bam_pair_reader.peek(1)
+            if len(records1) > 0:
+                with performance_monitor.stage('checkpointing'):
+                    pixel_chunks = []
+                    for accumulator in pixel_accumulators:
+                        chunk_names = accumulator.checkpoint()
+                        chunk_dir = None if accumulator.chunk_dir is None else os.path.basename(accumulator.chunk_dir)
+                        pixel_chunks.append([chunk_dir, chunk_names])
+                    save_checkpoint(checkpoint_file_name, records1['read_index'][0],
+                                    [records1['offset'][0], records2['offset'][0]], get_counters(), coverage,
+                                    read_pos_matrix, pixel_chunks, checkpoint_parameters)
+                log.info("checkpoint saved after {} lines\n".format(iter_num))
+            checkpoint_due = False
+            next_checkpoint_time = time.time() + 60 * args.checkpointInterval
+            continue
+
+        if batches_in_flight == 0:
+            break
+
+        # block until a worker returns a result. The timeout is only used to
+        # detect workers that were killed without reporting an error.
+        performance_monitor.sample_queue('worker input', queue_in)
+        try:
+            with performance_monitor.stage('waiting for workers'):
+                result = queue_out.get(timeout=60)
+        except Empty:
+            for i in range(args.threads):
+                if not process[i].is_alive():
                     fail_flag = True
-                    fail_message = result[6:]
-                else:
-                    if result[0] is not None:
-                        elements = result[0][15]
-                        if hic_matrix is None:
-                            hic_matrix = coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-                        else:
-                            hic_matrix += coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-
-                        for sequence in result[0][3]:
-                            dangling_end[sequence] += result[0][3][sequence]
-                        self_circle += result[0][4]
-                        self_ligation += result[0][5]
-                        same_fragment += result[0][6]
-                        mate_not_close_to_rf += result[0][7]
-
-                        count_inward += result[0][8]
-                        count_outward += result[0][9]
-                        count_left += result[0][10]
-                        count_right += result[0][11]
-                        inter_chromosomal += result[0][12]
-                        short_range += result[0][13]
-                        long_range += result[0][14]
-
-                        pair_added += result[0][15]
-                        iter_num += result[0][16]
-
-                    for bam_index in result[0][19]:
-                        mate1 = buffer_workers1[i][bam_index]
-                        mate2 = buffer_workers2[i][bam_index]
-
-                        mate1.flag |= 0x1
-                        mate2.flag |= 0x1
-
-                        # set one read as the first in pair and the
-                        # other as second
-                        mate1.flag |= 0x40
-                        mate2.flag |= 0x80
-
-                        # set chrom of mate
-                        mate1.mrnm = mate2.rname
-                        mate2.mrnm = mate1.rname
-
-                        # set position of mate
-                        mate1.mpos = mate2.pos
-                        mate2.mpos = mate1.pos
-
-                        out_bam_file.write(mate1)
-                        out_bam_file.write(mate2)
-
-                buffer_workers1[i] = None
-                buffer_workers2[i] = None
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-
-                # caused by the architecture I try to display this output
-                # information after +-1e5 of 1e6 reads.
-                if iter_num % 1e6 < 100000:
-                    elapsed_time = time.time() - start_time
-                    log.info("processing {} lines took {:.2f} "
-                             "secs ({:.1f} lines per "
-                             "second)\n".format(iter_num,
-                                                elapsed_time,
-                                                iter_num / elapsed_time))
-                    log.info("{} ({:.2f}%) valid pairs added to matrix"
-                             "\n".format(pair_added, float(100 * pair_added) / iter_num))
-                if args.doTestRun and iter_num > args.doTestRunLines:
-                    log.debug(
-                        "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
-                    all_data_processed = True
-                    thread_done[i] = True
-                    break
-            elif all_data_processed and queue[i] is None:
-                thread_done[i] = True
-            else:
-                time.sleep(1)
+                    fail_message = 'Worker process {} died with exit code {}'.format(i, process[i].exitcode)
+            continue
+
+        if isinstance(result, str):
+            fail_flag = True
+            fail_message = result[6:]
+            break
+        batches_in_flight -= 1
+        result_batch_id, (counts, row, col, (coverage_index, coverage_change)), worker_times = result
+        performance_monitor.add_process_times('workers', *worker_times)
+        performance_monitor.sample_memory()
+        with performance_monitor.stage('accumulation'):
+            coverage[coverage_index] += coverage_change
+
+            if len(row) > 0:
+                pixel_accumulator.add(row, col)
+                for _, _, merged_bin_id, merged_pixel_accumulator in merged_bins:
+                    merged_row = merged_bin_id[row]
+                    merged_col = merged_bin_id[col]
+                    is_merged = (merged_row >= 0) & (merged_col >= 0)
+                    merged_pixel_accumulator.add(merged_row[is_merged], merged_col[is_merged])
+
+        for sequence in counts[3]:
+            dangling_end[sequence] += counts[3][sequence]
+        self_circle += counts[4]
+        self_ligation += counts[5]
+        same_fragment += counts[6]
+        mate_not_close_to_rf += counts[7]
+
+        count_inward += counts[8]
+        count_outward += counts[9]
+        count_left += counts[10]
+        count_right += counts[11]
+        inter_chromosomal += counts[12]
+        short_range += counts[13]
+        long_range += counts[14]
+
+        pair_added += counts[15]
+        iter_num += counts[16]
+
+        if output_bam_set:
+            alignments1, alignments2 = batch_alignments.pop(result_batch_id)
+            bam_alignments[result_batch_id] = (alignments1[counts[17]], alignments2[counts[17]])
+            # the batches are written in the order they were read
+            while next_bam_batch_id in bam_alignments:
+                performance_monitor.sample_queue('bam writer', queue_bam_writer)
+                queue_bam_writer.put(bam_alignments.pop(next_bam_batch_id))
+                next_bam_batch_id += 1
+            if not queue_bam_writer_status.empty():
+                # the writer stops before the end only because of an error
+                fail_flag = True
+                fail_message = queue_bam_writer_status.get()[6:]
+
+        # caused by the architecture I try to display this output
+        # information after +-1e5 of 1e6 reads.
+        if iter_num % 1e6 < 100000:
+            elapsed_time = time.time() - start_time
+            log.info("processing {} lines took {:.2f} "
+                     "secs ({:.1f} lines per "
+                     "second)\n".format(iter_num,
+                                        elapsed_time,
+                                        iter_num / elapsed_time))
+            log.info("{} ({:.2f}%) valid pairs added to matrix"
+                     "\n".format(pair_added, float(100 * pair_added) / iter_num))
+        if checkpoint_file_name is not None and time.time() >= next_checkpoint_time:
+            checkpoint_due = True
+        if args.doTestRun and iter_num > args.doTestRunLines:
+            log.debug(
+                "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
+            all_data_processed = True
 
-        if all_data_processed:
-            all_threads_done = True
-            for thread in thread_done:
-                if not thread:
-                    all_threads_done = False
     if fail_flag:
+        for i in range(args.threads):
+            process[i].terminate()
+    else:
+        for i in range(args.threads):
+            queue_in.put(None)
+        for i in range(args.threads):
+            process[i].join()
+    if args.samFiles is not None:
+        bam_pair_reader.close()
+    if output_bam_set:
+        if fail_flag:
+            bam_writer.terminate()
+        else:
+            queue_bam_writer.put(None)
+            with performance_monitor.stage('waiting for bam writer'):
+                status = queue_bam_writer_status.get()
+            if isinstance(status, str):
+                fail_flag = True
+                fail_message = status[6:]
+            else:
+                performance_monitor.add_process_times('bam writer', status['wall time'], status['cpu time'], status['idle time'])
+        bam_writer.join()
+    if fail_flag:
+        if checkpoint_file_name is None:
+            pixel_accumulator.close()
+            for _, _, _, merged_pixel_accumulator in merged_bins:
+                merged_pixel_accumulator.close()
+        else:
+            # the chunks are kept to continue the run with --resume
+            log.info("The run can be continued from the last checkpoint with --resume.")
         log.error(fail_message)
         exit(1)
     else:
         log.debug('Parallel stuff done')
+    # cool and mcool files are written directly from the merged pixels of the accumulator,
+    # for h5 the whole matrix is needed
+    save_pixels_as_cool = not args.outFileName.name.endswith('.h5')
     if not args.doTestRun:
-        # the resulting matrix is only filled unevenly with some pairs
-        # int the upper triangle and others in the lower triangle. To construct
-        # the definite matrix I add the values from the upper and lower triangles
-        # and subtract the diagonal to avoid double counting it.
-        # The resulting matrix is symmetric.
-        if args.outBam:
-            out_bam_file.close()
-
-        dia = dia_matrix(([hic_matrix.diagonal()], [0]),
-                         shape=hic_matrix.shape)
-        hic_matrix = hic_matrix + hic_matrix.T - dia
-        # extend bins such that they are next to each other
-        bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
-        # compute max bin coverage
-        bin_max = []
-
-        for cover in pos_coverage:
-            max_element = 0
-            for i in range(cover.begin, cover.end, 1):
-                if coverage[i] > max_element:
-                    max_element = coverage[i]
-            if max_element == 0:
-                bin_max.append(np.nan)
-            else:
-                bin_max.append(max_element)
-
-        chr_name_list, start_list, end_list = list(zip(*bin_intervals))
-        bin_intervals = list(zip(chr_name_list, start_list, end_list, bin_max))
-        hic_ma = hm.hiCMatrix()
-        hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
+        with performance_monitor.stage('saving'):
+            # extend bins such that they are next to each other
+            bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
+            # compute max bin coverage
+            if args.mergeShards is None:
+                np.cumsum(coverage, out=coverage)
+            bin_max = get_max_coverage(coverage, pos_coverage)
+
+            chr_name_list, start_list, end_list = list(zip(*bin_intervals))
+            bin_intervals = list(zip(chr_name_list, start_list, end_list, bin_max))
+            if not save_pixels_as_cool:
+                # the pixels are accumulated only for the upper triangle,
+                # the resulting matrix is symmetric.
+                hic_ma = hm.hiCMatrix()
+                hic_ma.setMatrix(pixel_accumulator.to_matrix(), cut_intervals=bin_intervals)
 
     """
     if args.restrictionCutFile:
@@ -1575,6 +3272,20 @@ Max library insert size\t{}\t\t
         intermediate_qc_log.write("Read pair type: right pairs\t{}\t({:.2f})\n".
                                   format(count_right, 100 * float(count_right) / pair_added))
 
+    if shard_plan is not None:
+        duplication_check_memory = shard_plan['parameters']['duplication_check_memory']
+        duplication_check_false_positive_rate = shard_plan['parameters']['duplication_check_false_positive_rate']
+    elif args.mergeShards is None:
+        duplication_check_memory = read_pos_matrix.memory_usage()
+        duplication_check_false_positive_rate = read_pos_matrix.false_positive_rate()
+    if not args.skipDuplicationCheck:
+        intermediate_qc_log.write(
+            "\n#\tduplication check\n")
+        intermediate_qc_log.write("Duplication check memory (MB)\t{:.2f}\n".
+                                  format(duplication_check_memory / 2**20))
+        intermediate_qc_log.write("Duplication check false positive rate\t{:.3g}\n".
+                                  format(duplication_check_false_positive_rate))
+
     log_file_name = os.path.join(args.QCfolder, "QC.log")
     log_file = open(log_file_name, 'w')
     log_file.write(intermediate_qc_log.getvalue())
@@ -1582,8 +3293,6 @@ Max library insert size\t{}\t\t
     log.debug('log_file_name {}'.format(log_file_name))
     log.debug('args.QCfolder {}'.format(args.QCfolder))
 
-    QC.main("-l {} -o {}".format(log_file_name, args.QCfolder).split())
-
     args.outFileName.close()
     # removing the empty file. Otherwise the save method
     # will say that the file already exists.
@@ -1599,36 +3308,36 @@ Max library insert size\t{}\t\t
         hic_metadata['genome-assembly'] = np.string_(args.genomeAssembly)
 
     intermediate_qc_log.close()
-    if args.outFileName.name.endswith('.mcool') and args.binSize is not None and len(args.binSize) > 2:
-
-        matrixFileHandlerOutput = MatrixFileHandler(
-            pFileType='cool', pHiCInfo=hic_metadata)
-        matrixFileHandlerOutput.set_matrix_variables(hic_ma.matrix,
-                                                     hic_ma.cut_intervals,
-                                                     hic_ma.nan_bins,
-                                                     hic_ma.correction_factors,
-                                                     hic_ma.distance_counts)
-        matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
-            args.binSize[0]), pSymmetric=True, pApplyCorrection=False)
-
-        for resolution in args.binSize[1:]:
-            hic_matrix_to_merge = deepcopy(hic_ma)
-            _mergeFactor = int(resolution) // args.binSize[0]
-            merged_matrix = hicMergeMatrixBins.merge_bins(
-                hic_matrix_to_merge, _mergeFactor)
-            matrixFileHandlerOutput = MatrixFileHandler(
-                pFileType='cool', pAppend=True, pHiCInfo=hic_metadata)
-            matrixFileHandlerOutput.set_matrix_variables(merged_matrix.matrix,
-                                                         merged_matrix.cut_intervals,
-                                                         merged_matrix.nan_bins,
-                                                         merged_matrix.correction_factors,
-                                                         merged_matrix.distance_counts)
-            matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
-                resolution), pSymmetric=True, pApplyCorrection=False)
-
-    else:
-        if not args.doTestRun:
-            hic_ma.save(args.outFileName.name, pHiCInfo=hic_metadata)
+    if not args.doTestRun:
+        with performance_monitor.stage('saving'):
+            if save_as_mcool:
+                save_pixels_to_cool(args.outFileName.name + '::/resolutions/' + str(args.binSize[0]),
+                                    bin_intervals, pixel_accumulator.pixels(), hic_metadata)
+                for resolution, groups, _, merged_pixel_accumulator in merged_bins:
+                    merged_bin_intervals = [(bin_intervals[idx_start][0], bin_intervals[idx_start][1], bin_intervals[idx_end - 1][2])
+                                            for idx_start, idx_end in groups]
+                    save_pixels_to_cool(args.outFileName.name + '::/resolutions/' + str(resolution),
+                                        merged_bin_intervals, merged_pixel_accumulator.pixels(), hic_metadata)
+                    merged_pixel_accumulator.close()
+            elif save_pixels_as_cool:
+                save_pixels_to_cool(args.outFileName.name, bin_intervals, pixel_accumulator.pixels(), hic_metadata)
+            else:
+                hic_ma.save(args.outFileName.name, pHiCInfo=hic_metadata)
+            if shard_plan is not None:
+                shard_counters = get_counters()
+                shard_counters['duplication_check_memory'] = duplication_check_memory
+                shard_counters['duplication_check_false_positive_rate'] = duplication_check_false_positive_rate
+                save_shard_state(args.outFileName.name, args.shard, len(shard_plan['first_read_index']),
+                                 shard_counters, coverage, chrom_sizes)
+    pixel_accumulator.close()
+    if checkpoint_file_name is not None and os.path.exists(checkpoint_file_name):
+        # the run is complete, the checkpoint is not needed anymore
+        os.remove(checkpoint_file_name)
+
+    # the QC report is created after the matrix is saved, such that the
+    # saving is part of the performance statistics shown in the report
+    performance_monitor.save(os.path.join(args.QCfolder, "performance.json"), iter_num, performance_parameters)
+    QC.main("-l {} -o {}".format(log_file_name, args.QCfolder).split())
 
 
 class Tester(object):
@@ -1,17 +1,26 @@
 import warnings
 import sys
+import os
+import traceback
+from copy import copy
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from past.builtins import zip
-from scipy.sparse import lil_matrix
+from scipy.sparse import block_diag
+from multiprocessing import Pool, Process, Queue
+from queue import Empty
 
-from hicexplorer.iterativeCorrection import iterativeCorrection
+from hicexplorer.iterativeCorrection import iterativeCorrection, iterativeCorrectionCooler, coolerMarginals
+import cooler
+import pandas as pd
 from hicmatrix import HiCMatrix as hm
+from hicmatrix.lib import MatrixFileHandler
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import share_csr_matrix, csr_matrix_from_shared
 
 # Knight-Ruiz algorithm:
 from krbalancing import *
@@ -156,8 +165,8 @@ def correct_subparser():
 
     parserRequired.add_argument('--outFileName', '-o',
                                 help='File name to save the resulting matrix. '
-                                'The output is a .h5 file.',
-                                required=True)
+                                'The output is a .h5 file. Not needed with --inPlace.',
+                                default=None)
 
     parserOpt = parser.add_argument_group('Optional arguments')
 
@@ -229,12 +238,85 @@ def correct_subparser():
                            ' Only for ICE!',
                            action='store_true')
 
+    parserOpt.add_argument('--singlePrecision',
+                           help='Filter and correct the matrix with 32 bit instead of 64 bit floating point '
+                           'values. This about halves the memory needed for the matrix and its copies. The '
+                           'marginals are still summed up in 64 bit, the correction factors differ from the '
+                           '64 bit correction by about the --iterNum tolerance. Only for ICE!',
+                           action='store_true')
+
     parserOpt.add_argument('--perchr',
                            help='Normalize each chromosome separately. This is'
                            ' useful for samples from cells with uneven number '
                            'of chromosomes and/or translocations.',
                            action='store_true')
 
+    parserOpt.add_argument('--chunkSize',
+                           help='Compute the ICE correction out of core: instead of loading the matrix, '
+                           'the pixels of the cool file are streamed in chunks of this number of pixels '
+                           'in each iteration. Only the correction factors are held in memory, the '
+                           'corrected pixels are written chunk by chunk to the cool output file. '
+                           'The stored pixel counts are corrected, an existing weight column of the input '
+                           'is ignored. Requires a cool input and output file, and the ICE correction '
+                           'method. --chromosomes, --perchr, --transCutoff, --sequencedCountCutoff and '
+                           '--inflationCutoff are not supported. Only for ICE!',
+                           type=int,
+                           metavar='INT',
+                           default=None)
+
+    parserOpt.add_argument('--threads',
+                           help='Number of processes. With --perchr the chromosomes are balanced '
+                           'in parallel, with --chunkSize the marginals of the pixel chunks are computed '
+                           'in parallel'
+                           ' (Default: %(default)s).',
+                           type=int,
+                           metavar='INT',
+                           default=1)
+
+    parserOpt.add_argument('--inPlace',
+                           help='Only compute the correction factors and store them as weight column '
+                           'in the bins table of the input cool file, instead of writing a corrected '
+                           'matrix to --outFileName. Bins removed by the filtering get nan as weight. '
+                           'Memory and disk I/O for the output then scale with the number of bins instead '
+                           'of the number of non-zero pixels. The correction factors are computed for the '
+                           'stored pixel counts, an existing weight column is replaced.',
+                           action='store_true')
+
+    parserOpt.add_argument('--startWeights',
+                           help='Cool file whose weight column is the starting point of the '
+                           'correction instead of uniform weights, e.g. the weights of a matrix '
+                           'corrected with --inPlace before further sequencing runs were added with '
+                           'hicSumMatrices or bins were masked with hicAdjustMatrix. After small changes '
+                           'of the matrix the correction then converges in a few iterations. The file '
+                           'needs the same bins as --matrix, and it can be --matrix itself. The weights '
+                           'are multiplicative as in cooler; the raw counts of a cool --matrix are '
+                           'corrected. Only for ICE!',
+                           metavar='FILE',
+                           default=None)
+
+    parserOpt.add_argument('--resolutions',
+                           help='If --matrix is an mcool file, the resolutions to balance in one run. '
+                           'The resolutions are balanced in parallel by --threads processes and the weights '
+                           'are written to each resolution, --inPlace is required (Default: all resolutions).',
+                           type=int,
+                           nargs='+',
+                           metavar='INT',
+                           default=None)
+
+    parserOpt.add_argument('--maxMemory',
+                           help='Memory budget in MB for balancing the resolutions of an mcool file in parallel. '
+                           'A resolution is only started if the estimated memory of all running resolutions '
+                           'stays below the budget; a single resolution is always balanced.',
+                           type=float,
+                           metavar='MB',
+                           default=None)
+
+    parserOpt.add_argument('--maskFromCoarsestResolution',
+                           help='If --matrix is an mcool file, the coarsest resolution is balanced first and '
+                           'the bins of the other resolutions that lie in a filtered bin of the coarsest '
+                           'resolution are masked, in addition to their own filtering.',
+                           action='store_true')
+
     parserOpt.add_argument('--verbose',
                            help='Print processing status.',
                            action='store_true')
@@ -243,14 +325,328 @@ def correct_subparser():
     return parser
 
 
-def iterative_correction(matrix, args):
+def iterative_correction(matrix, args, start_bias=None, history=None):
     corrected_matrix, correction_factors = iterativeCorrection(matrix,
+                                                               v=start_bias,
                                                                M=args.iterNum,
-                                                               verbose=args.verbose)
+                                                               verbose=args.verbose,
+                                                               history=history,
+                                                               dtype=np.float32 if args.singlePrecision else np.float64)
 
     return corrected_matrix, correction_factors
 
 
+def read_start_bias(cooler_uri, chromosomes=None):
+    """
+    Reads the weight column of a cool file as the bias to start the
+    iterative correction with. The cooler weights are multiplicative,
+    the bias of the iterative correction is divisive. With a list of
+    chromosomes, the bias of these chromosomes is returned in the given order.
+    """
+    cooler_file = cooler.Cooler(cooler_uri)
+    if 'weight' not in cooler_file.bins().columns:
+        log.error('{} has no weight column.'.format(cooler_uri))
+        sys.exit(1)
+    weights = cooler_file.bins()['weight'][:].values.astype(np.float64)
+    if chromosomes:
+        weights = np.concatenate([weights[slice(*cooler_file.extent(chrom))] for chrom in chromosomes])
+    start_bias = np.ones(len(weights))
+    valid = np.isfinite(weights) & (weights > 0)
+    start_bias[valid] = 1 / weights[valid]
+    return start_bias
+
+
+def write_convergence_history(cooler_uri, history, tolerance=1e-5):
+    """
+    Stores the maximal deviation of the marginals in each iteration of
+    the correction, the number of iterations and whether the correction
+    converged as attributes of the weight column of a cool file.
+    """
+    with cooler.Cooler(cooler_uri).open('r+') as h5_group:
+        weight = h5_group['bins']['weight']
+        weight.attrs['convergence_history'] = np.array(history, dtype=np.float64)
+        weight.attrs['iterations'] = len(history)
+        weight.attrs['converged'] = bool(len(history) > 0 and history[-1] < tolerance)
+
+
+def corrected_pixel_chunks(cooler_uri, correction_factors, chunk_size, skip_diagonal=False):
+    """
+    Yields the pixels of a cooler file divided by the correction factors of
+    both bins, chunk by chunk. Pixels of bins without a correction factor (nan),
+    pixels without counts and, if skip_diagonal is set, the pixels on the
+    main diagonal are removed, as the in memory correction does.
+    """
+    cooler_file = cooler.Cooler(cooler_uri)
+    max_value = 0
+    with cooler_file.open('r') as h5_group:
+        pixels = h5_group['pixels']
+        for chunk_start in range(0, cooler_file.info['nnz'], chunk_size):
+            chunk_end = chunk_start + chunk_size
+            bin1_id = pixels['bin1_id'][chunk_start:chunk_end]
+            bin2_id = pixels['bin2_id'][chunk_start:chunk_end]
+            values = pixels['count'][chunk_start:chunk_end].astype(np.float64)
+            values /= correction_factors[bin1_id] * correction_factors[bin2_id]
+            keep = np.isfinite(values) & (values != 0)
+            if skip_diagonal:
+                keep &= bin1_id != bin2_id
+            if np.any(keep):
+                max_value = max(max_value, values[keep].max())
+                if max_value > 1e10:
+                    log.error("*Error* matrix correction produced extremely large values. "
+                              "This is often caused by bins of low counts. Use a more stringent "
+                              "filtering of bins.")
+                    exit(1)
+            yield pd.DataFrame({'bin1_id': bin1_id[keep],
+                                'bin2_id': bin2_id[keep],
+                                'count': values[keep]})
+
+
+def iterative_correction_out_of_core(args, seed_masked_bins=None):
+    """
+    ICE correction of a cool file without loading the matrix. The
+    bins are filtered as in the in memory correction, using the
+    row sums of a first pass over the pixels. The output is a cool file
+    with the corrected pixels and the correction factors as weight column,
+    like the cool files written by the in memory correction. With --inPlace
+    the weights and the convergence history are returned instead.
+    """
+    if not check_cooler(args.matrix) or not (args.inPlace or check_cooler(args.outFileName)):
+        log.error('--chunkSize requires a cool input and output file.')
+        sys.exit(1)
+    if args.correctionMethod != 'ICE':
+        log.error('--chunkSize is only supported for the ICE correction.')
+        sys.exit(1)
+    if args.chunkSize < 1 or args.threads < 1:
+        log.error('--chunkSize and --threads need to be positive numbers.')
+        sys.exit(1)
+    for unsupported, name in [(args.chromosomes, '--chromosomes'), (args.perchr, '--perchr'),
+                              (args.transCutoff, '--transCutoff'),
+                              (args.sequencedCountCutoff, '--sequencedCountCutoff'),
+                              (args.inflationCutoff, '--inflationCutoff'),
+                              (args.singlePrecision, '--singlePrecision')]:
+        if unsupported:
+            log.error('{} is not supported together with --chunkSize.'.format(name))
+            sys.exit(1)
+    if not args.filterThreshold:
+        log.error('min and max filtering thresholds should be set')
+        sys.exit(1)
+
+    cooler_file = cooler.Cooler(args.matrix)
+    row_sum, diagonal, _ = coolerMarginals(args.matrix, pChunkSize=args.chunkSize, pThreads=args.threads)
+    masked_bins = row_sum == 0
+    log.info("Removing {} zero value bins".format(np.sum(masked_bins)))
+    log.info("matrix contains {} data points in the upper triangle.".format(cooler_file.info['nnz']))
+    if seed_masked_bins is not None:
+        masked_bins |= seed_masked_bins
+
+    marginals = row_sum - diagonal
+    marginals[masked_bins] = np.nan
+    outlier_regions = filter_by_zscore(marginals, args.filterThreshold[0], args.filterThreshold[1])
+    log.info("Bins that are MAD outliers ({:.2f}%) out of {}: {}".format(
+        100 * float(len(outlier_regions)) / np.sum(~masked_bins), np.sum(~masked_bins), len(outlier_regions)))
+    masked_bins[outlier_regions] = True
+
+    start_bias = read_start_bias(args.startWeights) if args.startWeights else None
+    history = []
+    correction_factors = iterativeCorrectionCooler(args.matrix, pMaskedBins=masked_bins, pChunkSize=args.chunkSize,
+                                                   pThreads=args.threads, pSkipDiagonal=args.skipDiagonal,
+                                                   pStartBias=start_bias, M=args.iterNum, verbose=args.verbose,
+                                                   pHistory=history)
+    log.debug("Correction factors {}".format(correction_factors[:10]))
+    log.info("Total regions to be removed: {}".format(np.sum(masked_bins)))
+
+    if args.inPlace:
+        return 1 / correction_factors, history
+
+    bins = cooler_file.bins()[['chrom', 'start', 'end']][:]
+    bins['weight'] = np.where(np.isnan(correction_factors), 1, correction_factors)
+    cooler.create_cooler(args.outFileName, bins,
+                         corrected_pixel_chunks(args.matrix, correction_factors, args.chunkSize,
+                                                skip_diagonal=args.skipDiagonal),
+                         dtypes={'count': np.float64, 'weight': np.float32},
+                         ordered=True, symmetric_upper=True,
+                         temp_dir=os.path.dirname(os.path.realpath(args.outFileName)))
+    write_convergence_history(args.outFileName, history)
+
+
+def write_weights(cooler_uri, weights):
+    """
+    Writes the correction factors as weight column into the bins table of an
+    existing cooler file. The weights are multiplicative, as expected by cooler,
+    and an existing weight column is replaced.
+    """
+    with cooler.Cooler(cooler_uri).open('r+') as h5_group:
+        bins = h5_group['bins']
+        if 'weight' in bins:
+            del bins['weight']
+        bins.create_dataset('weight', data=np.asarray(weights, dtype=np.float64),
+                            compression='gzip', compression_opts=6)
+
+
+def balance_submatrix(submatrix, correction_method, iter_num, keep_matrix, verbose=False, start_bias=None):
+    """
+    Balances the matrix of a single chromosome with ICE or KR.
+
+    :return: the corrected matrix (None unless keep_matrix is set), the correction
+             factors, the row sums of the corrected matrix and the convergence
+             history (both only for ICE). None if the correction failed.
+    """
+    if correction_method == 'ICE':
+        history = []
+        try:
+            _matrix, _corr_factors = iterativeCorrection(submatrix, v=start_bias, M=iter_num, verbose=verbose,
+                                                         history=history, dtype=submatrix.dtype)
+        except SystemExit:
+            # the reason was already logged
+            return None
+        row_sum = np.asarray(_matrix.sum(axis=1)).flatten()
+        return _matrix if keep_matrix else None, _corr_factors, row_sum, history
+
+    # Set the kr matrix along with its correction factors vector
+    assert(correction_method == 'KR')
+    log.debug("Loading a float sparse matrix for KR balancing")
+    kr = kr_balancing(submatrix.shape[0],
+                      submatrix.shape[1],
+                      submatrix.count_nonzero(),
+                      submatrix.indptr.astype(
+                          np.int64, copy=False),
+                      submatrix.indices.astype(
+                          np.int64, copy=False),
+                      submatrix.data.astype(np.float64, copy=False))
+    kr.computeKR()
+    _matrix = kr.get_normalised_matrix(True) if keep_matrix else None
+    _corr_factors = np.asarray(kr.get_normalisation_vector(False).todense()).flatten()
+    return _matrix, _corr_factors, None, None
+
+
+def init_balancing_worker(data, indices, indptr, shape):
+    global shared_matrix
+    shared_matrix = csr_matrix_from_shared(data, indices, indptr, shape)
+
+
+def balance_chromosome_worker(job):
+    """
+    Balances the chromosome given by its bin range in the shared matrix.
+    """
+    job_id, (chr_start, chr_end, correction_method, iter_num, keep_matrix, verbose, start_bias) = job
+    submatrix = shared_matrix[chr_start:chr_end, chr_start:chr_end]
+    return job_id, balance_submatrix(submatrix, correction_method, iter_num, keep_matrix, verbose, start_bias)
+
+
+def estimate_memory(cooler_uri, chunk_size=None):
+    """
+    Rough estimate of the peak memory in bytes to balance a cooler: about
+    100 bytes per stored pixel for the matrix and its copies in memory,
+    or the chunks and a few vectors of the bin size with chunk_size.
+    """
+    info = cooler.Cooler(cooler_uri).info
+    if chunk_size:
+        return 64 * info['nbins'] + 64 * min(chunk_size, info['nnz'])
+    return 100 * info['nnz'] + 64 * info['nbins']
+
+
+def coarse_masked_bins(coarse_uri, coarse_weights, fine_uri):
+    """
+    Returns a boolean array with True for the bins of fine_uri that lie in
+    a bin of coarse_uri without weight, i.e. a bin filtered at the coarse resolution.
+    """
+    coarse_cooler = cooler.Cooler(coarse_uri)
+    fine_cooler = cooler.Cooler(fine_uri)
+    fine_bins = fine_cooler.bins()[['chrom', 'start']][:]
+    chrom_offsets = np.array([coarse_cooler.extent(chrom)[0] for chrom in fine_cooler.chromnames])
+    coarse_bin_ids = chrom_offsets[fine_bins['chrom'].cat.codes.values] + fine_bins['start'].values // coarse_cooler.binsize
+    return np.isnan(coarse_weights)[coarse_bin_ids]
+
+
+def balance_resolution_worker(pArgs, pResolution, pSeedMaskedBins, pQueue):
+    try:
+        result = correct_matrix(pArgs, pSeedMaskedBins)
+    except SystemExit:
+        # the reason was already logged
+        result = 'Fail: balancing {} failed.'.format(pArgs.matrix)
+    except Exception as exp:
+        result = 'Fail: ' + str(exp) + traceback.format_exc()
+    pQueue.put((pResolution, result))
+
+
+def balance_resolutions(args):
+    """
+    Balances several resolutions of an mcool file in one run. The resolutions are
+    balanced in parallel by separate processes, as long as their estimated memory
+    fits into --maxMemory. The weights are written to the mcool file once
+    all resolutions are balanced, such that no process writes into the file
+    while others read it.
+    """
+    cooler_uris = {}
+    for group in cooler.fileops.list_coolers(args.matrix):
+        cooler_uri = args.matrix + '::' + group
+        cooler_uris[cooler.Cooler(cooler_uri).binsize] = cooler_uri
+    resolutions = sorted(cooler_uris) if args.resolutions is None else sorted(set(args.resolutions))
+    for resolution in resolutions:
+        if resolution not in cooler_uris:
+            log.error('Resolution {} is not in {}. Available are: {}'.format(resolution, args.matrix,
+                                                                             sorted(cooler_uris)))
+            sys.exit(1)
+    # the coarsest resolution first
+    resolutions = resolutions[::-1]
+    coarsest = resolutions[0]
+
+    max_memory = args.maxMemory * 2**20 if args.maxMemory else np.inf
+    memory = {resolution: estimate_memory(cooler_uris[resolution], args.chunkSize) for resolution in resolutions}
+    number_of_processes = min(args.threads, len(resolutions))
+    threads_per_resolution = max(1, args.threads // number_of_processes)
+
+    queue = Queue()
+    pending = list(resolutions)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < number_of_processes:
+            resolution = pending[0]
+            if args.maskFromCoarsestResolution and resolution != coarsest and coarsest not in results:
+                break
+            if running and sum(memory[r] for r in running) + memory[resolution] > max_memory:
+                break
+            seed_masked_bins = None
+            if args.maskFromCoarsestResolution and resolution != coarsest:
+                seed_masked_bins = coarse_masked_bins(cooler_uris[coarsest], results[coarsest][0],
+                                                      cooler_uris[resolution])
+            resolution_args = copy(args)
+            resolution_args.matrix = cooler_uris[resolution]
+            resolution_args.threads = threads_per_resolution
+            log.info('Balancing resolution {}'.format(resolution))
+            running[resolution] = Process(target=balance_resolution_worker, kwargs=dict(
+                pArgs=resolution_args,
+                pResolution=resolution,
+                pSeedMaskedBins=seed_masked_bins,
+                pQueue=queue
+            ))
+            running[resolution].start()
+            pending.pop(0)
+
+        try:
+            resolution, result = queue.get(timeout=5)
+        except Empty:
+            for resolution in running:
+                if running[resolution].exitcode not in [None, 0]:
+                    log.error('Balancing resolution {} was terminated.'.format(resolution))
+                    sys.exit(1)
+            continue
+        running.pop(resolution).join()
+        if isinstance(result, str):
+            log.error(result)
+            for process in running.values():
+                process.terminate()
+            sys.exit(1)
+        results[resolution] = result
+
+    for resolution in resolutions:
+        weights, history = results[resolution]
+        write_weights(cooler_uris[resolution], weights)
+        if history:
+            write_convergence_history(cooler_uris[resolution], history)
+
+
 def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
     """ try to fill-in the failed_bins the matrix by adding the
     average values of the neighboring rows and cols. The idea
@@ -419,12 +815,13 @@ class MAD(object):
         return (mad * self.med_abs_deviation / self.mad_b_value) + self.median
 
 
-def plot_total_contact_dist(hic_ma, args):
+def plot_total_contact_dist(marginals, args, chr_bin_ranges=None):
     """
     Plots the distribution of number of contacts (excluding self contacts)
     Outliers with a high number are removed for the plot
 
-    :param hic_ma: sparse matrix
+    :param marginals: contacts per bin, see matrix_marginals, NaN for masked bins
+    :param chr_bin_ranges: list of (chromosome, (start bin, end bin)), needed with --perchr
     :return:
     """
     use('Agg')
@@ -485,13 +882,8 @@ def plot_total_contact_dist(hic_ma, args):
             else:
                 log.info("mad threshold {}".format(mad_threshold))
 
-    # replace nan by 0
-    # hic_ma.matrix.data[np.isnan(hic_ma.matrix.data)] = 0
-    hic_ma.matrix = convertNansToZeros(hic_ma.matrix)
-    hic_ma.matrix = convertInfsToZeros(hic_ma.matrix)
-
     if args.perchr:
-        chroms = hic_ma.getChrNames()
+        chroms = [chrname for chrname, _ in chr_bin_ranges]
         if len(chroms) > 30:
             log.warning("The matrix contains {} chromosomes. It is not "
                         "practical to plot each. Try using --chromosomes to "
@@ -501,14 +893,11 @@ def plot_total_contact_dist(hic_ma, args):
         grids = gridspec.GridSpec(num_rows, num_cols)
         fig = plt.figure(figsize=(6 * num_cols, 5 * num_rows))
         ax = {}
-        for plot_num, chrname in enumerate(chroms):
+        for plot_num, (chrname, chr_range) in enumerate(chr_bin_ranges):
             log.info("Plotting chromosome {}".format(chrname))
 
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            row_sum = row_sum - chr_submatrix.diagonal()
+            row_sum = marginals[chr_range[0]:chr_range[1]]
+            row_sum = row_sum[np.isfinite(row_sum)]
             mad = MAD(row_sum)
             modified_z_score = mad.get_motified_zscores()
 
@@ -524,8 +913,7 @@ def plot_total_contact_dist(hic_ma, args):
             ax[chrname].set_title(chrname)
     else:
         fig = plt.figure()
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        row_sum = row_sum - hic_ma.matrix.diagonal()
+        row_sum = marginals[np.isfinite(marginals)]
         mad = MAD(row_sum)
         modified_z_score = mad.get_motified_zscores()
 
@@ -542,48 +930,86 @@ def plot_total_contact_dist(hic_ma, args):
     plt.close()
 
 
-def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
+def chromosome_bin_ranges(hic_ma):
     """
-    The method defines thresholds per chromosome
-    to avoid introducing bias due to different chromosome numbers
+    Returns a list of (chromosome, (start bin, end bin)) of a matrix in memory.
+    """
+    return [(chrname, hic_ma.getChrBinRange(chrname)) for chrname in hic_ma.getChrNames()]
+
 
+def matrix_marginals(hic_ma, perchr=False):
     """
-    to_remove = []
-    if perchr:
-        for chrname in list(hic_ma.interval_trees):
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1],
-                                          chr_range[0]:chr_range[1]]
-
-            # replace nan values by zero
-            chr_submatrix.data[np.isnan(chr_submatrix.data)] = 0
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            # subtract from row sum, the diagonal
-            # to account for interactions with other bins
-            # and not only self interactions that are the dominant count
-            row_sum = row_sum - chr_submatrix.diagonal()
-            mad = MAD(row_sum)
-            problematic = np.flatnonzero(
-                mad.is_outlier(lower_threshold, upper_threshold))
+    Returns the total contacts per bin, without the self contacts of
+    the bin that are the dominant count. With perchr only the contacts
+    within the chromosome of the bin are counted.
+    """
+    if not perchr:
+        return np.asarray(hic_ma.matrix.sum(axis=1)).flatten() - hic_ma.matrix.diagonal()
+    marginals = np.zeros(hic_ma.matrix.shape[0])
+    for _, (chr_start, chr_end) in chromosome_bin_ranges(hic_ma):
+        chr_submatrix = hic_ma.matrix[chr_start:chr_end, chr_start:chr_end]
+        marginals[chr_start:chr_end] = np.asarray(chr_submatrix.sum(axis=1)).flatten() - chr_submatrix.diagonal()
+    return marginals
 
-            # because the problematic indices are specific for the given chromosome
-            # they need to be updated to match the large matrix indices
-            problematic += chr_range[0]
 
-            if len(problematic) == 0:
-                log.warn("Warning. No bins removed for chromosome {} using thresholds {} {}"
-                         "\n".format(chrname, lower_threshold, upper_threshold))
+def cooler_marginals(cooler_uri, chromosomes=None, perchr=False, chunk_size=10000000, threads=1):
+    """
+    Same as matrix_marginals for a cool file, computed chunk by chunk from the
+    pixels without loading the matrix. Bins without contacts and the bins of
+    chromosomes that are not selected are NaN.
 
-            to_remove.extend(problematic)
+    :return: the marginals and the list of (chromosome, (start bin, end bin)) of the selected chromosomes
+    """
+    cooler_file = cooler.Cooler(cooler_uri)
+    if chromosomes is None:
+        chromosomes = cooler_file.chromnames
+    for chrname in chromosomes:
+        if chrname not in cooler_file.chromnames:
+            log.error('Chromosome {} is not in {}.'.format(chrname, cooler_uri))
+            sys.exit(1)
+    chr_bin_ranges = [(chrname, cooler_file.extent(chrname)) for chrname in chromosomes]
+
+    bin_groups = None
+    if len(chromosomes) < len(cooler_file.chromnames):
+        # only the contacts between the selected chromosomes
+        bin_groups = np.full(cooler_file.info['nbins'], -1, dtype=np.int64)
+        for _, (chr_start, chr_end) in chr_bin_ranges:
+            bin_groups[chr_start:chr_end] = 0
+    row_sum, diagonal, _ = coolerMarginals(cooler_uri, pChunkSize=chunk_size, pThreads=threads,
+                                           pBinGroups=bin_groups)
+    if perchr:
+        chrom_groups = np.full(cooler_file.info['nbins'], -1, dtype=np.int64)
+        for chrom_id, (_, (chr_start, chr_end)) in enumerate(chr_bin_ranges):
+            chrom_groups[chr_start:chr_end] = chrom_id
+        cis_row_sum, _, _ = coolerMarginals(cooler_uri, pChunkSize=chunk_size, pThreads=threads,
+                                            pBinGroups=chrom_groups)
+        marginals = cis_row_sum - diagonal
     else:
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        # subtract from row sum, the diagonal
-        # to account for interactions with other bins
-        # and not only self interactions that are the dominant count
-        row_sum = row_sum - hic_ma.matrix.diagonal()
-        mad = MAD(row_sum)
-        to_remove = np.flatnonzero(mad.is_outlier(
-            lower_threshold, upper_threshold))
+        marginals = row_sum - diagonal
+    marginals[row_sum == 0] = np.nan
+    return marginals, chr_bin_ranges
+
+
+def filter_by_zscore(marginals, lower_threshold, upper_threshold, chr_bin_ranges=None):
+    """
+    Returns the bins whose marginals are outliers by the modified z-score.
+    With chr_bin_ranges the thresholds are defined per chromosome
+    to avoid introducing bias due to different chromosome numbers
+
+    :param marginals: contacts per bin, see matrix_marginals, NaN for masked bins
+    :param chr_bin_ranges: list of (chromosome, (start bin, end bin))
+    """
+    to_remove = []
+    for chrname, (chr_start, chr_end) in chr_bin_ranges or [(None, (0, len(marginals)))]:
+        bins = chr_start + np.flatnonzero(np.isfinite(marginals[chr_start:chr_end]))
+        mad = MAD(marginals[bins])
+        problematic = bins[mad.is_outlier(lower_threshold, upper_threshold)]
+
+        if chrname is not None and len(problematic) == 0:
+            log.warn("Warning. No bins removed for chromosome {} using thresholds {} {}"
+                     "\n".format(chrname, lower_threshold, upper_threshold))
+
+        to_remove.extend(problematic)
 
     return sorted(to_remove)
 
@@ -595,8 +1021,77 @@ def main(args=None):
     if args.verbose:
         log.setLevel(logging.INFO)
 
+    if 'inPlace' in args:
+        if args.inPlace:
+            if not check_cooler(args.matrix):
+                log.error('--inPlace requires a cool file.')
+                sys.exit(1)
+            if args.chromosomes:
+                log.error('--chromosomes is not supported together with --inPlace.')
+                sys.exit(1)
+        elif args.outFileName is None:
+            log.error('--outFileName is required if --inPlace is not set.')
+            sys.exit(1)
+        if args.startWeights and args.correctionMethod != 'ICE':
+            log.error('--startWeights is only supported for the ICE correction.')
+            sys.exit(1)
+        if args.singlePrecision and args.correctionMethod != 'ICE':
+            log.error('--singlePrecision is only supported for the ICE correction.')
+            sys.exit(1)
+
+        if '::' not in args.matrix and cooler.fileops.is_multires_file(args.matrix):
+            if not args.inPlace:
+                log.error('The weights of the resolutions of an mcool file can only be written in place, '
+                          'please use --inPlace.')
+                sys.exit(1)
+            if args.startWeights:
+                log.error('--startWeights is not supported for mcool files.')
+                sys.exit(1)
+            balance_resolutions(args)
+            return
+        elif args.resolutions or args.maskFromCoarsestResolution:
+            log.error('--resolutions and --maskFromCoarsestResolution require an mcool file.')
+            sys.exit(1)
+
+    result = correct_matrix(args)
+    if 'inPlace' in args and args.inPlace:
+        weights, history = result
+        write_weights(args.matrix, weights)
+        if history:
+            write_convergence_history(args.matrix, history)
+
+
+def correct_matrix(args, seed_masked_bins=None):
+    """
+    Runs the diagnostic plot or the correction of a single matrix.
+    seed_masked_bins are bins to be masked before the filtering.
+
+    :return: with --inPlace the weights and the convergence history
+    """
+    if 'chunkSize' in args and args.chunkSize is not None:
+        return iterative_correction_out_of_core(args, seed_masked_bins)
+
+    if 'plotName' in args and check_cooler(args.matrix):
+        # the diagnostic plot needs only the marginals, the matrix is not loaded
+        marginals, chr_bin_ranges = cooler_marginals(args.matrix, toString(args.chromosomes) if args.chromosomes else None,
+                                                     args.perchr)
+        plot_total_contact_dist(marginals, args, chr_bin_ranges)
+        log.info("Saving diagnostic plot {}\n".format(args.plotName))
+        return
+
     # args.chromosomes
-    if check_cooler(args.matrix) and args.chromosomes is not None and len(args.chromosomes) == 1:
+    if 'inPlace' in args and (args.inPlace or args.startWeights) and check_cooler(args.matrix):
+        # load the raw counts, the weights of the file are replaced
+        matrix_file_handler = MatrixFileHandler(pFileType='cool', pMatrixFile=args.matrix,
+                                                pApplyCorrectionCoolerLoad=False)
+        matrix, cut_intervals, nan_bins, _, _ = matrix_file_handler.load()
+        ma = hm.hiCMatrix()
+        ma.setMatrix(matrix, cut_intervals)
+        ma.nan_bins = nan_bins if nan_bins is not None else np.array([])
+        ma.fillLowerTriangle()
+        if args.chromosomes:
+            ma.reorderChromosomes(toString(args.chromosomes))
+    elif check_cooler(args.matrix) and args.chromosomes is not None and len(args.chromosomes) == 1:
         ma = hm.hiCMatrix(args.matrix, pChrnameList=toString(args.chromosomes))
     else:
         ma = hm.hiCMatrix(args.matrix)
@@ -604,6 +1099,17 @@ def main(args=None):
         if args.chromosomes:
             ma.reorderChromosomes(toString(args.chromosomes))
 
+    if 'startWeights' in args and args.startWeights:
+        # the start bias is kept in the correction factors, such that masking bins keeps it in sync
+        start_bias = read_start_bias(args.startWeights, toString(args.chromosomes) if args.chromosomes else None)
+        if len(start_bias) != ma.matrix.shape[0]:
+            log.error('The bins of --startWeights and --matrix differ.')
+            sys.exit(1)
+        ma.setCorrectionFactors(start_bias)
+
+    if seed_masked_bins is not None:
+        ma.maskBins(np.flatnonzero(seed_masked_bins))
+
     # mask all zero value bins
     if 'correctionMethod' in args:
         if args.correctionMethod == 'ICE':
@@ -619,7 +1125,10 @@ def main(args=None):
 
     ma.matrix = convertNansToZeros(ma.matrix)
     ma.matrix = convertInfsToZeros(ma.matrix)
-    ma.matrix = ma.matrix.astype(np.float64, copy=True)
+    if 'singlePrecision' in args and args.singlePrecision:
+        ma.matrix = ma.matrix.astype(np.float32, copy=True)
+    else:
+        ma.matrix = ma.matrix.astype(np.float64, copy=True)
 
     log.debug('ma.matrix.indices {}'.format(ma.matrix.indices.dtype))
     log.debug('ma.matrix.data {}'.format(ma.matrix.data.dtype))
@@ -633,7 +1142,7 @@ def main(args=None):
     # ma.matrix.indices = ma.matrix.indices.astype(np.int32, copy=False)
 
     if 'plotName' in args:
-        plot_total_contact_dist(ma, args)
+        plot_total_contact_dist(matrix_marginals(ma, args.perchr), args, chromosome_bin_ranges(ma))
         log.info("Saving diagnostic plot {}\n".format(args.plotName))
         return
 
@@ -650,7 +1159,8 @@ def main(args=None):
             log.error('min and max filtering thresholds should be set')
             sys.exit(1)
         outlier_regions = filter_by_zscore(
-            ma, args.filterThreshold[0], args.filterThreshold[1], perchr=args.perchr)
+            matrix_marginals(ma, args.perchr), args.filterThreshold[0], args.filterThreshold[1],
+            chromosome_bin_ranges(ma) if args.perchr else None)
         # compute and print some statistics
         pct_outlier = 100 * float(len(outlier_regions)) / ma.matrix.shape[0]
         ma.printchrtoremove(outlier_regions, label="Bins that are MAD outliers ({:.2f}%) "
@@ -688,45 +1198,51 @@ def main(args=None):
             ma.truncTrans(high=cutoff)
             pre_row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
 
-    correction_factors = []
-    corrected_matrix = lil_matrix(ma.matrix.shape)
+    if args.singlePrecision:
+        # restoring masked bins in hiCMatrix.maskBins returns a float64 matrix
+        ma.matrix = ma.matrix.astype(np.float32, copy=False)
+
+    is_h5_output = not args.inPlace and args.outFileName.endswith('.h5')
+    corrected_matrix = None
+    corrected_row_sum = None
+    history = []
+    start_bias = ma.correction_factors if args.startWeights else None
     if args.perchr:
-        # normalize each chromosome independently
-        for chrname in list(ma.interval_trees):
-            chr_range = ma.getChrBinRange(chrname)
-            chr_submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            if args.correctionMethod == 'ICE':
-                _matrix, _corr_factors = iterative_correction(
-                    chr_submatrix, args)
-                corrected_matrix[chr_range[0]:chr_range[1],
-                                 chr_range[0]:chr_range[1]] = _matrix
-                correction_factors.append(_corr_factors)
-            else:
-                # Set the kr matrix along with its correction factors vector
-                assert(args.correctionMethod == 'KR')
-                log.debug("Loading a float sparse matrix for KR balancing")
-                kr = kr_balancing(chr_submatrix.shape[0],
-                                  chr_submatrix.shape[1],
-                                  chr_submatrix.count_nonzero(),
-                                  chr_submatrix.indptr.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.indices.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.data.astype(np.float64, copy=False))
-                kr.computeKR()
-                if args.outFileName.endswith('.h5'):
-                    corrected_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = kr.get_normalised_matrix(True)
-                # correction_factors.append(np.true_divide(1,
-                #                                          kr.get_normalisation_vector(False).todense()))
-                correction_factors.append(
-                    kr.get_normalisation_vector(False).todense())
-
-        correction_factors = np.concatenate(correction_factors)
+        # normalize each chromosome independently, the largest chromosomes first
+        chr_ranges = sorted([ma.getChrBinRange(chrname) for chrname in list(ma.interval_trees)])
+        jobs = [(chr_range[0], chr_range[1], args.correctionMethod, args.iterNum, is_h5_output, args.verbose,
+                 start_bias[chr_range[0]:chr_range[1]] if start_bias is not None else None)
+                for chr_range in chr_ranges]
+        job_order = sorted(range(len(jobs)), key=lambda i: chr_ranges[i][0] - chr_ranges[i][1])
+        results = [None] * len(jobs)
+        if args.threads > 1 and len(jobs) > 1:
+            log.info("Balancing {} chromosomes with {} processes".format(len(jobs), args.threads))
+            with Pool(min(args.threads, len(jobs)), initializer=init_balancing_worker,
+                      initargs=share_csr_matrix(ma.matrix)) as pool:
+                for i, result in pool.imap_unordered(balance_chromosome_worker,
+                                                     [(i, jobs[i]) for i in job_order]):
+                    results[i] = result
+        else:
+            for i in job_order:
+                chr_start, chr_end = jobs[i][:2]
+                results[i] = balance_submatrix(ma.matrix[chr_start:chr_end, chr_start:chr_end], *jobs[i][2:])
+        if any(result is None for result in results):
+            exit(1)
+
+        correction_factors = np.concatenate([result[1] for result in results])
+        if args.correctionMethod == 'ICE':
+            corrected_row_sum = np.concatenate([result[2] for result in results])
+            # the maximal deviation over the chromosomes still corrected in each iteration
+            history = [max(result[3][i] for result in results if len(result[3]) > i)
+                       for i in range(max(len(result[3]) for result in results))]
+        if is_h5_output:
+            # the chromosomes are consecutive, the corrected matrix is block diagonal
+            corrected_matrix = block_diag([result[0] for result in results], format='csr')
 
     else:
         if args.correctionMethod == 'ICE':
             corrected_matrix, correction_factors = iterative_correction(
-                ma.matrix, args)
+                ma.matrix, args, start_bias=start_bias, history=history)
             ma.setMatrixValues(corrected_matrix)
         else:
             assert(args.correctionMethod == 'KR')
@@ -743,10 +1259,10 @@ def main(args=None):
             # correction_factors = np.true_divide(1, kr.get_normalisation_vector(False).todense())
             correction_factors = kr.get_normalisation_vector(True).todense()
 
-            if args.outFileName.endswith('.h5'):
+            if is_h5_output:
                 corrected_matrix = kr.get_normalised_matrix(True)
 
-    if args.outFileName.endswith('.h5'):
+    if is_h5_output:
         ma.setMatrixValues(corrected_matrix)
     # if
     ma.setCorrectionFactors(correction_factors)
@@ -754,7 +1270,10 @@ def main(args=None):
     log.debug("Correction factors {}".format(correction_factors[:10]))
     if args.inflationCutoff and args.inflationCutoff > 0 and args.correctionMethod == 'ICE':
 
-        after_row_sum = np.asarray(corrected_matrix.sum(axis=1)).flatten()
+        if corrected_row_sum is not None:
+            after_row_sum = corrected_row_sum
+        else:
+            after_row_sum = np.asarray(corrected_matrix.sum(axis=1)).flatten()
         # identify rows that were expanded more than args.inflationCutoff times
         to_remove = np.flatnonzero(
             after_row_sum / pre_row_sum >= args.inflationCutoff)
@@ -766,4 +1285,15 @@ def main(args=None):
     ma.printchrtoremove(sorted(list(total_filtered_out)),
                         label="Total regions to be removed", restore_masked_bins=False)
 
+    if args.inPlace:
+        # put the filtered bins back, their correction factors are nan
+        ma.restoreMaskedBins()
+        weights = np.array(ma.correction_factors, dtype=np.float64).flatten()
+        if args.correctionMethod == 'ICE':
+            # the ICE correction factors are divisive
+            weights = 1 / weights
+        return weights, history
+
     ma.save(args.outFileName, pApplyCorrection=False)
+    if history and check_cooler(args.outFileName):
+        write_convergence_history(args.outFileName, history)
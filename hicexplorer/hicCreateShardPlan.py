@@ -0,0 +1,146 @@
+import warnings
+warnings.simplefilter(action="ignore", category=RuntimeWarning)
+warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
+import argparse
+import numpy as np
+import logging
+log = logging.getLogger(__name__)
+
+from hicexplorer.hicBuildMatrix import BamPairReader, ReadPositionMatrix, ReadPositionBloomFilter, \
+    classify_read_pairs, save_shard_plan, BAM_READER_CHUNK_SIZE
+from hicexplorer._version import __version__
+
+
+def parse_arguments(args=None):
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False,
+        description="""
+Splits the two bam files of a Hi-C library into shards of consecutive read pairs, such that hicBuildMatrix
+can process the shards independently, e.g. on different machines. The shards are coordinated only
+via files: the shard plan created here, the partial matrices of the shards and the merged result.
+
+The two bam files are read once to find the file offsets of the first read pair of each shard. In the same pass
+the duplicated read pairs are identified with the same filters and the same duplication check as in hicBuildMatrix.
+Their indices are stored in the shard plan, such that the shards remove exactly the duplicates a single
+run of hicBuildMatrix would remove, independent of the shard the first occurrence of a read pair is in.
+Therefore the parameters --minMappingQuality, --skipDuplicationCheck and --duplicationCheckStrand need to be the
+same for hicCreateShardPlan and all hicBuildMatrix runs.
+
+Example usage:
+
+`$ hicCreateShardPlan -s R1.bam R2.bam --readPairsPerShard 50000000 -o shardPlan.npz`
+
+`$ hicBuildMatrix -s R1.bam R2.bam --shardPlan shardPlan.npz --shard 0 -o shard_0.cool --QCfolder QC_0 -bs 10000`
+
+`$ hicBuildMatrix --mergeShards shard_0.cool shard_1.cool shard_2.cool -o matrix.cool --QCfolder QC -bs 10000`
+""")
+
+    parserRequired = parser.add_argument_group('Required arguments')
+
+    parserRequired.add_argument('--samFiles', '-s',
+                                help='The two PE alignment sam files to process, as they are given to hicBuildMatrix.',
+                                metavar='two sam files',
+                                nargs=2,
+                                required=True)
+    parserRequired.add_argument('--outFileName', '-o',
+                                help='File name of the shard plan (npz format).',
+                                required=True)
+
+    parserOpt = parser.add_argument_group('Optional arguments')
+
+    parserOpt.add_argument('--readPairsPerShard', '-n',
+                           help='Number of read pairs per shard. The last shard contains the remaining read pairs '
+                           '(Default: %(default)s).',
+                           type=int,
+                           default=50000000)
+    parserOpt.add_argument('--minMappingQuality',
+                           help='Minimum mapping quality for reads to be accepted, see hicBuildMatrix '
+                           '(Default: %(default)s).',
+                           type=int,
+                           default=15)
+    parserOpt.add_argument('--skipDuplicationCheck',
+                           help='No duplicated read pairs are identified, see hicBuildMatrix.',
+                           action='store_true')
+    parserOpt.add_argument('--duplicationCheckStrand',
+                           help='The strands of the reads are part of the duplication check, see hicBuildMatrix.',
+                           action='store_true')
+    parserOpt.add_argument('--duplicationCheckMaxMemory',
+                           help='Upper memory limit in MB for the identification of duplicated read pairs, '
+                           'see hicBuildMatrix (Default: %(default)s).',
+                           type=int,
+                           default=None)
+    parserOpt.add_argument('--decompressionThreads',
+                           help='Number of threads used to decompress each of the two bam files '
+                           '(Default: %(default)s).',
+                           type=int,
+                           default=2)
+    parserOpt.add_argument('--help', '-h', action='help',
+                           help='show this help message and exit')
+
+    parserOpt.add_argument('--version', action='version',
+                           version='%(prog)s {}'.format(__version__))
+
+    return parser
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+
+    if args.readPairsPerShard < 1:
+        log.error('--readPairsPerShard needs to be a positive number.')
+        exit(1)
+    if args.duplicationCheckMaxMemory is not None:
+        if args.duplicationCheckMaxMemory <= 0:
+            log.error('--duplicationCheckMaxMemory needs to be a positive number of MB.')
+            exit(1)
+        read_pos_matrix = ReadPositionBloomFilter(args.duplicationCheckMaxMemory * 2**20,
+                                                  pUseStrand=args.duplicationCheckStrand)
+    else:
+        read_pos_matrix = ReadPositionMatrix(pUseStrand=args.duplicationCheckStrand)
+
+    bam_pair_reader = BamPairReader(args.samFiles, BAM_READER_CHUNK_SIZE, None, None,
+                                    pDecompressionThreads=args.decompressionThreads)
+    first_read_index = []
+    offsets = []
+    duplicated_read_indices = []
+    number_of_read_pairs = 0
+    while not bam_pair_reader.is_empty():
+        records1, records2 = bam_pair_reader.peek(BAM_READER_CHUNK_SIZE)
+        bam_pair_reader.consume(len(records1))
+        number_of_read_pairs += len(records1)
+
+        is_first = records1['read_index'] % args.readPairsPerShard == 0
+        first_read_index.append(records1['read_index'][is_first])
+        offsets.append(np.column_stack([records1['offset'][is_first], records2['offset'][is_first]]))
+
+        if not args.skipDuplicationCheck:
+            is_unmapped, is_not_unique, is_low_quality = classify_read_pairs(records1, records2, args.minMappingQuality)
+            is_candidate = ~is_unmapped & ~is_not_unique & ~is_low_quality
+            candidate_mate1 = records1[is_candidate]
+            candidate_mate2 = records2[is_candidate]
+            if len(candidate_mate1) > 0:
+                duplicated = read_pos_matrix.are_duplicated(candidate_mate1['reference_id'], candidate_mate1['pos'],
+                                                            candidate_mate2['reference_id'], candidate_mate2['pos'],
+                                                            candidate_mate1['is_reverse'], candidate_mate2['is_reverse'])
+                duplicated_read_indices.append(candidate_mate1['read_index'][duplicated])
+    bam_pair_reader.close()
+
+    if number_of_read_pairs == 0:
+        log.error('The sam files contain no read pairs.')
+        exit(1)
+    first_read_index = np.concatenate(first_read_index)
+    number_of_read_pairs_per_shard = np.diff(np.append(first_read_index, number_of_read_pairs))
+    duplicated_read_indices = np.concatenate(duplicated_read_indices) if duplicated_read_indices else np.zeros(0, dtype=np.int64)
+
+    parameters = dict(samFiles=args.samFiles,
+                      minMappingQuality=args.minMappingQuality,
+                      skipDuplicationCheck=args.skipDuplicationCheck,
+                      duplicationCheckStrand=args.duplicationCheckStrand,
+                      duplication_check_memory=read_pos_matrix.memory_usage(),
+                      duplication_check_false_positive_rate=read_pos_matrix.false_positive_rate())
+    save_shard_plan(args.outFileName, first_read_index, number_of_read_pairs_per_shard,
+                    np.concatenate(offsets), duplicated_read_indices, parameters)
+    log.info('{} read pairs are split into {} shards, {} read pairs '
+             'are duplicated.'.format(number_of_read_pairs, len(first_read_index), len(duplicated_read_indices)))
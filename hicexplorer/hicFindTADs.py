@@ -6,22 +6,32 @@ import os.path
 import logging
 import argparse
 import json
+import itertools
+import h5py
 from collections import OrderedDict
 from hicmatrix import HiCMatrix as hm
 from hicexplorer.utilities import enlarge_bins
 from scipy import sparse
+from scipy.stats import norm
 import numpy as np
 import multiprocessing
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes
+from hicexplorer.utilities import share_array, array_from_shared, share_csr_matrix, csr_matrix_from_shared
 
 from past.builtins import zip
 from past.builtins import map
 
 log = logging.getLogger(__name__)
 
-# this is a holder vor the
-hic_ma = None
+# the scores are computed in chunks of at least TASK_MIN_BINS bins, and
+# about TASKS_PER_PROCESSOR chunks per process for an even load
+TASK_MIN_BINS = 1000
+TASKS_PER_PROCESSOR = 8
+# the dense arrays of the band of a chunk hold at most about SCORE_TASK_VALUES values each
+SCORE_TASK_VALUES = 2**23
+# the boundary candidates are tested in chunks of about PVALUE_TASK_VALUES diamond values
+PVALUE_TASK_VALUES = 2**20
 
 
 def parse_arguments(args=None):
@@ -74,7 +84,9 @@ of information at certain bins, and depending on the parameters used with this t
                                 'but with extra information (p-value, delta). 6. <prefix>_score.bedgraph file '
                                 'contains the TAD-separation score '
                                 'measured at each Hi-C bin coordinate. Is useful to visualize in a genome '
-                                'browser. The delta and p-value settings are saved as part of the name.',
+                                'browser. The delta and p-value settings are saved as part of the name. '
+                                '7. <prefix>_tad_score.h5, the TAD-separation score of 1. in binary format '
+                                'together with the parameters used to compute it.',
                                 required=True)
 
     parserRequired.add_argument('--correctForMultipleTesting',
@@ -122,6 +134,12 @@ of information at certain bins, and depending on the parameters used with this t
                            'not be used.',
                            required=False)
 
+    parserOpt.add_argument('--skipTADscoreTextFile',
+                           help='Do not export the TAD-separation score as text bedgraph matrix <prefix>_tad_score.bm. '
+                           'The score is always saved as <prefix>_tad_score.h5, which is much faster to load with '
+                           '--TAD_sep_score_prefix. The .bm file is needed by hicPlotTADs.',
+                           action='store_true')
+
     parserOpt.add_argument('--thresholdComparisons',
                            help='P-value threshold for the Bonferroni correction / q-value for FDR. '
                            'The probability of a local minima to be a boundary '
@@ -130,25 +148,35 @@ of information at certain bins, and depending on the parameters used with this t
                            'regions (diamond) at the local minimum with the matrix z-scores for a '
                            'diamond at --minDepth to the left and a diamond --minDepth to the right. '
                            'If --correctForMultipleTesting is \'None\' the threshold is applied on the '
-                           'raw p-values without any multiple testing correction. Set it to \'1\' if no threshold should be used'
+                           'raw p-values without any multiple testing correction. Set it to \'1\' if no threshold should be used. '
+                           'Several values can be given to compute the boundaries for each of them, see --minBoundaryDistance'
                            ' (Default: %(default)s).',
                            type=float,
-                           default=0.01)
+                           nargs='+',
+                           default=[0.01])
 
     parserOpt.add_argument('--delta',
                            help='Minimum threshold of the difference between the TAD-separation score of a '
                            'putative boundary and the mean of the TAD-sep. score of surrounding bins. '
                            'The delta value reduces spurious boundaries that are shallow, which usually '
                            'occur at the center of large TADs when the TAD-sep. score is flat. Higher '
-                           'delta threshold values produce more conservative boundary estimations'
+                           'delta threshold values produce more conservative boundary estimations. '
+                           'Several values can be given to compute the boundaries for each of them, see --minBoundaryDistance'
                            ' (Default: %(default)s).',
                            type=float,
-                           default=0.01)
+                           nargs='+',
+                           default=[0.01])
 
     parserOpt.add_argument('--minBoundaryDistance',
                            help='Minimum distance between boundaries (in bp). This parameter can be '
-                           'used to reduce spurious boundaries caused by noise.',
-                           type=int)
+                           'used to reduce spurious boundaries caused by noise. If several values are given for '
+                           '--minBoundaryDistance, --delta or --thresholdComparisons, the boundaries are computed for '
+                           'each combination of them, reusing the TAD-separation score and the p-values of the '
+                           'boundary candidates. The files of each combination are saved with the prefix '
+                           '<outPrefix>_minBoundaryDistance<value>_delta<value>_thres<value>, containing only the '
+                           'parameters with several values.',
+                           type=int,
+                           nargs='+')
 
     parserOpt.add_argument('--chromosomes',
                            help='Chromosomes and order in which the '
@@ -169,10 +197,6 @@ of information at certain bins, and depending on the parameters used with this t
     return parser
 
 
-def compute_matrix_wrapper(args):
-    return compute_matrix(*args)
-
-
 def get_cut_weight_by_bin_id(matrix, cut, depth, return_mean=False):
     """
     like get_cut_weight which is the 'diamond' representing the counts
@@ -301,51 +325,319 @@ def get_incremental_step_size(min_win_size, max_win_size, start_step_len):
     return incremental_step
 
 
-def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
+def get_bins_at_positions(bin_starts, bin_ends, positions):
     """
-    Receives a number of bins for which the tad-score should be computed.
-    Parameters
-    ----------
-    hic_ma Hi-C matrix object
-    bins_list list of bins to process
-    min_win_size
-    max_win_size
-    step_len
-    Returns
-    -------
+    Vectorized getRegionBinRange(chrom, position, position + 1)[0] for the
+    sorted bins of a chromosome.
+    :param bin_starts: start positions of the bins of the chromosome
+    :param bin_ends: end positions of the bins of the chromosome
+    :param positions: array of positions
+    :return: the index of the bin containing each position, -1 if no bin contains it
     """
+    bin_idx = np.searchsorted(bin_ends, positions, side='right')
+    found = bin_idx < len(bin_ends)
+    found[found] = bin_starts[bin_idx[found]] <= positions[found]
+    return np.where(found, bin_idx, -1)
 
+
+def get_diamond_bins(bin_starts, bin_ends, cuts, window_len):
     """
-    :param hic_ma: Hi-C matrix object from HiCMatrix
-    :param outfile: String, path of a file to save the conductance
-                matrix in *bedgraph matrix* format
-    :return: (chrom, start, end, matrix)
+    Vectorized get_idx_of_bins_at_given_distance for the cuts of a chromosome.
+    :return: left and right bin indices, -1 if there is no bin at the given distance
     """
-    global hic_ma
-    positions_array = []
-    cond_matrix = []
-    incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
-    # if type(next(iter(self.interval_trees))) is np.bytes_:
-    #     chrname = toBytes(chrname)
-    # else:
-    #     chrname = toString(chrname)
-    # print("cut_intervals", hic_ma.cut_intervals)
-    for cut in bins_list:
-        chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
-        # get conductance
-        # for multiple window lengths at a time
-        mult_matrix = [get_cut_weight(hic_ma, cut, depth, return_mean=True) for depth in incremental_step]
-        if any(x is None or np.isnan(x) for x in mult_matrix):
-            # skip problematic cases
-            continue
+    left_start = np.maximum(0, bin_starts[cuts] - window_len)
+    right_end = np.minimum(bin_ends[-1], bin_ends[cuts] + window_len) - 1
+    return get_bins_at_positions(bin_starts, bin_ends, left_start), get_bins_at_positions(bin_starts, bin_ends, right_end)
+
+
+def diamond_sum_table(band, dtype=None):
+    """
+    Turns the upper band of a matrix into the cumulative sums needed to get the
+    sum of any diamond matrix[left:cut, cut:right] with a few array lookups.
+    :param band: dense array with band[i, k] = matrix[i, i + k]
+    :param dtype: type of the sums, the type of the band by default, e.g. to count a boolean band
+    :return: table, with table[j, t] the sum of matrix[j - t:j, :j] for t up to the
+             band width, and the cumulative sums of the rows of the band.
+    """
+    if dtype is None:
+        dtype = band.dtype
+    number_of_bins, band_width = band.shape
+    row_prefix_sums = np.zeros((number_of_bins, band_width + 1), dtype=dtype)
+    np.cumsum(band, axis=1, dtype=dtype, out=row_prefix_sums[:, 1:])
+    table = np.zeros((number_of_bins, band_width + 1), dtype=dtype)
+    for distance in range(1, band_width + 1):
+        table[distance:, distance] = row_prefix_sums[:number_of_bins - distance, distance]
+    np.cumsum(table, axis=1, out=table)
+    row_sums = np.zeros(number_of_bins + 1, dtype=dtype)
+    np.cumsum(row_prefix_sums[:, -1], out=row_sums[1:])
+    return table, row_sums
+
+
+def _upper_sums(table, row_sums, end, length):
+    """
+    Sums of matrix[end - length:end, :end], see diamond_sum_table.
+    """
+    band_width = table.shape[1] - 1
+    sums = table[end, np.minimum(length, band_width)]
+    beyond_band = length > band_width
+    if np.any(beyond_band):
+        # rows farther away than the band width contribute all their values
+        sums[beyond_band] += row_sums[end[beyond_band] - band_width] - row_sums[end[beyond_band] - length[beyond_band]]
+    return sums
+
+
+def diamond_sums(table, row_sums, left, cut, right):
+    """
+    Sums of the diamonds matrix[left:cut, cut:right] for arrays of bin indices.
+    """
+    return _upper_sums(table, row_sums, right, right - left) - _upper_sums(table, row_sums, right, right - cut) - \
+        _upper_sums(table, row_sums, cut, cut - left)
+
+
+def compute_diamond_means(matrix, bin_starts, bin_ends, first_bin, cuts, window_lengths):
+    """
+    Computes the TAD-separation score, the mean of the diamond matrix[left:cut, cut:right]
+    returned by get_cut_weight(..., return_mean=True), for the given cuts of a chromosome
+    and all window lengths at once. The band of the upper matrix around the cuts is
+    turned into cumulative sums once, see diamond_sum_table.
+
+    :param matrix: upper triangle band of the Hi-C matrix, in csr format
+    :param bin_starts: start positions of the bins of the chromosome
+    :param bin_ends: end positions of the bins of the chromosome
+    :param first_bin: index of the first bin of the chromosome in the matrix
+    :param cuts: sorted bin indices relative to first_bin
+    :param window_lengths: window lengths in bp
+    :return: array of shape (len(cuts), len(window_lengths)) with the means, NaN if a diamond
+             has no bins at the given distance or contains a non-finite value
+    """
+    cuts = np.asarray(cuts, dtype=np.int64)
+    left = np.empty((len(cuts), len(window_lengths)), dtype=np.int64)
+    right = np.empty((len(cuts), len(window_lengths)), dtype=np.int64)
+    for window_idx, window_len in enumerate(window_lengths):
+        left[:, window_idx], right[:, window_idx] = get_diamond_bins(bin_starts, bin_ends, cuts, window_len)
+    is_valid = (left >= 0) & (right >= 0)
+    cut = np.repeat(cuts[:, np.newaxis], len(window_lengths), axis=1)
+    left[~is_valid] = cut[~is_valid]
+    right[~is_valid] = cut[~is_valid]
+
+    # the rows and columns of the band needed for the diamonds of all cuts
+    start = left.min()
+    end = right.max() + 1
+    submatrix = matrix[first_bin + start:first_bin + end, first_bin + start:first_bin + end].tocoo()
+    distance = submatrix.col - submatrix.row
+    band_width = max(1, distance.max() + 1) if submatrix.nnz > 0 else 1
+    values = np.zeros((end - start, band_width), dtype=np.float64)
+    values[submatrix.row, distance] = submatrix.data
+    is_stored = np.zeros((end - start, band_width), dtype=np.bool_)
+    is_stored[submatrix.row, distance] = True
+    not_finite = ~np.isfinite(values)
+
+    left -= start
+    cut -= start
+    right -= start
+    # the mean is taken over all pixels of the diamond, it is 0 if the diamond has no values.
+    # The counts are at most the size of the band, which get_chunk_size keeps far below 2**31
+    number_of_values = diamond_sums(*diamond_sum_table(is_stored, np.int32), left, cut, right)
+    del is_stored
+    if np.any(not_finite):
+        values[not_finite] = 0
+        is_valid &= diamond_sums(*diamond_sum_table(not_finite, np.int32), left, cut, right) == 0
+    del not_finite
+    means = np.zeros(left.shape, dtype=np.float64)
+    has_values = number_of_values > 0
+    means[has_values] = diamond_sums(*diamond_sum_table(values), left, cut, right)[has_values] / \
+        ((cut - left) * (right - cut))[has_values]
+    means[~is_valid] = np.nan
+    return means
+
+
+def compute_matrix(matrix, bin_starts, bin_ends, task):
+    """
+    Computes the TAD-separation scores of a chunk of consecutive bins of one chromosome.
+
+    :param matrix: upper triangle band of the Hi-C matrix, in csr format
+    :param bin_starts: start positions of all bins of the matrix
+    :param bin_ends: end positions of all bins of the matrix
+    :param task: tuple (chr_first_bin, chr_last_bin, chunk_start, chunk_end, window_lengths) with the
+                 bin range of the chromosome and the bins of the chunk for which the scores are computed
+    :return: the bin ids of the chunk with valid scores and the matrix of the scores
+    """
+    chr_first_bin, chr_last_bin, chunk_start, chunk_end, window_lengths = task
+    cuts = np.arange(chunk_start, chunk_end) - chr_first_bin
+    mult_matrix = compute_diamond_means(matrix, bin_starts[chr_first_bin:chr_last_bin],
+                                        bin_ends[chr_first_bin:chr_last_bin], chr_first_bin, cuts, window_lengths)
+    # skip problematic cases
+    is_valid = ~np.isnan(mult_matrix).any(axis=1)
+    return chr_first_bin + cuts[is_valid], mult_matrix[is_valid]
 
-        cond_matrix.append(mult_matrix)
 
-        positions_array.append((chrom, chr_start, chr_end))
-    chrom, chr_start, chr_end = zip(*positions_array)
-    cond_matrix = np.vstack(cond_matrix)
+def diamond_values(band, row_index, left, cut, right):
+    """
+    Values of the diamonds matrix[left:cut, cut:right] for arrays of bin indices.
 
-    return chrom, chr_start, chr_end, cond_matrix
+    :param band: dense array with band[row_index[i], k] = matrix[i, i + k] for the rows i of the diamonds
+    :param row_index: row of the band for each row of the matrix
+    :return: the values of all diamonds, concatenated, and the index of the diamond of each value
+    """
+    number_of_rows = cut - left
+    number_of_cols = right - cut
+    sizes = number_of_rows * number_of_cols
+    diamond = np.repeat(np.arange(len(sizes)), sizes)
+    position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    rows = left[diamond] + position // number_of_cols[diamond]
+    cols = cut[diamond] + position % number_of_cols[diamond]
+    return band[row_index[rows], cols - rows], diamond
+
+
+def ranksums_pvalues(x, x_test, y, y_test, number_of_tests):
+    """
+    Two-sided p-values of the wilcoxon rank sum test, like scipy.stats.ranksums, for many
+    pairs of samples at once. The values of all samples are ranked by a single sort.
+
+    :param x: values of the first samples, concatenated
+    :param x_test: index of the test of each value of x
+    :param y: values of the second samples, concatenated
+    :param y_test: index of the test of each value of y
+    :param number_of_tests: number of tests
+    :return: array of p-values, NaN if a sample is empty or contains NaN
+    """
+    values = np.concatenate([x, y])
+    test = np.concatenate([x_test, y_test])
+    is_x = np.concatenate([np.ones(len(x), dtype=bool), np.zeros(len(y), dtype=bool)])
+    order = np.lexsort((values, test))
+    values = values[order]
+    test = test[order]
+    is_x = is_x[order]
+
+    n1 = np.bincount(x_test, minlength=number_of_tests)
+    n2 = np.bincount(y_test, minlength=number_of_tests)
+    test_start = np.cumsum(n1 + n2) - (n1 + n2)
+    position = (np.arange(len(values)) - test_start[test] + 1).astype(np.float64)
+    # tied values get the average of their positions
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = (values[1:] != values[:-1]) | (test[1:] != test[:-1])
+    group = np.cumsum(is_first) - 1
+    group_size = np.bincount(group)
+    rank = position[is_first][group] + (group_size[group] - 1) / 2
+
+    rank_sum = np.bincount(test[is_x], weights=rank[is_x], minlength=number_of_tests)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (rank_sum - n1 * (n1 + n2 + 1) / 2.0) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+        pvalues = 2 * norm.sf(np.abs(z))
+    pvalues[(n1 == 0) | (n2 == 0)] = np.nan
+    pvalues[np.bincount(test[np.isnan(values)], minlength=number_of_tests) > 0] = np.nan
+    return pvalues
+
+
+def compute_pvalues(matrix, bin_starts, bin_ends, task):
+    """
+    Compares the diamond at each boundary candidate with the diamonds window_len to the
+    left and to the right, using wilcoxon rank sum, for candidates of one chromosome.
+
+    :param matrix: the z-score matrix, in csr format
+    :param bin_starts: start positions of all bins of the matrix
+    :param bin_ends: end positions of all bins of the matrix
+    :param task: tuple (chr_first_bin, chr_last_bin, cuts, window_len) with the bin range of the
+                 chromosome and the bins of the candidates, relative to chr_first_bin
+    :return: array with the smaller of the two p-values of each candidate, NaN if a diamond is empty
+    """
+    chr_first_bin, chr_last_bin, cuts, window_len = task
+    bin_starts = bin_starts[chr_first_bin:chr_last_bin]
+    bin_ends = bin_ends[chr_first_bin:chr_last_bin]
+    number_of_candidates = len(cuts)
+    left_idx, right_idx = get_diamond_bins(bin_starts, bin_ends, cuts, window_len)
+
+    # the diamonds at the candidates, at left_idx and at right_idx
+    cut = np.concatenate([cuts, left_idx, right_idx])
+    is_valid = cut >= 0
+    cut[~is_valid] = 0
+    left, right = get_diamond_bins(bin_starts, bin_ends, cut, window_len)
+    is_valid &= (left >= 0) & (right >= 0)
+    left[~is_valid] = cut[~is_valid]
+    right[~is_valid] = cut[~is_valid]
+    is_empty = ((cut - left) * (right - cut) == 0).reshape(3, number_of_candidates).any(axis=0)
+
+    # dense band of the rows in any of the diamonds
+    row_changes = np.zeros(len(bin_starts) + 1, dtype=np.int64)
+    np.add.at(row_changes, left, 1)
+    np.add.at(row_changes, cut, -1)
+    rows = np.flatnonzero(np.cumsum(row_changes[:-1]) > 0)
+    row_index = np.full(len(bin_starts), -1, dtype=np.int64)
+    row_index[rows] = np.arange(len(rows))
+    band_width = max(1, (right - left).max())
+    band = np.zeros((len(rows), band_width), dtype=np.float64)
+    if len(rows) > 0:
+        submatrix = matrix[chr_first_bin + rows].tocoo()
+        distance = submatrix.col - chr_first_bin - rows[submatrix.row]
+        in_band = (distance >= 0) & (distance < band_width)
+        band[submatrix.row[in_band], distance[in_band]] = submatrix.data[in_band]
+
+    values, diamond = diamond_values(band, row_index, left, cut, right)
+    is_boundary = diamond < number_of_candidates
+    # test i compares candidate i with its left diamond, test number_of_candidates + i with its right one
+    boundary_values = values[is_boundary]
+    boundary_diamond = diamond[is_boundary]
+    pvalues = ranksums_pvalues(np.concatenate([boundary_values, boundary_values]),
+                               np.concatenate([boundary_diamond, boundary_diamond + number_of_candidates]),
+                               values[~is_boundary], diamond[~is_boundary] - number_of_candidates,
+                               2 * number_of_candidates)
+    pvalue_left = pvalues[:number_of_candidates]
+    pvalue_right = pvalues[number_of_candidates:]
+    # as min(pvalue_left, pvalue_right)
+    pvalues = np.where(pvalue_right < pvalue_left, pvalue_right, pvalue_left)
+    pvalues[is_empty] = np.nan
+    return pvalues
+
+
+def compute_pvalues_worker(task):
+    """
+    Computes the p-values of a task on the matrix shared by init_tad_score_worker.
+    """
+    return compute_pvalues(shared_matrix, shared_bin_starts, shared_bin_ends, task)
+
+
+def get_chunk_size(number_of_bins, num_processors, band_width):
+    """
+    Returns the number of bins per task for the TAD-separation scores. A few tasks per process
+    keep all processes busy until the end, and each task should be large compared to the band
+    of the matrix read around its bins. The dense band of a task, its bins and the windows on
+    both sides times the band width, holds at most about SCORE_TASK_VALUES values.
+
+    >>> get_chunk_size(5000, 1, 20)
+    1000
+    >>> get_chunk_size(250000, 4, 1000)
+    7388
+    """
+    chunk_size = max(TASK_MIN_BINS, int(np.ceil(number_of_bins / (num_processors * TASKS_PER_PROCESSOR))))
+    return min(chunk_size, max(1, SCORE_TASK_VALUES // band_width - band_width))
+
+
+def get_tasks(chr_bin_boundaries, window_lengths, chunk_size):
+    """
+    Splits the chromosomes into chunks of at most chunk_size bins. A chunk never
+    spans two chromosomes, such that the scores of each chunk can be computed
+    from the band of the matrix around the chunk.
+    """
+    tasks = []
+    for chr_first_bin, chr_last_bin in chr_bin_boundaries.values():
+        for chunk_start in range(chr_first_bin, chr_last_bin, chunk_size):
+            tasks.append((chr_first_bin, chr_last_bin, chunk_start, min(chunk_start + chunk_size, chr_last_bin),
+                          window_lengths))
+    return tasks
+
+
+def init_tad_score_worker(data, indices, indptr, shape, bin_starts, bin_ends):
+    global shared_matrix, shared_bin_starts, shared_bin_ends
+    shared_matrix = csr_matrix_from_shared(data, indices, indptr, shape)
+    shared_bin_starts = array_from_shared(bin_starts)
+    shared_bin_ends = array_from_shared(bin_ends)
+
+
+def compute_matrix_worker(task):
+    """
+    Computes the scores of a task on the matrix shared by init_tad_score_worker.
+    """
+    return compute_matrix(shared_matrix, shared_bin_starts, shared_bin_ends, task)
 
 
 class HicFindTads(object):
@@ -387,6 +679,11 @@ class HicFindTads(object):
         self.binsize = self.hic_ma.getBinSize()
         self.bedgraph_matrix = None
         self.boundaries = None
+        # the boundary candidates per lookahead and the p-values per window length and candidate,
+        # reused by find_boundaries for other values of delta and thresholdComparisons
+        self.minima_cache = {}
+        self.pvalue_cache = {}
+        self.cache_source = None
         self.set_variables()
         self.correct_for_multiple_testing = p_correct_for_multiple_testing
         self.threshold_comparisons = p_threshold_comparisons
@@ -855,12 +1152,7 @@ class HicFindTads(object):
         None
         """
         # get params to save as part of the bedgraph file
-        params = OrderedDict()
-        params['step'] = self.step
-        params['minDepth'] = self.min_depth
-        params['maxDepth'] = self.max_depth
-        params['binsize'] = self.binsize
-        params_str = json.dumps(params, separators=(',', ':'))
+        params_str = json.dumps(self.get_score_parameters(), separators=(',', ':'))
 
         with open(outfile, 'w') as f:
             f.write("#" + params_str + "\n")
@@ -1091,37 +1383,27 @@ class HicFindTads(object):
                                                                                               k=limit, format='csr')
         self.hic_ma.matrix.eliminate_zeros()
 
-        func = compute_matrix_wrapper
-        TASKS = []
-        bins_to_consider = []
-        # to speed up parallel computation the self.hic_ma (HiCMatrix object) is converted into a global object.
-        global hic_ma
-        hic_ma = self.hic_ma
-        for chrom in list(self.hic_ma.chrBinBoundaries):
-            bins_to_consider.extend(list(range(*self.hic_ma.chrBinBoundaries[chrom])))
-
-        for idx_array in np.array_split(bins_to_consider, self.num_processors):
-            TASKS.append((idx_array, self.min_depth, self.max_depth, self.step))
+        _, bin_starts, bin_ends, _ = zip(*self.hic_ma.cut_intervals)
+        bin_starts = np.array(bin_starts, dtype=np.int64)
+        bin_ends = np.array(bin_ends, dtype=np.int64)
+        chunk_size = get_chunk_size(self.hic_ma.matrix.shape[0], self.num_processors, limit)
+        tasks = get_tasks(self.hic_ma.chrBinBoundaries, incremental_step, chunk_size)
 
-        if self.num_processors > 1:
-            pool = multiprocessing.Pool(self.num_processors)
+        if self.num_processors > 1 and len(tasks) > 1:
             log.info("Using {} processors\n".format(self.num_processors))
-            res = pool.map_async(func, TASKS).get(9999999)
-            pool.close()
+            # the processes read the matrix from shared memory instead of receiving a copy with each task
+            with multiprocessing.Pool(min(self.num_processors, len(tasks)), initializer=init_tad_score_worker,
+                                      initargs=share_csr_matrix(self.hic_ma.matrix) +
+                                      [share_array(bin_starts), share_array(bin_ends)]) as pool:
+                res = list(pool.imap(compute_matrix_worker, tasks))
         else:
-            res = map(func, TASKS)
+            res = [compute_matrix(self.hic_ma.matrix, bin_starts, bin_ends, task) for task in tasks]
 
-        chrom = []
-        chr_start = []
-        chr_end = []
-        matrix = []
-        for _chrom, _chr_start, _chr_end, _matrix in res:
-            chrom.extend(toString(_chrom))
-            chr_start.extend(_chr_start)
-            chr_end.extend(_chr_end)
-            matrix.append(_matrix)
-
-        matrix = np.vstack(matrix)
+        bin_ids = np.concatenate([_bin_ids for _bin_ids, _ in res])
+        matrix = np.vstack([_matrix for _, _matrix in res])
+        chrom = [toString(self.hic_ma.cut_intervals[bin_id][0]) for bin_id in bin_ids]
+        chr_start = bin_starts[bin_ids]
+        chr_end = bin_ends[bin_ids]
 
         self.bedgraph_matrix = {'chrom': np.array(chrom),
                                 'chr_start': np.array(chr_start).astype(int),
@@ -1154,10 +1436,7 @@ class HicFindTads(object):
                     start_list.append(int(float(start)))
                     end_list.append(int(float(end)))
                     matrix.append(map(float, fields[3:]))
-        self.min_depth = parameters['minDepth']
-        self.max_depth = parameters['maxDepth']
-        self.step = parameters['step']
-        self.binsize = parameters['binsize']
+        self.set_score_parameters(parameters)
 
         matrix = np.vstack(matrix)
         self.bedgraph_matrix = {'chrom': np.array(chrom_list),
@@ -1165,6 +1444,148 @@ class HicFindTads(object):
                                 'chr_end': np.array(end_list).astype(int),
                                 'matrix': matrix}
 
+    def get_score_parameters(self):
+        """
+        Parameters of the TAD-separation score, saved together with the score.
+        """
+        params = OrderedDict()
+        params['step'] = self.step
+        params['minDepth'] = self.min_depth
+        params['maxDepth'] = self.max_depth
+        params['binsize'] = self.binsize
+        return params
+
+    def set_score_parameters(self, parameters):
+        self.min_depth = parameters['minDepth']
+        self.max_depth = parameters['maxDepth']
+        self.step = parameters['step']
+        self.binsize = parameters['binsize']
+
+    def save_tad_score_cache(self, outfile):
+        """
+        Saves the TAD-separation score in binary format (HDF5), as an alternative to the
+        text bedgraph matrix that is much faster to load, see load_tad_score_cache.
+        The rows of each chromosome are stored consecutively, with the row range of each
+        chromosome in 'chromosome_offsets', such that single chromosomes can be loaded.
+        The parameters used to compute the score are stored in the attribute 'parameters'.
+        """
+        chrom = self.bedgraph_matrix['chrom']
+        is_first_row = np.ones(len(chrom), dtype=bool)
+        is_first_row[1:] = chrom[1:] != chrom[:-1]
+        chromosome_names = [toString(name) for name in chrom[is_first_row]]
+        chromosome_offsets = np.append(np.flatnonzero(is_first_row), len(chrom))
+        with h5py.File(outfile, 'w') as h5file:
+            h5file.attrs['parameters'] = json.dumps(self.get_score_parameters(), separators=(',', ':'))
+            h5file.create_dataset('chromosome_names', data=chromosome_names, dtype=h5py.string_dtype())
+            h5file.create_dataset('chromosome_offsets', data=chromosome_offsets)
+            h5file.create_dataset('chr_start', data=self.bedgraph_matrix['chr_start'], compression='gzip', compression_opts=1)
+            h5file.create_dataset('chr_end', data=self.bedgraph_matrix['chr_end'], compression='gzip', compression_opts=1)
+            h5file.create_dataset('matrix', data=self.bedgraph_matrix['matrix'], compression='gzip', compression_opts=1)
+
+    def load_tad_score_cache(self, filename, pChromosomes=None):
+        """
+        Loads the TAD-separation score saved by save_tad_score_cache. If pChromosomes
+        is given, only the rows of these chromosomes are read.
+        """
+        with h5py.File(filename, 'r') as h5file:
+            self.set_score_parameters(json.loads(h5file.attrs['parameters']))
+            chromosome_names = h5file['chromosome_names'].asstr()[:]
+            chromosome_offsets = h5file['chromosome_offsets'][:]
+            chrom_list = []
+            start_list = []
+            end_list = []
+            matrix = []
+            for idx, chrom in enumerate(chromosome_names):
+                if pChromosomes is not None and chrom not in pChromosomes:
+                    continue
+                rows = slice(chromosome_offsets[idx], chromosome_offsets[idx + 1])
+                chrom_list.append(np.repeat(chrom, rows.stop - rows.start))
+                start_list.append(h5file['chr_start'][rows])
+                end_list.append(h5file['chr_end'][rows])
+                matrix.append(h5file['matrix'][rows])
+            if len(matrix) == 0:
+                log.error('The TAD-separation score file {} contains none of the chromosomes {}.'.format(filename, pChromosomes))
+                exit(1)
+
+        self.bedgraph_matrix = {'chrom': np.concatenate(chrom_list),
+                                'chr_start': np.concatenate(start_list).astype(int),
+                                'chr_end': np.concatenate(end_list).astype(int),
+                                'matrix': np.vstack(matrix)}
+
+    def load_tad_score(self, filename, pChromosomes=None):
+        """
+        Loads the TAD-separation score from the binary cache (.h5) or the text bedgraph matrix.
+        """
+        if filename.endswith('.h5'):
+            self.load_tad_score_cache(filename, pChromosomes)
+        else:
+            self.load_bedgraph_matrix(filename, pChromosomes)
+
+    def check_cache(self):
+        """
+        Clears the cached boundary candidates and p-values if the TAD-separation score or
+        the z-score matrix changed since they were computed.
+        """
+        if self.cache_source is None or self.cache_source[0] is not self.bedgraph_matrix or \
+                self.cache_source[1] is not self.hic_ma:
+            self.minima_cache = {}
+            self.pvalue_cache = {}
+            self.cache_source = (self.bedgraph_matrix, self.hic_ma)
+
+    def candidate_pvalues(self, candidates, window_len):
+        """
+        Compares the diamond at each boundary candidate, a row of the TAD-separation score,
+        with the diamonds window_len to the left and to the right using wilcoxon rank sum,
+        see compute_pvalues. The candidates are tested in batches per chromosome, in parallel
+        if several processors are given.
+        Returns the smaller of the two p-values per candidate, NaN if it can not be computed
+        and None if the candidate has no bin in the matrix.
+        """
+        chrom = self.bedgraph_matrix['chrom']
+        chr_start = self.bedgraph_matrix['chr_start']
+        chr_end = self.bedgraph_matrix['chr_end']
+        candidates = np.asarray(candidates, dtype=np.int64)
+        _, bin_starts, bin_ends, _ = zip(*self.hic_ma.cut_intervals)
+        bin_starts = np.array(bin_starts, dtype=np.int64)
+        bin_ends = np.array(bin_ends, dtype=np.int64)
+
+        # the number of candidates per task is limited by the number of diamond values
+        window_in_bins = window_len / np.median(bin_ends - bin_starts) + 1
+        candidates_per_task = max(1, int(PVALUE_TASK_VALUES / (4 * window_in_bins ** 2)))
+        tasks = []
+        task_candidates = []
+        for chrom_name in np.unique(chrom[candidates]):
+            chrom_candidates = candidates[chrom[candidates] == chrom_name]
+            if toString(chrom_name) not in self.hic_ma.chrBinBoundaries:
+                continue
+            chr_first_bin, chr_last_bin = self.hic_ma.chrBinBoundaries[toString(chrom_name)]
+            chr_bin_starts = bin_starts[chr_first_bin:chr_last_bin]
+            chr_bin_ends = bin_ends[chr_first_bin:chr_last_bin]
+            cuts = get_bins_at_positions(chr_bin_starts, chr_bin_ends, chr_start[chrom_candidates])
+            # as for getRegionBinRange, a bin has to contain the start and the end position
+            # of the candidate, which excludes the last bin of the chromosome
+            is_found = (cuts >= 0) & (get_bins_at_positions(chr_bin_starts, chr_bin_ends, chr_end[chrom_candidates]) >= 0)
+            chrom_candidates = chrom_candidates[is_found]
+            cuts = cuts[is_found]
+            assert np.array_equal(bin_starts[chr_first_bin + cuts], chr_start[chrom_candidates]) and \
+                np.array_equal(bin_ends[chr_first_bin + cuts], chr_end[chrom_candidates])
+            for task_start in range(0, len(cuts), candidates_per_task):
+                tasks.append((chr_first_bin, chr_last_bin, cuts[task_start:task_start + candidates_per_task], window_len))
+                task_candidates.append(chrom_candidates[task_start:task_start + candidates_per_task])
+
+        if self.num_processors > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(self.num_processors, len(tasks)), initializer=init_tad_score_worker,
+                                      initargs=share_csr_matrix(self.hic_ma.matrix) +
+                                      [share_array(bin_starts), share_array(bin_ends)]) as pool:
+                res = pool.imap(compute_pvalues_worker, tasks)
+                pvalues = dict(zip(np.concatenate(task_candidates), np.concatenate(list(res))))
+        elif len(tasks) > 0:
+            res = [compute_pvalues(self.hic_ma.matrix, bin_starts, bin_ends, task) for task in tasks]
+            pvalues = dict(zip(np.concatenate(task_candidates), np.concatenate(res)))
+        else:
+            pvalues = {}
+        return [pvalues.get(idx) for idx in candidates]
+
     def min_pvalue(self, min_idx):
         """
         For each putative local minima, find the -window_len diammond and the +window_len diamond
@@ -1177,54 +1598,17 @@ class HicFindTads(object):
         list of p-values per each local minima
         """
 
-        log.info("Computing p-values for window length: {}\n".format(self.min_depth))
-        pvalues = []
-        chrom = self.bedgraph_matrix['chrom']
-        chr_start = self.bedgraph_matrix['chr_start']
-        chr_end = self.bedgraph_matrix['chr_end']
+        self.check_cache()
         window_len = self.min_depth
+        new_candidates = [idx for idx in min_idx if (window_len, idx) not in self.pvalue_cache]
+        if len(new_candidates) > 0:
+            log.info("Computing p-values for window length: {}\n".format(window_len))
+        for idx, pvalue in zip(new_candidates, self.candidate_pvalues(new_candidates, window_len)):
+            self.pvalue_cache[(window_len, idx)] = pvalue
 
-        from scipy.stats import ranksums
-
-        new_min_idx = []
-        for idx in min_idx:
-
-            matrix_idx = self.hic_ma.getRegionBinRange(chrom[idx], chr_start[idx], chr_end[idx])
-            if matrix_idx is None:
-                continue
-            else:
-                matrix_idx = matrix_idx[0]
-
-            new_min_idx += [idx]
-            min_chr, min_start, min_end, _ = self.hic_ma.getBinPos(matrix_idx)
-            assert toString(chrom[idx]) == toString(min_chr) and chr_start[idx] == min_start and chr_end[idx] == min_end
-            left_idx, right_idx = get_idx_of_bins_at_given_distance(self.hic_ma, matrix_idx, window_len)
-
-            left = get_cut_weight(self.hic_ma, left_idx, window_len)
-            right = get_cut_weight(self.hic_ma, right_idx, window_len)
-            boundary = get_cut_weight(self.hic_ma, matrix_idx, window_len)
-
-            if left is None:
-                left = []
-            if right is None:
-                right = []
-
-            if len(left) == 0 and len(right) == 0:
-                pval = np.nan
-
-            elif boundary is None or len(boundary) == 0 or len(left) == 0 or len(right) == 0:
-                pval = np.nan
-
-            else:
-
-                try:
-                    pval1 = ranksums(boundary, left)[1]
-                    pval2 = ranksums(boundary, right)[1]
-                    pval = min(pval1, pval2)
-                except ValueError:
-                    # this condition happens when boundary, left and right are only composed of 'zeros'
-                    pval = np.nan
-            pvalues += [pval]
+        # candidates without a bin in the matrix have no p-value
+        new_min_idx = [idx for idx in min_idx if self.pvalue_cache[(window_len, idx)] is not None]
+        pvalues = [self.pvalue_cache[(window_len, idx)] for idx in new_min_idx]
 
         assert len(pvalues) == len(new_min_idx)
 
@@ -1261,8 +1645,14 @@ class HicFindTads(object):
         if lookahead < 1:
             raise ValueError("minBoundaryDistance must be '1' or above in value")
 
-        min_idx, delta = HicFindTads.find_consensus_minima(self.bedgraph_matrix['matrix'], lookahead=lookahead,
-                                                           chrom=self.bedgraph_matrix['chrom'])
+        self.check_cache()
+        if lookahead not in self.minima_cache:
+            self.minima_cache[lookahead] = HicFindTads.find_consensus_minima(self.bedgraph_matrix['matrix'],
+                                                                             lookahead=lookahead,
+                                                                             chrom=self.bedgraph_matrix['chrom'])
+        min_idx, delta = self.minima_cache[lookahead]
+        # save_domains_and_boundaries adds the chromosome ends to the deltas
+        delta = delta.copy()
 
         pvalues = self.min_pvalue(min_idx)
 
@@ -1307,13 +1697,25 @@ def print_args(args):
         log.info("{}:\t{}\n".format(key, value))
 
 
+def get_tad_score_file(prefix):
+    """
+    Returns the file with the TAD-separation score of the given prefix, the binary
+    <prefix>_tad_score.h5 or the text <prefix>_tad_score.bm, or None if none exists.
+    """
+    for ending in ['_tad_score.h5', '_tad_score.bm']:
+        if os.path.isfile(prefix + ending):
+            return prefix + ending
+    return None
+
+
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
+    min_boundary_distances = [None] if args.minBoundaryDistance is None else args.minBoundaryDistance
     ft = HicFindTads(args.matrix, num_processors=args.numberOfProcessors, max_depth=args.maxDepth,
-                     min_depth=args.minDepth, step=args.step, delta=args.delta,
-                     min_boundary_distance=args.minBoundaryDistance, use_zscore=True,
-                     p_correct_for_multiple_testing=args.correctForMultipleTesting, p_threshold_comparisons=args.thresholdComparisons,
+                     min_depth=args.minDepth, step=args.step, delta=args.delta[0],
+                     min_boundary_distance=min_boundary_distances[0], use_zscore=True,
+                     p_correct_for_multiple_testing=args.correctForMultipleTesting, p_threshold_comparisons=args.thresholdComparisons[0],
                      pChromosomes=args.chromosomes)
 
     matrix_ending = args.matrix.split('.')[-1]
@@ -1323,16 +1725,16 @@ def main(args=None):
             log.error("used input: {}, ending {}".format(args.matrix, matrix_ending))
 
             exit(1)
-    tad_score_file = args.outPrefix + "_tad_score.bm"
     zscore_matrix_file = args.outPrefix + "_zscore_matrix." + matrix_ending
+    tad_score_file = get_tad_score_file(args.outPrefix)
 
     if args.TAD_sep_score_prefix is not None:
-        tad_score_file = args.TAD_sep_score_prefix + "_tad_score.bm"
+        tad_score_file = get_tad_score_file(args.TAD_sep_score_prefix)
         zscore_matrix_file = args.TAD_sep_score_prefix + "_zscore_matrix." + matrix_ending
         # check that the given file exists
-        if not os.path.isfile(tad_score_file):
+        if tad_score_file is None:
             log.error("The given TAD_sep_score_prefix does not contain a valid TAD-separation score. Please check.\n"
-                      "Could not find file {}".format(tad_score_file))
+                      "Could not find file {0}_tad_score.h5 or {0}_tad_score.bm".format(args.TAD_sep_score_prefix))
             exit(1)
         if not os.path.isfile(zscore_matrix_file):
             log.error("The given TAD_sep_score_prefix does not contain a valid z-score matrix. Please check.\n"
@@ -1340,22 +1742,37 @@ def main(args=None):
             exit(1)
         log.info("\nUsing existing TAD-separation score file: {}\n".format(tad_score_file))
         ft.set_matrix(zscore_matrix_file, args.chromosomes)
-        ft.load_bedgraph_matrix(tad_score_file, args.chromosomes)
+        ft.load_tad_score(tad_score_file, args.chromosomes)
 
-    elif not os.path.isfile(tad_score_file):
+    elif tad_score_file is None:
         ft.compute_spectra_matrix()
         # save z-score matrix that is needed for find TADs algorithm
         ft.hic_ma.save(args.outPrefix + "_zscore_matrix." + matrix_ending)
-        ft.save_bedgraph_matrix(tad_score_file)
+        ft.save_tad_score_cache(args.outPrefix + "_tad_score.h5")
+        if not args.skipTADscoreTextFile:
+            ft.save_bedgraph_matrix(args.outPrefix + "_tad_score.bm")
     else:
         log.info("\nFound existing TAD-separation score file: {}\n".format(tad_score_file))
         log.info("This file will be used\n")
         ft.set_matrix(zscore_matrix_file, args.chromosomes)
         # ft.hic_ma = hm.hiCMatrix(zscore_matrix_file)
-        ft.load_bedgraph_matrix(tad_score_file, args.chromosomes)
-
-    ft.find_boundaries()
-    ft.save_domains_and_boundaries(args.outPrefix)
+        ft.load_tad_score(tad_score_file, args.chromosomes)
+
+    # the boundary candidates are computed once per minBoundaryDistance and
+    # their p-values once, independent of delta and thresholdComparisons
+    parameter_values = OrderedDict([('minBoundaryDistance', min_boundary_distances),
+                                    ('delta', args.delta),
+                                    ('thres', args.thresholdComparisons)])
+    for min_boundary_distance, delta, threshold_comparisons in itertools.product(*parameter_values.values()):
+        ft.min_boundary_distance = min_boundary_distance
+        ft.delta = delta
+        ft.threshold_comparisons = threshold_comparisons
+        prefix = args.outPrefix
+        for name, value in zip(parameter_values, [min_boundary_distance, delta, threshold_comparisons]):
+            if len(parameter_values[name]) > 1:
+                prefix += '_{}{}'.format(name, value)
+        ft.find_boundaries()
+        ft.save_domains_and_boundaries(prefix)
 
     # turn of hierarchical clustering which is apparently not working.
 
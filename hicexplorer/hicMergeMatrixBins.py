@@ -184,6 +184,38 @@ def running_window_merge(hic_matrix, num_bins):
     return hic_matrix
 
 
+def get_bins_to_merge(pChromNames, pNumBins):
+    """
+    Groups consecutive bins of the same chromosome into groups of pNumBins bins.
+    The last group of a chromosome is skipped if it has less than pNumBins / 2 bins,
+    except for the last chromosome.
+
+    Returns a list of tuples (first bin, last bin + 1)
+
+    >>> get_bins_to_merge(['a', 'a', 'a', 'a', 'a', 'b', 'c', 'c', 'c'], 2)
+    [(0, 2), (2, 4), (4, 5), (5, 6), (6, 8), (8, 9)]
+    >>> get_bins_to_merge(['a', 'a', 'a', 'b', 'c'], 3)
+    [(0, 3), (4, 5)]
+    """
+    groups = []
+    prev_ref = pChromNames[0]
+    idx_start = 0
+    count = 0
+    for idx, ref in enumerate(pChromNames):
+        if (count > 0 and count % pNumBins == 0) or ref != prev_ref:
+            if count < pNumBins / 2:
+                log.debug("{} has few bins ({}). Skipping it\n".format(prev_ref, count))
+            else:
+                groups.append((idx_start, idx))
+            idx_start = idx
+            count = 0
+
+        prev_ref = ref
+        count += 1
+    groups.append((idx_start, len(pChromNames)))
+    return groups
+
+
 def merge_bins(hic, num_bins):
     """
     Merge the bins using the specified number of bins. This
@@ -237,29 +269,12 @@ def merge_bins(hic, num_bins):
     ref_name_list, start_list, end_list, coverage_list = zip(*hic.cut_intervals)
     new_bins = []
     bins_to_merge = []
-    prev_ref = ref_name_list[0]
 
     # prepare new intervals
-    idx_start = 0
-    new_start = start_list[0]
-    count = 0
-    for idx, ref in enumerate(ref_name_list):
-        if (count > 0 and count % num_bins == 0) or ref != prev_ref:
-            if count < num_bins / 2:
-                log.debug("{} has few bins ({}). Skipping it\n".format(prev_ref, count))
-            else:
-                coverage = np.mean(coverage_list[idx_start:idx])
-                new_bins.append((ref_name_list[idx_start], new_start, end_list[idx - 1], coverage))
-                bins_to_merge.append(list(range(idx_start, idx)))
-            idx_start = idx
-            new_start = start_list[idx]
-            count = 0
-
-        prev_ref = ref
-        count += 1
-    coverage = np.mean(coverage_list[idx_start:])
-    new_bins.append((ref, new_start, end_list[idx], coverage))
-    bins_to_merge.append(list(range(idx_start, idx + 1)))
+    for idx_start, idx_end in get_bins_to_merge(ref_name_list, num_bins):
+        coverage = np.mean(coverage_list[idx_start:idx_end])
+        new_bins.append((ref_name_list[idx_start], start_list[idx_start], end_list[idx_end - 1], coverage))
+        bins_to_merge.append(list(range(idx_start, idx_end)))
 
     hic.matrix = reduce_matrix(hic.matrix, bins_to_merge, diagonal=True)
     hic.matrix.eliminate_zeros()
@@ -5,6 +5,7 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 import os
 import errno
+import json
 import matplotlib
 import pandas as pd
 matplotlib.use('Agg')
@@ -57,7 +58,7 @@ def parse_arguments():
     return parser
 
 
-def save_html(filename, unmap_table, discard_table, distance_table, orientation_table, all_table):
+def save_html(filename, unmap_table, discard_table, distance_table, orientation_table, all_table, performance_table=None):
     root = os.path.dirname(os.path.abspath(__file__))
 
     html = open(os.path.join(root, "qc_template.html"), "r")
@@ -75,11 +76,35 @@ def save_html(filename, unmap_table, discard_table, distance_table, orientation_
     all_table = all_table.drop(['Min rest. site distance', 'Max library insert size'], axis=1)
 
     html_content = html_content.replace("%%TABLE%%", all_table.style.render())
+
+    # the performance section is only shown if the statistics of hicBuildMatrix are available
+    if performance_table is not None:
+        html_content = html_content.replace("%%NAV_PERFORMANCE%%", '<h3><a href="#performance">Performance</a></h3>')
+        html_content = html_content.replace("%%PERFORMANCE%%", PERFORMANCE_HTML.replace(
+            "%%TABLE_PERFORMANCE%%", performance_table.style.format('{:,.2f}').render()))
+    else:
+        html_content = html_content.replace("%%NAV_PERFORMANCE%%", "")
+        html_content = html_content.replace("%%PERFORMANCE%%", "")
     with open(filename, 'w') as fh:
         fh.write(html_content)
     html.close()
 
 
+PERFORMANCE_HTML = """<h2 id="performance">Performance</h2>
+                    <img src="performance.png" alt="Performance" />
+
+                    <p>This figure contains the wall time of the stages of the main process of hicBuildMatrix.
+                    A large share of <i>waiting for workers</i> indicates that more <i>--threads</i> can speed up the run.
+                    <i>reading</i> is the time waiting for the decompression of the bam files, see <i>--decompressionThreads</i>,
+                    and <i>waiting for bam writer</i> the time waiting for the output bam file, see <i>--compressionThreads</i>.
+                    If <i>filtering</i> and <i>duplication check</i> dominate, the main process is the limit and additional
+                    threads are idle. The idle fractions of the other processes and the mean number of batches waiting
+                    for a worker are listed in the table.</p>
+
+                    %%TABLE_PERFORMANCE%%
+                    <a href="performance_table.txt">Download table (tab separated)</a>"""
+
+
 def make_sure_path_exists(path):
     try:
         os.makedirs(path)
@@ -223,6 +248,61 @@ def make_figure_read_orientation(table, filename, dpi):
                       u'Read pair type: left pairs', u'Read pair type: left pairs %', u'Read pair type: right pairs', u'Read pair type: right pairs %']]
 
 
+def read_performance_statistics(pLogFileName):
+    """
+    Returns the performance statistics hicBuildMatrix saves as 'performance.json'
+    next to the log file, None if the file does not exist.
+    """
+    performance_file_name = os.path.join(os.path.dirname(pLogFileName), 'performance.json')
+    if not os.path.exists(performance_file_name):
+        return None
+    with open(performance_file_name) as performance_file:
+        return json.load(performance_file)
+
+
+def make_figure_performance(pPerformanceStatistics, pLabels, filename, dpi):
+    """
+    Plots the wall time of the stages of the main process of hicBuildMatrix for each sample
+    and returns a table with the parameters, the throughput, the peak memory, the stage times,
+    the idle fraction of the other processes and the mean queue depths.
+    """
+    rows = []
+    stage_names = []
+    for statistics in pPerformanceStatistics:
+        row = {'Threads': statistics['parameters']['threads'],
+               'Input buffer size': statistics['parameters']['inputBufferSize'],
+               'Read pairs per second': statistics['read pairs per second'],
+               'Wall time (s)': statistics['wall time'],
+               'Peak memory all processes (MB)': statistics['peak rss (MB)']['all processes'],
+               'Peak memory main process (MB)': statistics['peak rss (MB)']['main process']}
+        for stage, times in statistics['stages'].items():
+            if stage not in stage_names:
+                stage_names.append(stage)
+            row[stage + ' (s)'] = times['wall time']
+        for process, times in statistics['processes'].items():
+            row[process + ' idle %'] = round(100 * times['idle fraction'], 2)
+        for queue, depth in statistics['queues'].items():
+            row[queue + ' queue mean'] = depth['mean']
+        rows.append(row)
+    table = pd.DataFrame(rows, index=pLabels).fillna(0)
+
+    stage_table = table[[stage + ' (s)' for stage in stage_names]]
+    stage_table.columns = stage_names
+    fig = plt.figure(figsize=(7, 1 + 0.5 * len(pLabels)))
+    ax = fig.add_subplot(111)
+    stage_table.plot(kind='barh', stacked=True, ax=ax)
+    handles, labels = ax.get_legend_handles_labels()
+    lgd = ax.legend(handles, labels, loc='center left',
+                    bbox_to_anchor=(1, 0.5))
+    ax.set_xlabel("wall time of the main process (s)")
+    ax.set_ylabel("")
+    plt.savefig(filename, bbox_extra_artists=(
+        lgd,), bbox_inches='tight', dpi=dpi)
+    plt.close()
+
+    return table
+
+
 def main(args=None):
     """
     The structure of the log file is as follows:
@@ -257,15 +337,25 @@ def main(args=None):
     Read pair type: outward pairs   9525    (26.06)
     Read pair type: left pairs      7012    (19.18)
     Read pair type: right pairs     7189    (19.67)
+
+    #       duplication check
+    Duplication check memory (MB)   1.00
+    Duplication check false positive rate   0
+
+    If hicBuildMatrix saved its performance statistics as 'performance.json'
+    next to a log file, they are added to the report.
     """
 
     args = parse_arguments().parse_args(args)
     mpl.rcParams['pdf.fonttype'] = 42
 
-    params = dict()
+    # one dictionary per log file, such that log files written by different
+    # hicBuildMatrix versions (i.e. with additional entries) can be combined
+    params = []
     make_sure_path_exists(args.outputFolder)
     for fh in args.logfiles:
         in_log_part = False
+        params.append(dict())
         log.debug('Processing {}\n'.format(fh.name))
         for line in fh.readlines():
             if line.startswith("File"):
@@ -276,13 +366,14 @@ def main(args=None):
                 fields = line.strip().split("\t")
                 if len(fields) == 1:
                     continue
-                if fields[0] not in params:
-                    params[fields[0]] = []
-
                 try:
-                    params[fields[0]].append(int(fields[1]))
+                    params[-1][fields[0]] = int(fields[1])
                 except ValueError:
-                    params[fields[0]].append(fields[1])
+                    try:
+                        # e.g. the memory of the duplication check
+                        params[-1][fields[0]] = float(fields[1])
+                    except ValueError:
+                        params[-1][fields[0]] = fields[1]
 
     log.debug('params {}'.format(params))
     table = pd.DataFrame(params)
@@ -322,8 +413,17 @@ def main(args=None):
 
     log.debug('table {}'.format(list(table.columns)))
 
+    performance_statistics = [read_performance_statistics(fh.name) for fh in args.logfiles]
+    performance_table = None
+    if any(statistics is not None for statistics in performance_statistics):
+        performance_table = make_figure_performance(
+            [statistics for statistics in performance_statistics if statistics is not None],
+            [label for label, statistics in zip(table.index, performance_statistics) if statistics is not None],
+            args.outputFolder + "/performance.png", args.dpi)
+        performance_table.to_csv(args.outputFolder + "/performance_table.txt", sep="\t")
+
     save_html(args.outputFolder + "/hicQC.html", unmap_table, discarded_table, distance_table,
-              read_orientation_table, table)
+              read_orientation_table, table, performance_table)
 
     unmap_table.to_csv(args.outputFolder + "/unmapable_table.txt", sep="\t")
     discarded_table.to_csv(args.outputFolder +
@@ -3,11 +3,51 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import numpy as np
 import time
+from multiprocessing import Pool
+import cooler
 import logging
 log = logging.getLogger(__name__)
 
 
-def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
+def startBias(pBias, pNumberOfBins):
+    """
+    Returns a copy of the given bias vector to start an iterative correction with.
+    Bins without a positive, finite bias start with 1. Without a bias all bins start with 1.
+    """
+    total_bias = np.ones(pNumberOfBins, 'float64')
+    if pBias is not None:
+        pBias = np.asarray(pBias, dtype=np.float64).flatten()
+        if len(pBias) != pNumberOfBins:
+            raise ValueError("The start bias has {} values, but the matrix has {} bins.".format(len(pBias), pNumberOfBins))
+        valid = np.isfinite(pBias) & (pBias > 0)
+        total_bias[valid] = pBias[valid]
+    return total_bias
+
+
+def _rowSums(W, pIndptr=None, pChunkSize=2**22):
+    """
+    Row sums of a coo matrix. If the row pointers of the rows of W are given,
+    i.e. W is sorted by row, the sums are accumulated in double precision
+    in chunks of about pChunkSize values. This keeps the deviation of the
+    marginals of a single precision matrix as exact as in double precision.
+    """
+    if pIndptr is None:
+        return np.array(W.sum(axis=1)).flatten()
+    row_sums = np.zeros(W.shape[0], dtype=np.float64)
+    non_empty_rows = np.flatnonzero(np.diff(pIndptr))
+    row_starts = pIndptr[non_empty_rows]
+    chunk_boundaries = np.unique(np.append(np.searchsorted(row_starts, np.arange(0, W.nnz, pChunkSize)),
+                                           len(row_starts)))
+    for first_row, last_row in zip(chunk_boundaries[:-1], chunk_boundaries[1:]):
+        chunk_start = row_starts[first_row]
+        chunk_end = pIndptr[non_empty_rows[last_row - 1] + 1]
+        row_sums[non_empty_rows[first_row:last_row]] = np.add.reduceat(W.data[chunk_start:chunk_end],
+                                                                       row_starts[first_row:last_row] - chunk_start,
+                                                                       dtype=np.float64)
+    return row_sums
+
+
+def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False, history=None, dtype=np.float64):
     """
     adapted from cytonised version in mirnylab
     original code from: ultracorrectSymmetricWithVector
@@ -17,36 +57,57 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
     Possibly excludes diagonal.
     By default does iterative correction, but can perform an M-time correction
     :param matrix: a scipy sparse matrix
+    :param v: bias vector to start with, e.g. the bias of a previous correction
+              of a similar matrix. After small changes of the matrix, the
+              correction then converges in a few iterations.
     :param tolerance: Tolerance is the maximum allowed relative
                       deviation of the marginals.
+    :param history: if a list is given, the maximal deviation of the marginals
+                    of each iteration is appended to it.
+    :param dtype: float type of the corrected matrix. With np.float32 the matrix
+                  needs half the memory; the marginals and the bias are still
+                  computed in double precision.
     """
     if verbose:
         log.setLevel(logging.INFO)
 
-    total_bias = np.ones(matrix.shape[0], 'float64')
+    total_bias = startBias(v, matrix.shape[0])
 
     if np.isnan(matrix.sum()):
         log.warn("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
         matrix.data[np.isnan(matrix.data)] = 0
 
-    matrix = matrix.astype(float)
+    matrix = matrix.astype(dtype)
+    indptr = None
+    if matrix.dtype != np.float64:
+        # the coo matrix of a csr matrix is sorted by row, its marginals
+        # are summed up in double precision
+        matrix = matrix.tocsr()
+        indptr = matrix.indptr
     W = matrix.tocoo()
 
     if np.abs(matrix - matrix.T).mean() / (1. * np.abs(matrix.mean())) > 1e-10:
         raise ValueError("Please provide symmetric matrix!")
 
+    if v is not None:
+        # start with the matrix corrected by the given bias
+        W.data /= np.take(total_bias.astype(W.dtype, copy=False), W.row)
+        W.data /= np.take(total_bias.astype(W.dtype, copy=False), W.col)
+
     start_time = time.time()
     log.info("starting iterative correction")
     for iternum in range(M):
         iternum += 1
-        s = np.array(W.sum(axis=1)).flatten()
+        s = _rowSums(W, indptr)
         mask = (s == 0)
         s = s / np.mean(s[~mask])
 
         total_bias *= s
         deviation = np.abs(s - 1).max()
+        if history is not None:
+            history.append(deviation)
 
-        s = 1.0 / s
+        s = (1.0 / s).astype(W.dtype, copy=False)
 
         # The following code  is an optimization of this
         # for i in range(N):
@@ -76,7 +137,8 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
     # scale the total bias such that the sum is 1.0
     corr = total_bias[total_bias != 0].mean()
     total_bias /= corr
-    W.data = W.data * corr * corr
+    W.data *= corr
+    W.data *= corr
     if np.any(W.data > 1e10):
         log.error("*Error* matrix correction produced extremely large values. "
                   "This is often caused by bins of low counts. Use a more stringent "
@@ -84,3 +146,161 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
         exit(1)
 
     return W.tocsr(), total_bias
+
+
+def _coolerMarginalsWorker(pArgs):
+    """
+    Computes the row sums of the pixels pStart to pEnd of a cooler file, one chunk of
+    pChunkSize pixels at a time. The pixels are scaled by the given weights, and both
+    triangles of the symmetric matrix are accounted for.
+    """
+    cooler_uri, start, end, chunk_size, weights, skip_diagonal, bin_groups = pArgs
+    cooler_file = cooler.Cooler(cooler_uri)
+    number_of_bins = cooler_file.info['nbins']
+    marginals = np.zeros(number_of_bins, dtype=np.float64)
+    diagonal = np.zeros(number_of_bins, dtype=np.float64)
+    max_value = 0.0
+    with cooler_file.open('r') as h5_group:
+        pixels = h5_group['pixels']
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            bin1_id = pixels['bin1_id'][chunk_start:chunk_end]
+            bin2_id = pixels['bin2_id'][chunk_start:chunk_end]
+            values = pixels['count'][chunk_start:chunk_end].astype(np.float64)
+            values[~np.isfinite(values)] = 0
+            if weights is not None:
+                values *= weights[bin1_id]
+                values *= weights[bin2_id]
+            is_diagonal = bin1_id == bin2_id
+            if skip_diagonal:
+                values[is_diagonal] = 0
+            if bin_groups is not None:
+                values[(bin_groups[bin1_id] != bin_groups[bin2_id]) | (bin_groups[bin1_id] < 0)] = 0
+            if len(values) > 0:
+                max_value = max(max_value, values.max())
+            marginals += np.bincount(bin1_id, weights=values, minlength=number_of_bins)
+            off_diagonal = ~is_diagonal
+            marginals += np.bincount(bin2_id[off_diagonal], weights=values[off_diagonal], minlength=number_of_bins)
+            diagonal += np.bincount(bin1_id[is_diagonal], weights=values[is_diagonal], minlength=number_of_bins)
+    return marginals, diagonal, max_value
+
+
+def coolerMarginals(pCoolerUri, pWeights=None, pChunkSize=10000000, pSkipDiagonal=False, pThreads=1, pPool=None,
+                    pBinGroups=None):
+    """
+    Computes the row sums of the symmetric matrix stored in a cooler file
+    without loading the matrix into memory. The pixel table is streamed in chunks
+    of pChunkSize pixels. With pThreads > 1 the pixel table is split into pThreads
+    consecutive parts whose row sums are computed in parallel, by the processes of
+    pPool or of a new pool, and added up.
+
+    :param pCoolerUri: the cooler file, e.g. matrix.cool or matrix.mcool::/resolutions/10000
+    :param pWeights: if given, the pixel (i, j) is multiplied with pWeights[i] * pWeights[j]
+    :param pSkipDiagonal: if set, the pixels on the main diagonal are ignored
+    :param pBinGroups: if given, only the pixels (i, j) with pBinGroups[i] == pBinGroups[j] >= 0
+        are counted, e.g. the chromosome of each bin for the contacts within chromosomes
+
+    :return: the row sums, the sums of the main diagonal pixels and the maximal pixel value
+    """
+    number_of_pixels = cooler.Cooler(pCoolerUri).info['nnz']
+    number_of_parts = max(1, min(pThreads, -(-number_of_pixels // pChunkSize)))
+    # split the pixel table at chunk boundaries into one part per process
+    part_boundaries = np.linspace(0, -(-number_of_pixels // pChunkSize), number_of_parts + 1).astype(np.int64) * pChunkSize
+    part_boundaries[-1] = number_of_pixels
+    tasks = [(pCoolerUri, part_boundaries[i], part_boundaries[i + 1], pChunkSize, pWeights, pSkipDiagonal, pBinGroups)
+             for i in range(number_of_parts)]
+    if number_of_parts == 1:
+        results = [_coolerMarginalsWorker(tasks[0])]
+    elif pPool is not None:
+        results = pPool.map(_coolerMarginalsWorker, tasks)
+    else:
+        with Pool(number_of_parts) as pool:
+            results = pool.map(_coolerMarginalsWorker, tasks)
+
+    marginals = np.sum([result[0] for result in results], axis=0)
+    diagonal = np.sum([result[1] for result in results], axis=0)
+    max_value = max(result[2] for result in results)
+    return marginals, diagonal, max_value
+
+
+def iterativeCorrectionCooler(pCoolerUri, pMaskedBins=None, pChunkSize=10000000, pThreads=1, pSkipDiagonal=False,
+                              pStartBias=None, M=50, tolerance=1e-5, verbose=False, pHistory=None):
+    """
+    Out-of-core version of iterativeCorrection for matrices stored in a cooler file.
+    Instead of holding the matrix in memory, each iteration streams the pixel table
+    in chunks to compute the marginals of the matrix corrected with the current
+    bias vector. Only the bias vector and the pixels of the current chunks are held in memory.
+    The computed bias is the same as the one of iterativeCorrection for the matrix
+    without the masked bins.
+
+    :param pCoolerUri: the cooler file, e.g. matrix.cool or matrix.mcool::/resolutions/10000
+    :param pMaskedBins: boolean array, True for the bins excluded from the correction
+    :param pChunkSize: number of pixels read at once
+    :param pThreads: number of processes computing the marginals of the chunks
+    :param pSkipDiagonal: if set, the pixels on the main diagonal are ignored
+    :param pStartBias: bias vector to start with, see iterativeCorrection
+    :param pHistory: if a list is given, the maximal deviation of the marginals
+                     of each iteration is appended to it.
+
+    :return: the bias vector, nan for the masked bins. The corrected matrix is
+             given by matrix[i, j] / (bias[i] * bias[j]).
+    """
+    if verbose:
+        log.setLevel(logging.INFO)
+
+    cooler_file = cooler.Cooler(pCoolerUri)
+    if cooler_file.storage_mode != 'symmetric-upper':
+        raise ValueError("Please provide symmetric matrix!")
+
+    number_of_bins = cooler_file.info['nbins']
+    if pMaskedBins is None:
+        pMaskedBins = np.zeros(number_of_bins, dtype=bool)
+    total_bias = startBias(pStartBias, number_of_bins)
+    total_bias[pMaskedBins] = 0
+
+    pool = Pool(pThreads) if pThreads > 1 else None
+    try:
+        start_time = time.time()
+        log.info("starting iterative correction")
+        for iternum in range(M):
+            iternum += 1
+            weights = np.zeros(number_of_bins, dtype=np.float64)
+            weights[total_bias != 0] = 1.0 / total_bias[total_bias != 0]
+            s, _, max_value = coolerMarginals(pCoolerUri, pWeights=weights, pChunkSize=pChunkSize,
+                                              pSkipDiagonal=pSkipDiagonal, pThreads=pThreads, pPool=pool)
+            if max_value > 1e100:
+                log.error("*Error* matrix correction is producing extremely large values. "
+                          "This is often caused by bins of low counts. Use a more stringent "
+                          "filtering of bins.")
+                exit(1)
+            mask = (s == 0)
+            s = s / np.mean(s[~mask])
+
+            total_bias *= s
+            deviation = np.abs(s[~pMaskedBins] - 1).max()
+            if pHistory is not None:
+                pHistory.append(deviation)
+
+            if verbose:
+                if iternum % 5 == 0:
+                    end_time = time.time()
+                    estimated = (float(M - iternum) * (end_time - start_time)) / iternum
+                    m, sec = divmod(estimated, 60)
+                    h, m = divmod(m, 60)
+                    log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
+                    log.info("max delta - 1 = {} ".format(deviation))
+
+            if deviation < tolerance:
+                log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # scale the total bias such that the sum is 1.0
+    corr = total_bias[total_bias != 0].mean()
+    total_bias /= corr
+    total_bias[pMaskedBins] = np.nan
+
+    return total_bias
@@ -36,6 +36,7 @@ The following is the list of tools:
 
 findRestSite                 Identifies the genomic locations of restriction sites
 hicBuildMatrix               Creates a Hi-C matrix using the aligned BAM files of the Hi-C sequencing reads
+hicCreateShardPlan           Splits the BAM files of a Hi-C library into shards that hicBuildMatrix can process independently
 hicQuickQC                   Estimates the quality of Hi-C dataset
 hicQC                        Plots QC measures from the output of hicBuildMatrix
 hicCorrectMatrix             Uses iterative correction to remove biases from a Hi-C matrix
@@ -6,9 +6,12 @@ from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile, mkdtemp
 import shutil
 import os
+import json
+import numpy as np
 import numpy.testing as nt
+import pandas as pd
 import pytest
-from hicexplorer.test.test_compute_function import compute
+from hicexplorer.test.test_compute_function import compute, qc_files
 
 ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
 sam_R1 = ROOT + "small_test_R1_unsorted.bam"
@@ -53,9 +56,12 @@ def test_build_matrix(capsys):
     nt.assert_equal(test.matrix.data, new.matrix.data)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
     # print("MATRIX NAME:", outfile.name)
-    print(set(os.listdir(ROOT + "QC/")))
+    print(qc_files(ROOT + "QC/"))
     assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC/") == qc_files(qc_folder)
+    # are_files_equal stops at the end of the shorter file
+    with open(ROOT + "QC/QC.log") as test_log, open(qc_folder + "/QC.log") as new_log:
+        assert test_log.readlines()[-3:] == new_log.readlines()[-3:]
 
     # accept delta of 60 kb, file size is around 4.5 MB
     assert abs(os.path.getsize(ROOT + "small_test_matrix_result.bam") - os.path.getsize(outfile_bam.name)) < 64000
@@ -82,9 +88,9 @@ def test_build_matrix_restriction_enzyme(capsys):
     nt.assert_equal(test.matrix.data, new.matrix.data)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
     # print("MATRIX NAME:", outfile.name)
-    print(set(os.listdir(ROOT + "QC_multi_restriction/")))
+    print(qc_files(ROOT + "QC_multi_restriction/"))
     assert are_files_equal(ROOT + "QC_multi_restriction/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC_multi_restriction/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC_multi_restriction/") == qc_files(qc_folder)
 
     # accept delta of 60 kb, file size is around 4.5 MB
     assert abs(os.path.getsize(ROOT + "small_test_matrix_result.bam") - os.path.getsize(outfile_bam.name)) < 64000
@@ -115,9 +121,9 @@ def test_build_matrix_restriction_enzyme_region(capsys):
     nt.assert_equal(len(test.cut_intervals), len(new.cut_intervals))
 
     # print("MATRIX NAME:", outfile.name)
-    print(set(os.listdir(ROOT + "QC_region/")))
+    print(qc_files(ROOT + "QC_region/"))
     assert are_files_equal(ROOT + "QC_region/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC_region/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC_region/") == qc_files(qc_folder)
 
     # accept delta of 60 kb, file size is around 4.5 MB
     assert abs(os.path.getsize(ROOT + "build_region.bam") - os.path.getsize(outfile_bam.name)) < 64000
@@ -144,9 +150,9 @@ def test_build_matrix_chromosome_sizes(capsys):
     nt.assert_equal(test.matrix.data, new.matrix.data)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
     # print("MATRIX NAME:", outfile.name)
-    print(set(os.listdir(ROOT + "QC/")))
+    print(qc_files(ROOT + "QC/"))
     assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC/") == qc_files(qc_folder)
 
     # accept delta of 60 kb, file size is around 4.5 MB
     assert abs(os.path.getsize(ROOT + "hicBuildMatrix/chromosome_sizes/test.bam") - os.path.getsize(outfile_bam.name)) < 64000
@@ -183,9 +189,9 @@ def test_build_matrix_cooler():
         cut_interval_test_.append(x[:3])
 
     nt.assert_equal(cut_interval_new_, cut_interval_test_)
-    # print(set(os.listdir(ROOT + "QC/")))
+    # print(qc_files(ROOT + "QC/"))
     assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC/") == qc_files(qc_folder)
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
@@ -218,9 +224,9 @@ def test_build_matrix_cooler_metadata():
         cut_interval_test_.append(x[:3])
 
     nt.assert_equal(cut_interval_new_, cut_interval_test_)
-    # print(set(os.listdir(ROOT + "QC/")))
+    # print(qc_files(ROOT + "QC/"))
     assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC/") == qc_files(qc_folder)
 
     outfile_metadata = NamedTemporaryFile(suffix='.txt', delete=False)
     outfile_metadata.close()
@@ -288,9 +294,9 @@ def test_build_matrix_cooler_multiple():
         cut_interval_test_.append(x[:3])
 
     nt.assert_equal(cut_interval_new_, cut_interval_test_)
-    # print(set(os.listdir(ROOT + "QC/")))
+    # print(qc_files(ROOT + "QC/"))
     assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC/") == qc_files(qc_folder)
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
@@ -316,9 +322,9 @@ def test_build_matrix_rf():
     nt.assert_equal(test.matrix.data, new.matrix.data)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
-    print(set(os.listdir(ROOT + "QC_rc/")))
+    print(qc_files(ROOT + "QC_rc/"))
     assert are_files_equal(ROOT + "QC_rc/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC_rc/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC_rc/") == qc_files(qc_folder)
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
@@ -345,9 +351,9 @@ def test_build_matrix_rf_multi():
     nt.assert_equal(test.matrix.data, new.matrix.data)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
-    print(set(os.listdir(ROOT + "QC_rc_multiple/")))
+    print(qc_files(ROOT + "QC_rc_multiple/"))
     assert are_files_equal(ROOT + "QC_rc_multiple/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "QC_rc_multiple/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "QC_rc_multiple/") == qc_files(qc_folder)
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
@@ -365,3 +371,107 @@ def test_build_matrix_fail(capsys):
                                                                                         qc_folder).split()
     # hicBuildMatrix.main(args)
     compute(hicBuildMatrix.main, args, 5)
+
+
+def test_build_matrix_pairs_file():
+    outfile = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    pairs_file = NamedTemporaryFile(suffix='.pairs', delete=False, mode='w')
+    pairs_file.write("## pairs format v1.0\n"
+                     "#chromsize: chr1 10000\n"
+                     "#chromsize: chr2 5000\n"
+                     "#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2 pair_type mapq1 mapq2\n"
+                     "r1\tchr1\t1500\tchr1\t5500\t+\t-\tUU\t60\t60\n"
+                     "r2\tchr1\t1500\tchr1\t5500\t+\t-\tUU\t60\t60\n"
+                     "r3\tchr1\t2500\tchr2\t3500\t+\t+\tUU\t60\t60\n"
+                     "r4\t!\t0\tchr2\t3500\t-\t+\tNU\t0\t60\n"
+                     "r5\tchr1\t2500\tchr2\t3500\t+\t+\tUU\t60\t5\n")
+    pairs_file.close()
+    rs_file = NamedTemporaryFile(suffix='.bed', delete=False, mode='w')
+    rs_file.write("chr1\t1000\t1004\n"
+                  "chr1\t5000\t5004\n"
+                  "chr2\t3000\t3004\n")
+    rs_file.close()
+    args = "--pairsFile {} --outFileName {} -bs 1000 --QCfolder {} --threads 2 --minMappingQuality 15 " \
+           "--restrictionSequence GATC --danglingSequence GATC " \
+           "-rs {}".format(pairs_file.name, outfile.name, qc_folder, rs_file.name).split()
+    compute(hicBuildMatrix.main, args, 5)
+
+    new = hm.hiCMatrix(outfile.name)
+    assert new.matrix.shape == (15, 15)
+    assert new.matrix[1, 5] == 1
+    assert new.matrix[2, 13] == 1
+    assert new.matrix.sum() == 4
+
+    with open(qc_folder + "/QC.log") as qc_log:
+        qc_log = qc_log.read()
+    assert "Hi-C contacts\t2\t" in qc_log
+    assert "One mate unmapped\t1\t" in qc_log
+    assert "Low mapping quality\t1\t" in qc_log
+    assert "duplicated pairs\t1\t" in qc_log
+    assert "#\tduplication check\nDuplication check memory (MB)\t1.06\n" \
+           "Duplication check false positive rate\t0\n" in qc_log
+
+    qc_table = pd.read_csv(qc_folder + "/QC_table.txt", sep="\t", index_col=0)
+    assert qc_table['Duplication check memory (MB)'].dtype == np.float64
+    assert qc_table['Duplication check memory (MB)'].iloc[0] == 1.06
+
+    with open(qc_folder + "/performance.json") as performance_file:
+        performance = json.load(performance_file)
+    assert performance['read pairs'] == 5
+    assert performance['parameters']['threads'] == 2
+    assert 'reading' in performance['stages']
+    assert performance['processes']['workers']['cpu time'] > 0
+    assert os.path.exists(qc_folder + "/performance_table.txt")
+
+    os.unlink(outfile.name)
+    os.unlink(pairs_file.name)
+    os.unlink(rs_file.name)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_checkpoint_resume(monkeypatch):
+    qc_folder = mkdtemp(prefix="testQC_")
+    checkpoint_folder = mkdtemp(prefix="testCheckpoint_")
+    stopped_checkpoint_folder = os.path.join(mkdtemp(prefix="testCheckpoint_"), 'stopped')
+    args = "-s {} {} -bs 100000 --threads 2 --inputBufferSize 100 " \
+           "--restrictionSequence AAGCTT --danglingSequence AGCT " \
+           "-rs {}".format(ROOT + "R1_1000.bam", ROOT + "R2_1000.bam", ROOT + "hicFindRestSite/hindIII.bed")
+    outfiles = []
+    for name in ['single', 'checkpoint', 'resume']:
+        outfile = NamedTemporaryFile(suffix='.cool', delete=False)
+        outfile.close()
+        outfiles.append(outfile.name)
+
+    hicBuildMatrix.main("{} -o {} --QCfolder {}".format(args, outfiles[0], qc_folder + '/single').split())
+
+    # the state of the first checkpoint is kept as if the run was stopped afterwards
+    save_checkpoint = hicBuildMatrix.save_checkpoint
+
+    def save_first_checkpoint(pFileName, *pArgs):
+        save_checkpoint(pFileName, *pArgs)
+        if not os.path.exists(stopped_checkpoint_folder):
+            shutil.copytree(checkpoint_folder, stopped_checkpoint_folder)
+    monkeypatch.setattr(hicBuildMatrix, 'save_checkpoint', save_first_checkpoint)
+    hicBuildMatrix.main("{} -o {} --QCfolder {} --checkpointFolder {} "
+                        "--checkpointInterval 0".format(args, outfiles[1], qc_folder + '/checkpoint', checkpoint_folder).split())
+    assert os.listdir(checkpoint_folder) == []
+    assert os.path.exists(os.path.join(stopped_checkpoint_folder, 'checkpoint.npz'))
+
+    hicBuildMatrix.main("{} -o {} --QCfolder {} --checkpointFolder {} "
+                        "--resume".format(args, outfiles[2], qc_folder + '/resume', stopped_checkpoint_folder).split())
+    assert os.listdir(stopped_checkpoint_folder) == []
+
+    test = hm.hiCMatrix(outfiles[0])
+    for name, outfile in zip(['checkpoint', 'resume'], outfiles[1:]):
+        new = hm.hiCMatrix(outfile)
+        nt.assert_equal(test.matrix.toarray(), new.matrix.toarray())
+        nt.assert_equal(test.cut_intervals, new.cut_intervals)
+        assert are_files_equal(qc_folder + "/single/QC.log", qc_folder + "/{}/QC.log".format(name), delta=0)
+
+    for outfile in outfiles:
+        os.unlink(outfile)
+    shutil.rmtree(qc_folder)
+    shutil.rmtree(checkpoint_folder)
+    shutil.rmtree(os.path.dirname(stopped_checkpoint_folder))
@@ -5,7 +5,11 @@ from hicexplorer import hicCorrectMatrix
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
+import shutil
+import numpy as np
 import numpy.testing as nt
+import cooler
+import h5py
 from matplotlib.testing.compare import compare_images
 from matplotlib.testing.exceptions import ImageComparisonFailure
 import pytest
@@ -95,6 +99,208 @@ def test_correct_matrix_KR_partial_cool():
     os.unlink(outfile.name)
 
 
+def test_correct_matrix_ICE_chunked_cool():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    outfile_chunked = NamedTemporaryFile(suffix='_ICE_chunked.cool', delete=False)
+    outfile_chunked.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--chunkSize 50000 --threads 2 "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile_chunked.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    test = hm.hiCMatrix(outfile.name)
+    new = hm.hiCMatrix(outfile_chunked.name)
+    nt.assert_allclose(test.matrix.data, new.matrix.data, rtol=1e-10)
+    nt.assert_equal(test.matrix.indices, new.matrix.indices)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_chunked.name)
+
+
+def test_correct_matrix_ICE_in_place():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    in_place_file = NamedTemporaryFile(suffix='_in_place.cool', delete=False)
+    in_place_file.close()
+    shutil.copyfile(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", in_place_file.name)
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--inPlace".format(in_place_file.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    # the weights applied to the raw counts give the corrected matrix
+    test = cooler.Cooler(outfile.name).matrix(balance=False, sparse=True)[:].tocsr()
+    new = hm.hiCMatrix(in_place_file.name)
+    nt.assert_allclose(test.data, new.matrix.data, rtol=1e-10)
+    nt.assert_equal(test.indices, new.matrix.indices)
+    weights = cooler.Cooler(in_place_file.name).bins()['weight'][:].values
+    assert np.sum(np.isnan(weights)) == 128
+
+    # a second run replaces the weights instead of correcting the corrected matrix
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--inPlace --chunkSize 100000".format(in_place_file.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    nt.assert_allclose(weights, cooler.Cooler(in_place_file.name).bins()['weight'][:].values, rtol=1e-10)
+
+    os.unlink(outfile.name)
+    os.unlink(in_place_file.name)
+
+
+def test_correct_matrix_ICE_perchr_threads():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    outfile_threads = NamedTemporaryFile(suffix='_ICE_threads.cool', delete=False)
+    outfile_threads.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --perchr "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --perchr --threads 3 "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile_threads.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    test = hm.hiCMatrix(outfile.name)
+    new = hm.hiCMatrix(outfile_threads.name)
+    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_equal(test.matrix.indices, new.matrix.indices)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_threads.name)
+
+
+def test_correct_matrix_ICE_start_weights():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    outfile_warm = NamedTemporaryFile(suffix='_ICE_warm.cool', delete=False)
+    outfile_warm.close()
+    in_place_file = NamedTemporaryFile(suffix='_in_place.cool', delete=False)
+    in_place_file.close()
+    shutil.copyfile(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", in_place_file.name)
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--inPlace".format(in_place_file.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --startWeights {} "\
+           "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                      in_place_file.name, outfile_warm.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    with h5py.File(outfile.name, 'r') as cold, h5py.File(outfile_warm.name, 'r') as warm:
+        assert cold['bins/weight'].attrs['converged']
+        assert warm['bins/weight'].attrs['converged']
+        assert cold['bins/weight'].attrs['iterations'] > 10
+        # the start weights are already converged
+        assert warm['bins/weight'].attrs['iterations'] == 1
+        assert len(warm['bins/weight'].attrs['convergence_history']) == 1
+
+    test = hm.hiCMatrix(outfile.name)
+    new = hm.hiCMatrix(outfile_warm.name)
+    nt.assert_allclose(test.matrix.data, new.matrix.data, rtol=1e-4)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_warm.name)
+    os.unlink(in_place_file.name)
+
+
+def test_correct_matrix_ICE_mcool_resolutions():
+    mcool_file = NamedTemporaryFile(suffix='.mcool', delete=False)
+    mcool_file.close()
+    single_file = NamedTemporaryFile(suffix='.mcool', delete=False)
+    single_file.close()
+    shutil.copyfile(ROOT + "matrix.mcool", mcool_file.name)
+    shutil.copyfile(ROOT + "matrix.mcool", single_file.name)
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+           "--inPlace --threads 3".format(mcool_file.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    # all resolutions are balanced as if they were balanced one by one
+    for group in cooler.fileops.list_coolers(single_file.name):
+        args = "correct --matrix {}::{} --correctionMethod ICE --filterThreshold -1.5 5.0 "\
+               "--inPlace".format(single_file.name, group).split()
+        compute(hicCorrectMatrix.main, args, 5)
+        nt.assert_allclose(cooler.Cooler(single_file.name + '::' + group).bins()['weight'][:].values,
+                           cooler.Cooler(mcool_file.name + '::' + group).bins()['weight'][:].values,
+                           rtol=1e-10)
+
+    # the bins filtered at 640 kb are masked at 40 kb
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --inPlace "\
+           "--resolutions 40000 640000 --maskFromCoarsestResolution".format(mcool_file.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    coarse = cooler.Cooler(mcool_file.name + '::/0').bins()[:]
+    fine = cooler.Cooler(mcool_file.name + '::/4').bins()[:]
+    coarse_masked = coarse[np.isnan(coarse['weight'])]
+    fine['coarse_start'] = fine['start'] // 640000 * 640000
+    fine = fine.merge(coarse_masked[['chrom', 'start']], left_on=['chrom', 'coarse_start'], right_on=['chrom', 'start'])
+    assert len(fine) > 0
+    assert np.all(np.isnan(fine['weight']))
+
+    os.unlink(mcool_file.name)
+    os.unlink(single_file.name)
+
+
+def test_correct_matrix_ICE_single_precision():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    outfile_single = NamedTemporaryFile(suffix='_ICE_single.cool', delete=False)
+    outfile_single.close()
+
+    for perchr in ['', '--perchr']:
+        args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 {} "\
+               "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", perchr,
+                                          outfile.name).split()
+        compute(hicCorrectMatrix.main, args, 5)
+        args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 {} --singlePrecision "\
+               "--outFileName {} ".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", perchr,
+                                          outfile_single.name).split()
+        compute(hicCorrectMatrix.main, args, 5)
+
+        # the single precision correction agrees with the double precision one within the tolerance
+        test = cooler.Cooler(outfile.name)
+        new = cooler.Cooler(outfile_single.name)
+        nt.assert_allclose(test.bins()['weight'][:].values, new.bins()['weight'][:].values, rtol=1e-5)
+        nt.assert_allclose(test.pixels()[:]['count'].values, new.pixels()[:]['count'].values, rtol=1e-5)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_single.name)
+
+
+def test_cooler_marginals():
+    matrix = ROOT + "hicCorrectMatrix/gm12878_raw_values.cool"
+    ma = hm.hiCMatrix(matrix)
+    ma.reorderChromosomes(['2', '1', 'X'])
+    row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
+    ma.maskBins(np.flatnonzero(row_sum == 0))
+
+    for perchr in [False, True]:
+        # the marginals of the pixel chunks are the marginals of the loaded matrix
+        test = hicCorrectMatrix.matrix_marginals(ma, perchr)
+        marginals, chr_bin_ranges = hicCorrectMatrix.cooler_marginals(matrix, ['2', '1', 'X'], perchr, chunk_size=10000)
+        new = np.concatenate([marginals[start:end] for _, (start, end) in chr_bin_ranges])
+        nt.assert_allclose(test, new[np.isfinite(new)], rtol=1e-10)
+        assert len(hicCorrectMatrix.filter_by_zscore(marginals, -1.5, 5, chr_bin_ranges)) > 0
+
+
 @pytest.mark.xfail(raises=ImageComparisonFailure, reason='Matplotlib plots for reasons a different image size.')
 def test_correct_matrix_diagnostic_plot():
     outfile = NamedTemporaryFile(
@@ -0,0 +1,55 @@
+import warnings
+warnings.simplefilter(action="ignore", category=RuntimeWarning)
+warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
+from hicexplorer import hicBuildMatrix, hicCreateShardPlan
+from hicmatrix import HiCMatrix as hm
+from tempfile import NamedTemporaryFile, mkdtemp
+import shutil
+import os
+import numpy.testing as nt
+from hicexplorer.test.test_compute_function import compute
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
+sam_R1 = ROOT + "R1_1000.bam"
+sam_R2 = ROOT + "R2_1000.bam"
+hindIII_file = ROOT + "hicFindRestSite/hindIII.bed"
+
+
+def test_shard_plan_and_merge():
+    tmp_dir = mkdtemp(prefix="testShards_")
+    matrix_args = "--threads 2 -bs 100000 --restrictionSequence AAGCTT --danglingSequence AGCT " \
+                  "-rs {}".format(hindIII_file).split()
+
+    plan = os.path.join(tmp_dir, 'plan.npz')
+    args = "-s {} {} -n 300 -o {}".format(sam_R1, sam_R2, plan).split()
+    compute(hicCreateShardPlan.main, args, 5)
+    shard_plan = hicBuildMatrix.load_shard_plan(plan)
+    assert shard_plan['first_read_index'].tolist() == [0, 300, 600, 900]
+    assert sum(shard_plan['number_of_read_pairs']) == 983
+
+    shards = []
+    for shard in range(4):
+        shards.append(os.path.join(tmp_dir, 'shard_{}.cool'.format(shard)))
+        args = "-s {} {} --shardPlan {} --shard {} --outFileName {} " \
+               "--QCfolder {}".format(sam_R1, sam_R2, plan, shard, shards[-1],
+                                      os.path.join(tmp_dir, 'QC_{}'.format(shard))).split()
+        compute(hicBuildMatrix.main, args + matrix_args, 5)
+
+    merged = os.path.join(tmp_dir, 'merged.h5')
+    args = ["--mergeShards"] + shards + "--outFileName {} --QCfolder {}".format(merged, os.path.join(tmp_dir, 'QC_merged')).split()
+    compute(hicBuildMatrix.main, args + matrix_args, 5)
+
+    single = os.path.join(tmp_dir, 'single.h5')
+    args = "-s {} {} --outFileName {} --QCfolder {}".format(sam_R1, sam_R2, single, os.path.join(tmp_dir, 'QC_single')).split()
+    compute(hicBuildMatrix.main, args + matrix_args, 5)
+
+    test = hm.hiCMatrix(single)
+    new = hm.hiCMatrix(merged)
+    nt.assert_equal(test.matrix.toarray(), new.matrix.toarray())
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+    with open(os.path.join(tmp_dir, 'QC_single', 'QC.log')) as qc_single, \
+            open(os.path.join(tmp_dir, 'QC_merged', 'QC.log')) as qc_merged:
+        assert [line for line in qc_single if not line.startswith('File')] == \
+            [line for line in qc_merged if not line.startswith('File')]
+
+    shutil.rmtree(tmp_dir)
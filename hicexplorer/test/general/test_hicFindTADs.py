@@ -5,8 +5,11 @@ from hicexplorer import hicFindTADs
 from hicmatrix import HiCMatrix as hm
 from tempfile import mkdtemp
 import shutil
+from collections import OrderedDict
 import os
+import numpy as np
 import numpy.testing as nt
+from scipy.sparse import triu
 from hicexplorer.test.test_compute_function import compute
 
 
@@ -121,3 +124,117 @@ def test_find_TADs_none():
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
 
     shutil.rmtree(tad_folder)
+
+
+def test_compute_diamond_means():
+    # the cumulative sums give the same scores as the diamonds of get_cut_weight
+    hic_ma = hm.hiCMatrix(ROOT + 'find_TADs/FDR/multiFDR_zscore_matrix.h5')
+    chr_first_bin, chr_last_bin = hic_ma.chrBinBoundaries['chr4']
+    hic_ma.matrix = triu(hic_ma.matrix, format='csr')
+    _, bin_starts, bin_ends, _ = zip(*hic_ma.cut_intervals[chr_first_bin:chr_last_bin])
+    cuts = np.arange(0, chr_last_bin - chr_first_bin, 7)
+    window_lengths = [20000, 60000, 180000]
+
+    means = hicFindTADs.compute_diamond_means(hic_ma.matrix, np.array(bin_starts), np.array(bin_ends),
+                                              chr_first_bin, cuts, window_lengths)
+    for cut_idx, cut in enumerate(cuts):
+        for window_idx, window_len in enumerate(window_lengths):
+            expected = hicFindTADs.get_cut_weight(hic_ma, chr_first_bin + cut, window_len, return_mean=True)
+            if expected is None or not np.isfinite(expected):
+                assert np.isnan(means[cut_idx, window_idx])
+            else:
+                nt.assert_allclose(means[cut_idx, window_idx], expected, rtol=1e-10, atol=1e-12)
+
+
+def test_get_tasks():
+    chr_bin_boundaries = OrderedDict([('chr1', (0, 2500)), ('chr2', (2500, 2600)), ('chr3', (2600, 5000))])
+    tasks = hicFindTADs.get_tasks(chr_bin_boundaries, [20000], 1000)
+    assert [task[:4] for task in tasks] == [(0, 2500, 0, 1000), (0, 2500, 1000, 2000), (0, 2500, 2000, 2500),
+                                            (2500, 2600, 2500, 2600),
+                                            (2600, 5000, 2600, 3600), (2600, 5000, 3600, 4600), (2600, 5000, 4600, 5000)]
+
+
+def test_compute_spectra_matrix_task_values(monkeypatch):
+    # tasks with a smaller band, i.e. with fewer bins, give the same scores
+    bedgraph_matrices = []
+    for score_task_values in [hicFindTADs.SCORE_TASK_VALUES, 2**10]:
+        monkeypatch.setattr(hicFindTADs, 'SCORE_TASK_VALUES', score_task_values)
+        ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5', min_depth=20000,
+                                     max_depth=60000, step=20000, use_zscore=False, pChromosomes=['chr4', 'chr2L'])
+        ft.compute_spectra_matrix()
+        bedgraph_matrices.append(ft.bedgraph_matrix)
+    assert hicFindTADs.get_chunk_size(5000, 1, 24) == 18
+    for key in ['chrom', 'chr_start', 'chr_end', 'matrix']:
+        nt.assert_equal(bedgraph_matrices[1][key], bedgraph_matrices[0][key])
+
+
+def test_find_TADs_tad_score_cache():
+    # the binary TAD-separation score gives the same boundaries as the text bedgraph matrix
+    tad_folder = mkdtemp(prefix="test_case_find_tads_cache")
+    ft = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    ft.load_bedgraph_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm")
+    ft.save_tad_score_cache(tad_folder + "/cache_tad_score.h5")
+    shutil.copy(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5', tad_folder + "/cache_zscore_matrix.h5")
+
+    for chromosomes in [None, ['chr3R', 'chr2L']]:
+        cached = hicFindTADs.HicFindTads(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+        cached.load_tad_score_cache(tad_folder + "/cache_tad_score.h5", chromosomes)
+        ft.load_bedgraph_matrix(ROOT + "find_TADs/None/multiNone_tad_score.bm", chromosomes)
+        for key in ['chrom', 'chr_start', 'chr_end', 'matrix']:
+            nt.assert_equal(cached.bedgraph_matrix[key], ft.bedgraph_matrix[key])
+        assert (cached.min_depth, cached.max_depth, cached.step, cached.binsize) == (ft.min_depth, ft.max_depth, ft.step, ft.binsize)
+
+    args = "--matrix {0}/cache_zscore_matrix.h5 --TAD_sep_score_prefix {0}/cache \
+    --outPrefix {0}/test_multiNone --minBoundaryDistance 20000 --skipTADscoreTextFile \
+    --correctForMultipleTesting None --thresholdComparisons 1.0".format(tad_folder).split()
+    compute(hicFindTADs.main, args, 5)
+
+    assert not os.path.isfile(tad_folder + "/test_multiNone_tad_score.bm")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", tad_folder + "/test_multiNone_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_domains.bed", tad_folder + "/test_multiNone_domains.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
+
+    shutil.rmtree(tad_folder)
+
+
+def test_find_TADs_parameter_sweep():
+    # the boundaries of each combination of a sweep are the same as of a single run
+    matrix = ROOT + "small_test_matrix.h5"
+    tad_folder = mkdtemp(prefix="test_case_find_tads_sweep")
+    shutil.copy(ROOT + "find_TADs/None/multiNone_tad_score.bm", tad_folder + "/test_multiNone_tad_score.bm")
+    shutil.copy(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5', tad_folder + "/test_multiNone_zscore_matrix.h5")
+    args = "--matrix {} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
+    --outPrefix {}/test_multiNone --minBoundaryDistance 20000 --delta 0.01 0.05 \
+    --correctForMultipleTesting None --thresholdComparisons 0.05 1.0".format(matrix, tad_folder).split()
+
+    compute(hicFindTADs.main, args, 5)
+
+    prefix = tad_folder + "/test_multiNone_delta0.01_thres1.0"
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", prefix + "_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_domains.bed", prefix + "_domains.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.gff", prefix + "_boundaries.gff")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", prefix + "_score.bedgraph")
+    for delta, threshold in [('0.01', '0.05'), ('0.05', '0.05'), ('0.05', '1.0')]:
+        assert os.path.isfile(tad_folder + "/test_multiNone_delta{}_thres{}_boundaries.bed".format(delta, threshold))
+
+    shutil.rmtree(tad_folder)
+
+
+def test_ranksums_pvalues():
+    # the rank sum tests computed at once give the p-values of scipy's ranksums
+    from scipy.stats import ranksums
+    rng = np.random.RandomState(7)
+    samples = []
+    for i in range(20):
+        # rounded values to have ties, and samples with NaN and of size 1
+        x = np.round(rng.randn(rng.randint(1, 30)), 1)
+        y = np.round(rng.randn(rng.randint(1, 30)) + 0.5, 1)
+        if i % 7 == 0:
+            y[0] = np.nan
+        samples.append((x, y))
+    pvalues = hicFindTADs.ranksums_pvalues(np.concatenate([x for x, _ in samples]),
+                                           np.concatenate([np.full(len(x), i) for i, (x, _) in enumerate(samples)]),
+                                           np.concatenate([y for _, y in samples]),
+                                           np.concatenate([np.full(len(y), i) for i, (_, y) in enumerate(samples)]),
+                                           len(samples))
+    nt.assert_allclose(pvalues, [ranksums(x, y)[1] for x, y in samples], rtol=1e-12)
@@ -6,7 +6,7 @@ import logging
 log = logging.getLogger(__name__)
 
 from hicexplorer import hicQuickQC
-from hicexplorer.test.test_compute_function import compute
+from hicexplorer.test.test_compute_function import compute, qc_files
 
 ROOT = os.path.join(os.path.dirname(
     os.path.dirname(os.path.abspath(__file__))), "test_data/")
@@ -44,8 +44,8 @@ def test_main():
     # hicQuickQC.main(args)
     compute(hicQuickQC.main, args, 5)
 
-    # print(set(os.listdir(ROOT + "hicQuickQC/")))
+    # print(qc_files(ROOT + "hicQuickQC/"))
     assert are_files_equal(ROOT + "hicQuickQC/QC.log", qc_folder + "/QC.log")
-    assert set(os.listdir(ROOT + "hicQuickQC/")) == set(os.listdir(qc_folder))
+    assert qc_files(ROOT + "hicQuickQC/") == qc_files(qc_folder)
 
     shutil.rmtree(qc_folder)
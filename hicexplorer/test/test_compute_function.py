@@ -1,3 +1,4 @@
+import os
 import time
 from random import randint
 
@@ -13,3 +14,8 @@ def compute(pFunction, pParameters, pTries):
             exception_string = str(exp)
     raise Exception('Tries {}, but still got an exception: {}'.format(pTries, exception_string))
     return
+
+
+def qc_files(pQCFolder):
+    # the performance report contains timings of the run, it is not compared
+    return set(file_name for file_name in os.listdir(pQCFolder) if not file_name.startswith('performance'))
@@ -11,6 +11,8 @@ import cooler
 from copy import deepcopy
 import time
 from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
+from scipy.sparse import csr_matrix
 import traceback
 import logging
 log = logging.getLogger(__name__)
@@ -688,3 +690,40 @@ def in_units(pBasePosition):
         labels = "{:.2f} ".format((pBasePosition))
         labels += " bp"
     return labels
+
+
+def share_array(pArray):
+    """
+    Copies a numpy array into shared memory, such that the processes of a pool
+    can access it without pickling it. The returned tuple can be passed to the
+    processes, also with the spawn start method, see array_from_shared.
+    """
+    shared_array = RawArray(np.ctypeslib.as_ctypes_type(pArray.dtype), max(1, len(pArray)))
+    np.frombuffer(shared_array, dtype=pArray.dtype)[:len(pArray)] = pArray
+    return shared_array, pArray.dtype.str, len(pArray)
+
+
+def array_from_shared(pSharedArray):
+    """
+    Numpy view of an array copied into shared memory with share_array.
+    """
+    shared_array, dtype, length = pSharedArray
+    return np.frombuffer(shared_array, dtype=dtype)[:length]
+
+
+def share_csr_matrix(pMatrix):
+    """
+    Copies the arrays of a csr matrix into shared memory, such that the
+    processes of a pool can access the matrix without pickling it.
+
+    :return: the shared data, indices and indptr arrays and the shape of the matrix
+    """
+    return [share_array(pMatrix.data), share_array(pMatrix.indices), share_array(pMatrix.indptr), pMatrix.shape]
+
+
+def csr_matrix_from_shared(pData, pIndices, pIndptr, pShape):
+    """
+    Csr matrix on the arrays shared with share_csr_matrix, without copying them.
+    """
+    return csr_matrix((array_from_shared(pData), array_from_shared(pIndices), array_from_shared(pIndptr)),
+                      shape=pShape, copy=False)